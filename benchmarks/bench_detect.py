@@ -0,0 +1,89 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Detection latency (single image) and throughput (batches) at several image and batch sizes.
+# Requires the detect extra, the model is downloaded on first use.
+# uv run --extra detect python benchmarks/bench_detect.py [BACKEND]
+
+import math
+import pathlib
+import sys
+import tempfile
+import typing as ta
+
+from common import emit, measure, synthetic_image
+
+from kbai.image import DETECTION_EDGES, ImageSrc, load_images
+from kbai.structs import DetectorBackend, Size
+
+if ta.TYPE_CHECKING:
+    from kbai.detector import Detector
+
+IMAGE_SIZES = [Size(640, 480), Size(1920, 1080), Size(6000, 4000)]
+BATCH_SIZES = [1, 4, 8]
+IMAGE_COUNT = 8
+FEATURES = ["a human face", "a person", "a dog", "a cat"]
+
+
+def count_forward_passes(
+    detector: "Detector", images: list[ImageSrc], features: list[list[str]], batch_size: int
+) -> int:
+    """
+    Number of model forward passes detecting features in images takes
+    """
+    forward = detector._forward
+    passes = 0
+
+    def counted(inputs: ta.Any) -> ta.Any:
+        nonlocal passes
+        passes += 1
+        return forward(inputs)
+
+    detector._forward = counted  # type: ignore[method-assign]
+    try:
+        detector.detect_many(images, features, batch_size=batch_size)
+    finally:
+        del detector._forward
+    return passes
+
+
+def run(backend: DetectorBackend = DetectorBackend.TORCH) -> list[dict[str, ta.Any]]:
+    from kbai.detector import Detector
+
+    detector = Detector(backend=backend)
+    results = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        for size in IMAGE_SIZES:
+            # Distinct images, identical ones would only be detected once
+            sources = [pathlib.Path(tempdir) / f"{size}-{i}.jpg" for i in range(IMAGE_COUNT)]
+            for seed, source in enumerate(sources):
+                synthetic_image(source, size, seed)
+            images = load_images([str(source) for source in sources], edges=DETECTION_EDGES)
+            features = [FEATURES] * IMAGE_COUNT
+            # Warm up
+            detector.detect(images[0], FEATURES)
+            latency = measure(lambda images=images: detector.detect(images[0], FEATURES))
+            for batch_size in BATCH_SIZES:
+                passes = count_forward_passes(detector, images, features, batch_size)
+                if passes != math.ceil(IMAGE_COUNT / batch_size):
+                    raise RuntimeError(f"{passes} forward passes for batch size {batch_size}")
+                seconds = measure(
+                    lambda images=images, features=features, batch_size=batch_size: detector.detect_many(
+                        images, features, batch_size=batch_size
+                    )
+                )
+                results.append(
+                    {
+                        "backend": backend.value,
+                        "image_size": str(size),
+                        "batch_size": batch_size,
+                        "forward_passes": passes,
+                        "latency_seconds": latency,
+                        "images_per_second": IMAGE_COUNT / seconds["min"],
+                    }
+                )
+    return results
+
+
+if __name__ == "__main__":
+    emit("detect", run(DetectorBackend(sys.argv[1]) if len(sys.argv) > 1 else DetectorBackend.TORCH))
@@ -0,0 +1,50 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# End to end encode of a single image segment, in frames per second, for each fit and renderer.
+# Requires ffmpeg.
+# uv run python benchmarks/bench_encode.py
+
+import pathlib
+import tempfile
+import typing as ta
+
+from common import emit, kbimage, measure, synthetic_image
+
+from kbai.encoder import encode
+from kbai.structs import Fit, Renderer, Size
+
+SOURCE_SIZE = Size(1920, 1280)
+ENCODE_SIZE = Size(640, 360)
+FPS = 25
+DURATION = 5
+
+
+def run() -> list[dict[str, ta.Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        outdir = pathlib.Path(tempdir)
+        source = outdir / "source.jpg"
+        synthetic_image(source, SOURCE_SIZE)
+        for fit in Fit:
+            for renderer in Renderer:
+                image = kbimage(str(source), SOURCE_SIZE, fit, DURATION)
+                seconds = measure(
+                    lambda image=image, renderer=renderer: encode(
+                        ENCODE_SIZE, FPS, [image], outdir / "out.mp4", renderer=renderer
+                    ),
+                    repeat=2,
+                )
+                results.append(
+                    {
+                        "fit": fit.value,
+                        "renderer": renderer.value,
+                        "seconds": seconds,
+                        "fps": DURATION * FPS / seconds["min"],
+                    }
+                )
+    return results
+
+
+if __name__ == "__main__":
+    emit("encode", run())
@@ -0,0 +1,43 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Time building the encode filtergraph, and rendering it to the ffmpeg -filter_complex string.
+# uv run python benchmarks/bench_filtergraph.py
+
+import itertools
+import typing as ta
+
+from common import emit, kbimage, measure
+
+from kbai.encoder import build_filtergraph
+from kbai.structs import Fit, Size
+
+ENCODE_SIZE = Size(640, 360)
+FPS = 25
+IMAGE_COUNTS = [10, 100, 1000]
+ORIENTATIONS = {"landscape": Size(4000, 3000), "portrait": Size(3000, 4000)}
+
+
+def run() -> list[dict[str, ta.Any]]:
+    results = []
+    # Every fit with every orientation, each builds a different kind of segment filterchain
+    for fit, (orientation, size), count in itertools.product(Fit, ORIENTATIONS.items(), IMAGE_COUNTS):
+        kbimages = [kbimage(f"image{i}.jpg", size, fit) for i in range(count)]
+        results.append(
+            {
+                "images": count,
+                "fit": fit.value,
+                "orientation": orientation,
+                "build_seconds": measure(
+                    lambda kbimages=kbimages: build_filtergraph(ENCODE_SIZE, FPS, kbimages)
+                ),
+                "build_and_format_seconds": measure(
+                    lambda kbimages=kbimages: str(build_filtergraph(ENCODE_SIZE, FPS, kbimages))
+                ),
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    emit("filtergraph", run())
@@ -0,0 +1,84 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Compare segment rendering time of the zoompan and native renderers on a large synthetic source.
+# zoompan pans in whole pixels, so it is usually smoothed by upscaling its input,
+# the zoompan-upscaled variant measures that.
+# Requires ffmpeg.
+# uv run python benchmarks/bench_renderer.py
+
+import pathlib
+import subprocess
+import tempfile
+import time
+import typing as ta
+
+from common import emit, synthetic_image
+
+from kbai import encoder, renderer
+from kbai.easings import Easing
+from kbai.structs import AnnotatedBox, Fit, KBImage, Size
+from kbai.transitions import Transition
+
+SOURCE_SIZE = Size(6000, 4000)
+ENCODE_SIZE = Size(640, 360)
+FPS = 25
+DURATION = 5
+UPSCALE = 4
+
+
+def render_upscaled_segment(
+    image: KBImage, input_: str, encode_size: Size, fps: int, outfile: pathlib.Path
+) -> None:
+    filterchain = encoder.segment_filterchain(image, "0", encode_size, fps)
+    if filterchain.filters[0].name == "scale":
+        filterchain.filters.pop(0)
+    filterchain.filters.insert(0, encoder.Filter("scale", {"w": f"iw*{UPSCALE}", "h": f"ih*{UPSCALE}"}))
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-i",
+        input_,
+        "-filter_complex",
+        str(encoder.FilterGraph([filterchain])),
+        *encoder.SEGMENT_CODEC_ARGUMENTS,
+        "-y",
+        str(outfile),
+    ]
+    subprocess.check_call(command)  # noqa: S603
+
+
+RENDERERS = {
+    "zoompan": encoder.render_segment,
+    "zoompan-upscaled": render_upscaled_segment,
+    "native": renderer.render_segment,
+}
+
+
+def run() -> dict[str, ta.Any]:
+    results = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        outdir = pathlib.Path(tempdir)
+        source = outdir / "source.jpg"
+        synthetic_image(source, SOURCE_SIZE)
+        image = KBImage(
+            str(source),
+            SOURCE_SIZE,
+            fit=Fit.COVER,
+            boxes=[AnnotatedBox(2800, 1800, 3400, 2200, "target")],
+            duration=DURATION,
+            transition_duration=1,
+            transition=Transition.FADE,
+            transition_easing=Easing.CUBIC_IN_OUT,
+        )
+        for name, render in RENDERERS.items():
+            start = time.perf_counter()
+            render(image, str(source), ENCODE_SIZE, FPS, outdir / f"{name}.mkv")
+            elapsed = time.perf_counter() - start
+            results.append({"renderer": name, "seconds": elapsed, "fps": DURATION * FPS / elapsed})
+    return {"source_size": str(SOURCE_SIZE), "encode_size": str(ENCODE_SIZE), "results": results}
+
+
+if __name__ == "__main__":
+    emit("renderer", run())
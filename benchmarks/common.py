@@ -0,0 +1,87 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Shared helpers for the benchmarks, which use synthetic local images so they need no network.
+
+import importlib.metadata
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import time
+import typing as ta
+from collections.abc import Callable
+
+import numpy as np
+from PIL import Image
+
+from kbai.easings import Easing
+from kbai.structs import AnnotatedBox, Fit, KBImage, Size
+from kbai.transitions import Transition
+
+
+def synthetic_image(path: pathlib.Path, size: Size, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    # Smooth gradients with noise, so the encoder has realistic detail to compress
+    y, x = np.mgrid[0 : size.height, 0 : size.width]
+    pixels = np.stack(
+        [x * 255 / size.width, y * 255 / size.height, (x + y) * 127 / (size.width + size.height)]
+    )
+    pixels += rng.normal(0, 16, pixels.shape)
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8).transpose(1, 2, 0)).save(path, quality=90)
+
+
+def kbimage(src: str, size: Size, fit: Fit = Fit.COVER, duration: float = 5) -> KBImage:
+    """
+    An image with a single box, off center so the segment pans and zooms
+    """
+    return KBImage(
+        src,
+        size,
+        fit=fit,
+        boxes=[
+            AnnotatedBox(
+                size.width * 0.45, size.height * 0.45, size.width * 0.6, size.height * 0.55, "target"
+            )
+        ],
+        duration=duration,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=Easing.CUBIC_IN_OUT,
+    )
+
+
+def measure(func: Callable[[], ta.Any], repeat: int = 3) -> dict[str, float]:
+    """
+    Time repeat calls of func, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def environment() -> dict[str, ta.Any]:
+    try:
+        version = importlib.metadata.version("kbai")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    ffmpeg = None
+    if shutil.which("ffmpeg"):
+        ffmpeg = subprocess.check_output(["ffmpeg", "-version"], text=True).splitlines()[0]  # noqa: S603, S607
+    return {
+        "kbai": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": ffmpeg,
+    }
+
+
+def emit(name: str, results: ta.Any) -> None:
+    print(json.dumps({"environment": environment(), name: results}, indent=2))
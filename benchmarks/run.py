@@ -0,0 +1,50 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Run all the benchmarks and write the results as JSON, to track regressions between releases.
+# uv run --extra detect python benchmarks/run.py --output results.json
+
+import argparse
+import json
+import pathlib
+import sys
+
+import bench_detect
+import bench_encode
+import bench_filtergraph
+import bench_renderer
+from common import environment
+
+BENCHMARKS = {
+    "filtergraph": bench_filtergraph.run,
+    "encode": bench_encode.run,
+    "renderer": bench_renderer.run,
+    "detect": bench_detect.run,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the kbai benchmarks.")
+    parser.add_argument("--output", type=pathlib.Path, help="Write results to this file instead of stdout.")
+    parser.add_argument(
+        "--only", choices=list(BENCHMARKS), action="append", help="Run only these benchmarks."
+    )
+    parser.add_argument("--skip", choices=list(BENCHMARKS), action="append", default=[], help="Skip these.")
+    args = parser.parse_args()
+
+    results = {"environment": environment()}
+    for name, run in BENCHMARKS.items():
+        if name in args.skip or (args.only and name not in args.only):
+            continue
+        print(f"Running {name}", file=sys.stderr)
+        results[name] = run()
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
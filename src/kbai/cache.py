@@ -0,0 +1,181 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import Collection, Iterator, Sequence
+from contextlib import contextmanager
+
+from .structs import AnnotatedBox
+
+
+@contextmanager
+def transaction(path: pathlib.Path) -> Iterator[sqlite3.Connection]:
+    """
+    Open the sqlite database at path and run an immediate (write locked) transaction
+    """
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        # WAL lets readers proceed while another process is writing
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+class DetectionCache:
+    """
+    Persistent cache of detection results, stored in an sqlite database
+    so it can be shared by concurrent processes.
+    Entries older than max_age seconds are expired, and least recently used
+    entries are evicted when the total size exceeds max_bytes.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path | str,
+        max_bytes: int | None = None,
+        max_age: float | None = None,
+    ) -> None:
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with transaction(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS detections ("
+                "key TEXT PRIMARY KEY, boxes TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def key(
+        image_digest: str, text: str, model_id: str, box_threshold: float, text_threshold: float
+    ) -> str:
+        """
+        Key of the detections of an image, image_digest (see ImageSrc.digest) includes
+        the source size because boxes are in source coordinates
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{image_digest}:".encode())
+        digest.update(json.dumps([text, model_id, box_threshold, text_threshold]).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> list[AnnotatedBox] | None:
+        now = time.time()
+        with transaction(self.path) as connection:
+            self._expire(connection, now)
+            row = connection.execute("SELECT boxes FROM detections WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE detections SET accessed = ? WHERE key = ?", (now, key))
+        return [AnnotatedBox(*box) for box in json.loads(row[0])]
+
+    def put(self, key: str, boxes: Sequence[AnnotatedBox]) -> None:
+        now = time.time()
+        data = json.dumps([[box.xmin, box.ymin, box.xmax, box.ymax, box.annotation] for box in boxes])
+        with transaction(self.path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO detections (key, boxes, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(key) + len(data), now, now),
+            )
+            self._expire(connection, now)
+            self._evict(connection)
+
+    def _expire(self, connection: sqlite3.Connection, now: float) -> None:
+        if self.max_age is not None:
+            connection.execute("DELETE FROM detections WHERE created < ?", (now - self.max_age,))
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        if self.max_bytes is None:
+            return
+        # Keep the most recently accessed entries that fit within max_bytes
+        connection.execute(
+            "DELETE FROM detections WHERE key IN ("
+            "SELECT key FROM ("
+            "SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM detections"
+            ") WHERE total > ?)",
+            (self.max_bytes,),
+        )
+
+
+class SegmentCache:
+    """
+    Persistent cache of rendered segment files, keyed by a hash of their inputs.
+    Least recently used segments are evicted when the total size exceeds max_bytes.
+    """
+
+    def __init__(self, root: pathlib.Path | str, max_bytes: int | None = None) -> None:
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self.segments = self.root / "segments"
+        self.segments.mkdir(parents=True, exist_ok=True)
+        self.index = self.root / "index.db"
+        with transaction(self.index) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "key TEXT PRIMARY KEY, name TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    def get(self, key: str) -> pathlib.Path | None:
+        with transaction(self.index) as connection:
+            row = connection.execute("SELECT name FROM segments WHERE key = ?", (key,)).fetchone()
+            if row is None or not (self.segments / row[0]).exists():
+                return None
+            connection.execute("UPDATE segments SET accessed = ? WHERE key = ?", (time.time(), key))
+        return self.segments / row[0]
+
+    def put(self, key: str, segment: pathlib.Path) -> pathlib.Path:
+        """
+        Move the rendered segment file into the cache, returning its cached path.
+        Nothing is evicted until evict is called, so segments in use are not removed.
+        """
+        name = key + segment.suffix
+        path = self.segments / name
+        # Move into place atomically, so concurrent readers never see a partial file
+        partial = path.with_name(f".{name}.{os.getpid()}.{threading.get_ident()}")
+        shutil.move(segment, partial)
+        partial.replace(path)
+        with transaction(self.index) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO segments (key, name, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, name, path.stat().st_size, time.time()),
+            )
+        return path
+
+    def evict(self, keep: Collection[str] = ()) -> None:
+        """
+        Evict least recently used segments beyond max_bytes, except the keep keys
+        (e.g. the segments of an encode that is still using them)
+        """
+        if self.max_bytes is None:
+            return
+        with transaction(self.index) as connection:
+            # Keep the most recently accessed segments that fit within max_bytes
+            rows = [
+                (key, name)
+                for key, name in connection.execute(
+                    "SELECT key, name FROM ("
+                    "SELECT key, name, SUM(size) OVER (ORDER BY accessed DESC, key) AS total "
+                    "FROM segments) WHERE total > ?",
+                    (self.max_bytes,),
+                )
+                if key not in keep
+            ]
+            connection.executemany("DELETE FROM segments WHERE key = ?", [(key,) for key, _ in rows])
+        for _, name in rows:
+            (self.segments / name).unlink(missing_ok=True)
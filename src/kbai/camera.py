@@ -0,0 +1,216 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import json
+import pathlib
+import sys
+import typing as ta
+from dataclasses import dataclass
+
+import numpy as np
+
+from .easings import ease
+from .encoder import (
+    PREVIEW_SWS_FLAGS,
+    SEGMENT_CODEC_ARGUMENTS,
+    Filter,
+    FilterChain,
+    FilterGraph,
+    SegmentLayout,
+    input_arguments,
+    loglevel,
+    lowres,
+    run_ffmpeg,
+    segment_layout,
+)
+from .progress import ProgressCallback
+from .structs import KBImage, Size
+
+# Max allowed ffmpeg zoom, applied here too so every renderer produces the same path
+MAX_ZOOM = 10
+
+
+def frame_count(image: KBImage, fps: int) -> int:
+    return round(image.duration * fps)
+
+
+@dataclass
+class CameraPath:
+    """
+    Per frame camera of an image segment, the same path zoompan follows but without
+    rounding to whole pixels. x and y are the top left of the zoomed region in zoom image
+    coordinates (size), the zoomed image is then center cropped to encode_size.
+    """
+
+    fps: int
+    size: Size
+    encode_size: Size
+    zoom: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.zoom)
+
+    def visible_boxes(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Region of each frame visible in the output (left, top, right, bottom) in zoom image coordinates
+        """
+        crop_x = (self.size.width - self.encode_size.width) / 2
+        crop_y = (self.size.height - self.encode_size.height) / 2
+        return (
+            self.x + crop_x / self.zoom,
+            self.y + crop_y / self.zoom,
+            self.x + (crop_x + self.encode_size.width) / self.zoom,
+            self.y + (crop_y + self.encode_size.height) / self.zoom,
+        )
+
+    def to_dict(self) -> dict[str, ta.Any]:
+        return {
+            "fps": self.fps,
+            "size": [self.size.width, self.size.height],
+            "encode_size": [self.encode_size.width, self.encode_size.height],
+            "zoom": self.zoom.tolist(),
+            "x": self.x.tolist(),
+            "y": self.y.tolist(),
+        }
+
+    def write_json(self, path: pathlib.Path | str) -> None:
+        pathlib.Path(path).write_text(json.dumps(self.to_dict()) + "\n")
+
+    def sendcmd(self, scale_target: str = "scale@camera", crop_target: str = "crop@camera") -> str:
+        """
+        ffmpeg sendcmd script that follows the path by scaling the zoom image by the zoom of each frame
+        with scale_target, then cropping the visible region with crop_target (see sendcmd_filterchain)
+        """
+        left, top, _, _ = self.visible_boxes()
+        width = np.round(self.size.width * self.zoom).astype(int)
+        height = np.round(self.size.height * self.zoom).astype(int)
+        x = np.clip(left * self.zoom, 0, width - self.encode_size.width)
+        y = np.clip(top * self.zoom, 0, height - self.encode_size.height)
+        return "".join(
+            f"{i / self.fps:.6f} {scale_target} w {w}, {scale_target} h {h}, "
+            f"{crop_target} x {x0:.3f}, {crop_target} y {y0:.3f};\n"
+            for i, (w, h, x0, y0) in enumerate(zip(width, height, x, y, strict=True))
+        )
+
+
+def camera_path(
+    image: KBImage, encode_size: Size, fps: int, layout: SegmentLayout | None = None
+) -> CameraPath:
+    """
+    Compute the camera of every frame of image in one vectorized pass
+    """
+    if layout is None:
+        layout = segment_layout(image, encode_size)
+    width, height = layout.zoom_image_size.width, layout.zoom_image_size.height
+    frames = np.arange(frame_count(image, fps), dtype=np.float64)
+    if layout.zoom is None:
+        zoom = np.ones_like(frames)
+    else:
+        progress = ease(image.transition_easing, np.clip(frames / fps / image.duration, 0, 1))
+        zoom = np.clip(1 + (layout.zoom - 1) * progress, 1, MAX_ZOOM)
+    return CameraPath(
+        fps,
+        layout.zoom_image_size,
+        encode_size,
+        zoom,
+        np.clip((width + width * layout.translate_x) / 2 - width / zoom / 2, 0, width - width / zoom),
+        np.clip((height + height * layout.translate_y) / 2 - height / zoom / 2, 0, height - height / zoom),
+    )
+
+
+def looped_input_arguments(image: KBImage, input_: str, fps: int, level: int = 0) -> list[str]:
+    """
+    ffmpeg input arguments repeating the image input_ for every frame of its segment,
+    JPEGs are decoded at 1/2**level scale (see encoder.input_arguments)
+    """
+    return [
+        "-loop",
+        "1",
+        "-framerate",
+        str(fps),
+        "-t",
+        str(frame_count(image, fps) / fps),
+        *input_arguments(input_, level),
+    ]
+
+
+def sendcmd_filterchain(
+    image: KBImage, input_pad: str, encode_size: Size, fps: int, script: pathlib.Path
+) -> FilterChain:
+    """
+    Build a filterchain that follows the camera path of image with scale and crop commands,
+    an alternative to zoompan driven by a precomputed path. The sendcmd script is written to script,
+    the input must repeat the image for every frame (see looped_input_arguments).
+    """
+    layout = segment_layout(image, encode_size)
+    path = camera_path(image, encode_size, fps, layout)
+    filterchain = FilterChain([], input_pads=[input_pad])
+    if layout.pad_size is not None and layout.scale_size is not None:
+        filterchain.filters.extend(
+            [
+                Filter("scale", {"w": str(layout.scale_size.width), "h": str(layout.scale_size.height)}),
+                Filter(
+                    "pad",
+                    {
+                        "w": str(layout.pad_size.width),
+                        "h": str(layout.pad_size.height),
+                        "x": "-1",
+                        "y": "-1",
+                    },
+                ),
+            ]
+        )
+    script.write_text(path.sendcmd())
+    # Commands are sent before each frame is filtered, the initial options are replaced immediately
+    filterchain.filters.extend(
+        [
+            Filter("sendcmd", {"f": str(script)}),
+            Filter("scale@camera", {"w": str(path.size.width), "h": str(path.size.height)}),
+            Filter("crop@camera", {"w": str(encode_size.width), "h": str(encode_size.height)}),
+            Filter("setsar", {"sar": "1"}),
+        ]
+    )
+    return filterchain
+
+
+def render_segment(
+    image: KBImage,
+    input_: str,
+    encode_size: Size,
+    fps: int,
+    outfile: pathlib.Path,
+    verbose: int = 0,
+    progress: ProgressCallback | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Render the pan/zoom segment of a single image into a lossless intermediate file,
+    following the precomputed camera path with sendcmd instead of zoompan.
+    Previews decode the image at reduced scale and use fast scaling.
+    """
+    script = outfile.with_suffix(".sendcmd")
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        loglevel(verbose),
+        *looped_input_arguments(image, input_, fps, lowres(image, encode_size) if preview else 0),
+        "-filter_complex",
+        str(
+            FilterGraph(
+                [sendcmd_filterchain(image, "0", encode_size, fps, script)],
+                sws_flags=PREVIEW_SWS_FLAGS if preview else None,
+            )
+        ),
+        *SEGMENT_CODEC_ARGUMENTS,
+        "-y",
+        str(outfile),
+    ]
+    try:
+        run_ffmpeg(command, progress, image.src, image.duration)
+    finally:
+        script.unlink(missing_ok=True)
+    if verbose > 0:
+        print(command, file=sys.stderr)
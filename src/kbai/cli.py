@@ -5,13 +5,27 @@ from __future__ import annotations
 import enum
 import logging
 import os
+import shlex
+import sys
 import typing as ta
 from argparse import SUPPRESS, Action, ArgumentError, ArgumentParser, ArgumentTypeError, Namespace
 from collections.abc import Sequence
 
 from .easings import Easing
-from .main import detect_main, encode_main
-from .structs import Fit, Size
+from .image import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+from .jobs import JobError, spec_argv
+from .main import (
+    batch_main,
+    detect_job,
+    detect_main,
+    encode_job,
+    encode_main,
+    render_job,
+    render_main,
+    serve_main,
+    warmup_main,
+)
+from .structs import AnnotatedBox, DetectorBackend, Fit, OutputFormat, Renderer, Size
 from .transitions import Transition
 
 if ta.TYPE_CHECKING:
@@ -22,11 +36,19 @@ if ta.TYPE_CHECKING:
 def enum_converter[ET: enum.Enum](ec: type[ET]) -> ta.Callable[[str], ET]:
     def converter(value: str) -> ET:
         name = value.upper().replace("-", "_")
-        return getattr(ec, name)
+        try:
+            return ec[name]
+        except KeyError:
+            raise ArgumentTypeError(f"invalid {ec.__name__.lower()}: {value}") from None
 
     return converter
 
 
+def parse_box(value: str) -> AnnotatedBox:
+    xmin, ymin, xmax, ymax, *annotation = value.split(",", 4)
+    return AnnotatedBox(float(xmin), float(ymin), float(xmax), float(ymax), "".join(annotation))
+
+
 class ImageAction(Action):
     image_parser = ArgumentParser(prog="", add_help=False, exit_on_error=False)
     # Empty metavar to hide from usage, the image metavar is in the main parser
@@ -61,6 +83,15 @@ class ImageAction(Action):
     image_parser.add_argument(
         "-ft", dest="feature_text", action="append", default=SUPPRESS
     )  # XXX how can user specify None?
+    image_parser.add_argument(
+        "-bx",
+        dest="boxes",
+        type=parse_box,
+        action="append",
+        default=SUPPRESS,
+        help="Precomputed feature box XMIN,YMIN,XMAX,YMAX[,LABEL] in image pixels, "
+        "features are not detected in images with boxes.",
+    )
 
     def __init__(self, option_strings, dest: str, nargs: int | str | None = None, **kwargs) -> None:
         # Override nargs
@@ -90,15 +121,211 @@ class ImageAction(Action):
         return cls.image_parser.format_usage().removeprefix("usage: ").replace("--", "/").replace("-", "/")
 
 
+class ImageListAction(ImageAction):
+    """
+    Read images from a file (- for stdin), one per line with the same syntax as --image,
+    e.g. photo.jpg /id 3 /ft "a dog". Blank lines and lines starting with # are ignored.
+    """
+
+    def __init__(self, option_strings, dest: str, nargs: int | str | None = None, **kwargs) -> None:
+        # Skip ImageAction overriding nargs
+        Action.__init__(self, option_strings, dest=dest, **kwargs)
+
+    def __call__(
+        self,
+        parser: ArgumentParser,
+        namespace: Namespace,
+        values: str | Sequence[ta.Any] | None,
+        option_string: str | None = None,
+    ) -> None:
+        if not isinstance(values, str):
+            raise ValueError("values not a filename")
+        try:
+            if values == "-":
+                lines = sys.stdin.readlines()
+            else:
+                with open(values) as f:
+                    lines = f.readlines()
+        except OSError as e:
+            raise ArgumentError(self, str(e)) from e
+        for lineno, line in enumerate(lines, 1):
+            if line.strip() and not line.lstrip().startswith("#"):
+                try:
+                    args = shlex.split(line)
+                except ValueError as e:
+                    raise ArgumentError(self, f"{values}:{lineno}: {e}") from e
+                super().__call__(parser, namespace, args, option_string)
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 def parse_size(value: str) -> Size:
     w, h = value.split("x")
     return Size(int(w), int(h))
 
 
+def add_timings_argument(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--timings",
+        metavar="FILE",
+        help="Write a JSON report of the wall time, CPU time and peak memory of each stage to FILE.",
+    )
+
+
+def add_detector_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--detect-batch-size",
+        type=int,
+        default=8,
+        help="Maximum number of images to detect features in per inference batch.",
+    )
+    parser.add_argument(
+        "--detect-batch-pixels",
+        type=int,
+        help="Maximum padded pixel count per inference batch (caps batch memory use).",
+    )
+    add_detector_model_arguments(parser)
+
+
+def add_detector_model_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--detect-backend",
+        type=enum_converter(DetectorBackend),
+        choices=list(DetectorBackend),
+        metavar="{" + ",".join(b.value for b in DetectorBackend) + "}",
+        default="torch",
+        help="Detection inference backend (torch=fp32 PyTorch, bf16=PyTorch bfloat16 autocast, "
+        "int8=PyTorch dynamic int8 quantization, onnx=ONNX Runtime, requires the onnx extra).",
+    )
+    parser.add_argument(
+        "--model-dir",
+        help="Load the detection model from this local model directory (see warmup) without network "
+        "access, defaults to the directory installed by warmup if present.",
+    )
+    parser.add_argument(
+        "-dc",
+        "--detection-cache",
+        help="Detection cache database path, detection results are reused from this cache.",
+    )
+    parser.add_argument(
+        "--detection-cache-max-bytes",
+        type=int,
+        help="Evict least recently used detection cache entries beyond this size.",
+    )
+    parser.add_argument(
+        "--detection-cache-max-age",
+        type=float,
+        help="Expire detection cache entries older than this many seconds.",
+    )
+
+
+def add_fetch_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--fetch-concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of images to fetch concurrently.",
+    )
+    parser.add_argument(
+        "--fetch-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Timeout in seconds for each image request.",
+    )
+
+
+def add_image_store_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "-is",
+        "--image-store",
+        help="Image store directory, fetched images are kept here and revalidated on reuse.",
+    )
+    parser.add_argument(
+        "--image-store-max-bytes",
+        type=int,
+        help="Evict least recently used images from the image store beyond this size.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only load remote images from the image store, never from the network.",
+    )
+
+
+def add_render_arguments(parser: ArgumentParser, output_required: bool = False) -> None:
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=output_required,
+        help="Output video filename (with extension), the playlist filename for hls, "
+        "or - to write fmp4 to stdout.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="output_format",
+        type=enum_converter(OutputFormat),
+        choices=list(OutputFormat),
+        metavar="{" + ",".join(f.value for f in OutputFormat) + "}",
+        default="mp4",
+        help="Output format (mp4=regular MP4, fmp4=fragmented MP4 playable while encoding, "
+        "hls=HLS playlist updated as each segment completes). "
+        "fmp4 fragments and hls segments start at image and transition boundaries.",
+    )
+    parser.add_argument(
+        "--renderer",
+        type=enum_converter(Renderer),
+        choices=list(Renderer),
+        metavar="{" + ",".join(r.value for r in Renderer) + "}",
+        default="zoompan",
+        help="Segment renderer (zoompan=ffmpeg zoompan filter, "
+        "native=smooth subpixel frames rendered in Python and streamed to ffmpeg, "
+        "sendcmd=ffmpeg scale and crop following the precomputed camera path).",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Render each image segment in its own ffmpeg process, running this many in parallel.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Print encoding progress (frame, fps, speed, time and ETA) to stderr.",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="Quickly render a low quality preview at a quarter of the size and at most 10 fps, "
+        "with the same timing and pan and zoom as the full render.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=positive_int,
+        help="Render long slideshows in chunks of this many images, one chunk at a time, "
+        "then concatenate them, so memory use does not grow with the number of images.",
+    )
+    parser.add_argument(
+        "--segment-cache",
+        help="Segment cache directory, rendered image segments are reused from this cache "
+        "so only changed images are rendered again.",
+    )
+    parser.add_argument(
+        "--segment-cache-max-bytes",
+        type=int,
+        help="Evict least recently used segments from the segment cache beyond this size.",
+    )
+
+
 def build_encode_parser(subparsers: _SubParsersAction) -> None:
     parser = subparsers.add_parser("encode", description="Encode images with pan/zoom into a video.")
 
-    parser.add_argument("-o", "--output", help="Output video filename (with extension).")
     parser.add_argument("-r", "--framerate", type=int, default=25, help="Output video framerate (FPS).")
     parser.add_argument(
         "-s",
@@ -150,15 +377,57 @@ def build_encode_parser(subparsers: _SubParsersAction) -> None:
         default=["a human face", "a person", "a dog", "a cat"],
         help="Default image feature detection text.",
     )
-    parser.add_argument(
+    images = parser.add_mutually_exclusive_group(required=True)
+    images.add_argument(
         "-i",
         "--image",
         action=ImageAction,
-        required=True,
         metavar=("IMAGE", "IMAGE_OPTIONS"),
         help=f"IMAGE_OPTIONS: {ImageAction.reformat_usage()}",
     )
-    parser.set_defaults(func=encode_main)
+    images.add_argument(
+        "--image-list",
+        dest="image",
+        action=ImageListAction,
+        metavar="FILE",
+        help="Read images from FILE (- for stdin) instead of the command line, "
+        "one per line as IMAGE IMAGE_OPTIONS.",
+    )
+    parser.add_argument(
+        "--no-detect",
+        action="store_true",
+        help="Only use precomputed image boxes, never detect features or load the detection model.",
+    )
+    parser.add_argument(
+        "--project",
+        help="Write the resolved slideshow (image sizes, boxes, durations and transitions) to this "
+        "JSON project file, see render. Only the project is written if there is no output.",
+    )
+    add_fetch_arguments(parser)
+    add_render_arguments(parser)
+    add_image_store_arguments(parser)
+    add_detector_arguments(parser)
+    add_timings_argument(parser)
+
+    def check_args(args: Namespace) -> None:
+        if args.output is None and args.project is None:
+            parser.error("one of the arguments -o/--output --project is required")
+
+    parser.set_defaults(func=encode_main, job=encode_job, check_args=check_args)
+
+
+def build_render_parser(subparsers: _SubParsersAction) -> None:
+    parser = subparsers.add_parser(
+        "render",
+        description="Encode a project file written by encode --project into a video, "
+        "without detecting features or loading the detection model.",
+    )
+    parser.add_argument("project", help="JSON project file.")
+    add_fetch_arguments(parser)
+    add_render_arguments(parser, output_required=True)
+    add_image_store_arguments(parser)
+    add_timings_argument(parser)
+    parser.set_defaults(func=render_main, job=render_job)
 
 
 def build_detect_parser(subparsers: _SubParsersAction) -> None:
@@ -167,7 +436,104 @@ def build_detect_parser(subparsers: _SubParsersAction) -> None:
     )
     parser.add_argument("image", help="Image url or path to detect features in.")
     parser.add_argument("feature", action="append", help="Feature description.")
-    parser.set_defaults(func=detect_main)
+    add_image_store_arguments(parser)
+    add_detector_arguments(parser)
+    add_timings_argument(parser)
+    parser.set_defaults(func=detect_main, job=detect_job)
+
+
+def build_serve_parser(subparsers: _SubParsersAction) -> None:
+    parser = subparsers.add_parser(
+        "serve",
+        description="Load the detection model once and run encode, detect and render jobs "
+        "submitted over HTTP. "
+        "POST a JSON job spec to /jobs, with the command and its long options, e.g. "
+        '{"command": "encode", "output": "out.mp4", "image": [["a.jpg", "/ft", "dog"]]}, '
+        "then GET /jobs/ID for the job status and result. "
+        "Jobs use the detection cache of the server.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--socket", help="Listen on this Unix socket path instead of host and port.")
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=16,
+        help="Maximum number of queued jobs, further jobs are refused.",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of jobs to run concurrently.")
+    parser.add_argument(
+        "--job-history", type=int, default=1000, help="Number of finished jobs to keep the status of."
+    )
+    add_detector_model_arguments(parser)
+    parser.set_defaults(func=serve_main, parse_job=parse_job)
+
+
+def build_batch_parser(subparsers: _SubParsersAction) -> None:
+    parser = subparsers.add_parser(
+        "batch",
+        description="Load the detection model once and run the encode, detect and render jobs "
+        "in a manifest. "
+        "Each line of the manifest is a JSON job spec (see serve), the command defaults to encode "
+        "and an optional id identifies the job. "
+        "Job statuses are appended to a status file, "
+        "rerunning the batch skips jobs that already succeeded.",
+    )
+    parser.add_argument("manifest", help="JSON lines file of job specs.")
+    parser.add_argument(
+        "--status",
+        help="JSON lines file to record job statuses in, defaults to MANIFEST.status.jsonl.",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of jobs to run concurrently.")
+    add_detector_model_arguments(parser)
+    parser.set_defaults(func=batch_main, parse_job=parse_job)
+
+
+def build_warmup_parser(subparsers: _SubParsersAction) -> None:
+    parser = subparsers.add_parser(
+        "warmup",
+        description="Install the detection model in a local model directory, verify its checksums "
+        "and load it once, e.g. when building a container image. "
+        "Other commands then load the model from this directory without network access.",
+    )
+    parser.add_argument("--revision", help="Hub revision (branch, tag or commit) of the model to install.")
+    add_detector_model_arguments(parser)
+    parser.set_defaults(func=warmup_main)
+
+
+class JobArgumentParser(ArgumentParser):
+    """
+    Parses job specs, raising JobError instead of exiting
+    """
+
+    def error(self, message: str) -> ta.NoReturn:
+        raise JobError(message)
+
+    def exit(self, status: int = 0, message: str | None = None) -> ta.NoReturn:
+        raise JobError(message or "invalid job")
+
+
+def parse_args(parser: ArgumentParser, args: Sequence[str] | None) -> Namespace:
+    """
+    Parse args, then run the checks across arguments of the command
+    """
+    namespace = parser.parse_args(args)
+    if (check_args := getattr(namespace, "check_args", None)) is not None:
+        check_args(namespace)
+    return namespace
+
+
+def parse_job(spec: ta.Any) -> tuple[str, Namespace]:
+    """
+    Parse a job spec (see serve) into the command name and its arguments
+    """
+    argv = spec_argv(spec)
+    parser = JobArgumentParser(prog="kbai")
+    subparsers = parser.add_subparsers(required=True)
+    build_encode_parser(subparsers)
+    build_detect_parser(subparsers)
+    build_render_parser(subparsers)
+    return argv[0], parse_args(parser, argv)
 
 
 def main(args=None) -> None:
@@ -179,6 +545,10 @@ def main(args=None) -> None:
     subparsers = parser.add_subparsers(title="commands", required=True)
     build_encode_parser(subparsers)
     build_detect_parser(subparsers)
-    args = parser.parse_args(args)
+    build_render_parser(subparsers)
+    build_serve_parser(subparsers)
+    build_batch_parser(subparsers)
+    build_warmup_parser(subparsers)
+    args = parse_args(parser, args)
     logging.basicConfig(level=max(logging.DEBUG, logging.ERROR - 10 * args.verbose))
     args.func(args)
@@ -2,18 +2,87 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 from __future__ import annotations
 
-from collections.abc import Sequence
+import logging
+import os
+import pathlib
+import tempfile
+import typing as ta
+from collections.abc import Iterable, Iterator, Sequence
+from dataclasses import dataclass
 
 import torch
+from PIL import Image
 from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
 
+from .cache import DetectionCache
 from .image import ImageSrc
-from .structs import AnnotatedBox
+from .models import DEFAULT_MODEL_ID, model_manifest
+from .structs import AnnotatedBox, DetectorBackend
+from .timings import Timings, record_span
+
+if ta.TYPE_CHECKING:
+    import onnxruntime
+
+logger = logging.getLogger(__name__)
+
+ONNX_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "kbai" / "onnx"
+
+
+@dataclass
+class DetectorOutputs:
+    """
+    The model outputs used by post processing
+    """
+
+    logits: torch.Tensor
+    pred_boxes: torch.Tensor
+
+
+class ExportModel(torch.nn.Module):
+    """
+    Wraps the model with positional inputs and tuple outputs for ONNX export
+    """
+
+    def __init__(self, model: torch.nn.Module, input_names: Sequence[str]) -> None:
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        outputs = self.model(**dict(zip(self.input_names, inputs, strict=True)))
+        return outputs.logits, outputs.pred_boxes
+
+
+def bf16_supported(device: torch.device) -> bool:
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # Without native bf16 instructions (e.g. AVX512-BF16, AMX) autocast is slower than fp32
+    if not torch.backends.mkldnn.is_available():
+        return False
+    # There is no public check, the private op may be missing or fail in other torch versions
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
 
 
 class Detector:
-    def __init__(self) -> None:
-        model_id = "IDEA-Research/grounding-dino-tiny"
+    model_id = DEFAULT_MODEL_ID
+    # Pinned hub commit of a local model directory
+    revision: str | None = None
+    box_threshold = 0.5
+    text_threshold = 0.3
+
+    def __init__(
+        self,
+        cache: DetectionCache | None = None,
+        backend: DetectorBackend = DetectorBackend.TORCH,
+        model_dir: pathlib.Path | str | None = None,
+    ) -> None:
+        """
+        Load the model from the hub, or from a local model directory (see models.install_model)
+        without any network access.
+        """
         if torch.backends.mps.is_available():
             # device = "mps"
             # mps is slower https://github.com/pytorch/pytorch/issues/77799
@@ -22,32 +91,274 @@ class Detector:
             device = "cuda"
         else:
             device = "cpu"
+        if backend in (DetectorBackend.INT8, DetectorBackend.ONNX):
+            # These backends run on CPU
+            device = "cpu"
+        if backend == DetectorBackend.BF16 and not bf16_supported(torch.device(device)):
+            logger.warning("bf16 not supported on %s, using the torch backend", device)
+            backend = DetectorBackend.TORCH
         self.device = torch.device(device)
+        self.backend = backend
+        self.cache = cache
 
-        self.processor = AutoProcessor.from_pretrained(model_id)
-        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(self.device)
+        source: str | pathlib.Path = self.model_id
+        options: dict[str, ta.Any] = {}
+        model_options: dict[str, ta.Any] = {}
+        if model_dir is not None:
+            manifest = model_manifest(model_dir)
+            self.model_id = manifest["model_id"]
+            self.revision = manifest.get("revision")
+            source = model_dir
+            options = {"local_files_only": True}
+            # safetensors weights are memory mapped, processes on a host share the page cache
+            model_options = {"use_safetensors": True}
+        self.processor = AutoProcessor.from_pretrained(source, **options)
+        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(
+            source, **options, **model_options
+        ).to(self.device)
+        if backend == DetectorBackend.INT8:
+            # Dynamic quantization of the linear layers, which dominate the transformer compute
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.session = self._onnx_session() if backend == DetectorBackend.ONNX else None
 
-    def detect(self, image: ImageSrc, features: Sequence[str]) -> list[AnnotatedBox]:
-        if not features:
-            return []
+    @property
+    def model_revision_id(self) -> str:
+        # Installed revisions of a model may detect differently
+        if self.revision is None:
+            return self.model_id
+        return f"{self.model_id}@{self.revision}"
 
+    @property
+    def cache_model_id(self) -> str:
+        # Backends produce slightly different results, so are cached separately
+        if self.backend == DetectorBackend.TORCH:
+            return self.model_revision_id
+        return f"{self.model_revision_id}@{self.backend.value}"
+
+    @property
+    def onnx_path(self) -> pathlib.Path:
+        return ONNX_DIR / f"{self.model_revision_id.replace('/', '--')}.onnx"
+
+    def _onnx_session(self) -> onnxruntime.InferenceSession:
+        """
+        Load the ONNX model, exporting it on first use
+        """
+        import onnxruntime
+
+        path = self.onnx_path
+        if not path.exists():
+            self._export_onnx(path)
+        return onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+
+    def _export_onnx(self, path: pathlib.Path) -> None:
+        inputs = self.processor(images=[Image.new("RGB", (800, 800))], text=["a cat."], return_tensors="pt")
+        input_names = list(inputs.keys())
+        sequence_axes = {0: "batch", 1: "sequence"}
+        input_axes = {
+            "input_ids": sequence_axes,
+            "token_type_ids": sequence_axes,
+            "attention_mask": sequence_axes,
+            "pixel_values": {0: "batch", 2: "height", 3: "width"},
+            "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+        }
+        # logits are padded to the maximum text length, so only the batch size varies
+        dynamic_axes = {name: input_axes[name] for name in input_names} | {
+            "logits": {0: "batch"},
+            "pred_boxes": {0: "batch"},
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        logger.warning("Exporting %s to %s", self.model_id, path)
+        # Export atomically, other processes may be loading the model
+        fd, temp = tempfile.mkstemp(dir=path.parent, suffix=".onnx")
+        os.close(fd)
+        try:
+            torch.onnx.export(
+                ExportModel(self.model, input_names),
+                tuple(inputs[name] for name in input_names),
+                temp,
+                input_names=input_names,
+                output_names=["logits", "pred_boxes"],
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+            )
+            os.replace(temp, path)
+        finally:
+            pathlib.Path(temp).unlink(missing_ok=True)
+
+    def _forward(self, inputs: ta.Mapping[str, torch.Tensor]) -> DetectorOutputs:
+        if self.session is not None:
+            names = [i.name for i in self.session.get_inputs()]
+            logits, pred_boxes = self.session.run(
+                ["logits", "pred_boxes"], {name: inputs[name].numpy() for name in names}
+            )
+            return DetectorOutputs(torch.from_numpy(logits), torch.from_numpy(pred_boxes))
+        with (
+            torch.no_grad(),
+            torch.autocast(
+                self.device.type, dtype=torch.bfloat16, enabled=self.backend == DetectorBackend.BF16
+            ),
+        ):
+            outputs = self.model(**inputs)
+        return DetectorOutputs(outputs.logits.float(), outputs.pred_boxes.float())
+
+    def _prompt(self, features: Sequence[str]) -> str:
         # End each lowercase feature with a dot
-        text = " ".join(
+        return " ".join(
             feature.lower() if feature.endswith(".") else f"{feature.lower()}." for feature in features
         )
 
-        inputs = self.processor(images=image.image, text=text, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+    def _processed_size(self, image: ImageSrc) -> tuple[int, int]:
+        """
+        Approximate (width, height) of the image after the processor resizes it
+        """
+        size = self.processor.image_processor.size
+        width, height = image.image.size
+        scale = min(size["shortest_edge"] / min(width, height), size["longest_edge"] / max(width, height))
+        return round(width * scale), round(height * scale)
+
+    def _batches(
+        self,
+        pending: Sequence[int],
+        images: Sequence[ImageSrc],
+        batch_size: int,
+        max_batch_pixels: int | None,
+    ) -> Iterator[list[int]]:
+        """
+        Group image indexes into batches of at most batch_size images,
+        whose padded pixel count does not exceed max_batch_pixels.
+        """
+        batch: list[int] = []
+        max_width = max_height = 0
+        for index in pending:
+            width, height = self._processed_size(images[index])
+            width, height = max(width, max_width), max(height, max_height)
+            if batch and (
+                len(batch) >= batch_size
+                or (max_batch_pixels is not None and (len(batch) + 1) * width * height > max_batch_pixels)
+            ):
+                yield batch
+                batch = []
+                width, height = self._processed_size(images[index])
+            batch.append(index)
+            max_width, max_height = width, height
+        if batch:
+            yield batch
 
-        results = self.processor.post_process_grounded_object_detection(
-            outputs,
-            inputs.input_ids,
-            box_threshold=0.5,
-            text_threshold=0.3,
-            target_sizes=[image.image.size[::-1]],
+    def detect_stream(
+        self,
+        images: Iterable[tuple[ImageSrc, Sequence[str]]],
+        batch_size: int = 8,
+        max_batch_pixels: int | None = None,
+        timings: Timings | None = None,
+    ) -> Iterator[tuple[ImageSrc, list[AnnotatedBox]]]:
+        """
+        Detect features in (image, features) pairs as they arrive, yielding each image and its boxes
+        in order. Images are detected as soon as batch_size of them need detection,
+        so loading later images can overlap detecting earlier ones.
+        """
+        # Boxes of each image and prompt already detected, repeats in later batches are not detected again
+        detected: dict[tuple[str, str], list[AnnotatedBox]] = {}
+        pending: list[tuple[ImageSrc, Sequence[str], tuple[str, str] | None]] = []
+        needs_detection = 0
+        for image, features in images:
+            content = (image.digest, self._prompt(features)) if features else None
+            pending.append((image, features, content))
+            needs_detection += content is not None and content not in detected
+            if needs_detection >= batch_size:
+                yield from self._detect_pending(pending, detected, batch_size, max_batch_pixels, timings)
+                pending = []
+                needs_detection = 0
+        yield from self._detect_pending(pending, detected, batch_size, max_batch_pixels, timings)
+
+    def _detect_pending(
+        self,
+        pending: Sequence[tuple[ImageSrc, Sequence[str], tuple[str, str] | None]],
+        detected: dict[tuple[str, str], list[AnnotatedBox]],
+        batch_size: int,
+        max_batch_pixels: int | None,
+        timings: Timings | None,
+    ) -> Iterator[tuple[ImageSrc, list[AnnotatedBox]]]:
+        if not pending:
+            return
+        results = self.detect_many(
+            [image for image, _, _ in pending],
+            [[] if content in detected else features for _, features, content in pending],
+            batch_size=batch_size,
+            max_batch_pixels=max_batch_pixels,
+            timings=timings,
         )
-        return [
-            AnnotatedBox(*box.tolist(), label)
-            for box, label in zip(results[0]["boxes"], results[0]["labels"], strict=True)
-        ]
+        for (image, _, content), boxes in zip(pending, results, strict=True):
+            if content is not None:
+                boxes = detected.setdefault(content, boxes)
+            yield image, boxes
+
+    def detect(self, image: ImageSrc, features: Sequence[str]) -> list[AnnotatedBox]:
+        return self.detect_many([image], [features])[0]
+
+    def detect_many(
+        self,
+        images: Sequence[ImageSrc],
+        features: Sequence[Sequence[str]],
+        batch_size: int = 8,
+        max_batch_pixels: int | None = None,
+        timings: Timings | None = None,
+    ) -> list[list[AnnotatedBox]]:
+        """
+        Detect features in each image, batching images into as few forward passes as possible.
+        features[i] are the features to detect in images[i].
+        """
+        results: list[list[AnnotatedBox]] = [[] for _ in images]
+        texts: dict[int, str] = {}
+        keys: dict[int, str] = {}
+        # Index of the first occurrence of each identical image and prompt, and of each repeat
+        first: dict[tuple[str, str], int] = {}
+        repeats: dict[int, int] = {}
+        for index, (image, image_features) in enumerate(zip(images, features, strict=True)):
+            if not image_features:
+                continue
+            text = self._prompt(image_features)
+            content = (image.digest, text)
+            if content in first:
+                repeats[index] = first[content]
+                continue
+            first[content] = index
+            if self.cache is not None:
+                keys[index] = self.cache.key(
+                    image.digest, text, self.cache_model_id, self.box_threshold, self.text_threshold
+                )
+                boxes = self.cache.get(keys[index])
+                if boxes is not None:
+                    results[index] = boxes
+                    continue
+            texts[index] = text
+
+        for batch in self._batches(list(texts), images, batch_size, max_batch_pixels):
+            with record_span(timings, "detect", images=[images[index].src for index in batch]):
+                batch_images = [images[index].image for index in batch]
+                inputs = self.processor(
+                    images=batch_images,
+                    text=[texts[index] for index in batch],
+                    padding=True,
+                    return_tensors="pt",
+                ).to(self.device)
+                outputs = self._forward(inputs)
+                batch_results = self.processor.post_process_grounded_object_detection(
+                    outputs,
+                    inputs.input_ids,
+                    box_threshold=self.box_threshold,
+                    text_threshold=self.text_threshold,
+                    # Boxes in source image coordinates, images may have been decoded at a reduced scale
+                    target_sizes=[(images[index].size.height, images[index].size.width) for index in batch],
+                )
+            for index, result in zip(batch, batch_results, strict=True):
+                results[index] = [
+                    AnnotatedBox(*box.tolist(), label)
+                    for box, label in zip(result["boxes"], result["labels"], strict=True)
+                ]
+                if self.cache is not None:
+                    self.cache.put(keys[index], results[index])
+        for index, first_index in repeats.items():
+            results[index] = list(results[first_index])
+        return results
@@ -1,5 +1,8 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 import enum
+import typing as ta
+
+import numpy as np
 
 # Easings from https://github.com/scriptituk/xfade-easing/blob/main/expr/generic-easings-script.txt
 
@@ -122,3 +125,85 @@ class Easing(enum.Enum):
     CUBEROOT_IN = "st(0, 1 - pow((1-ld(0)), 1/3))"
     CUBEROOT_OUT = "st(0, pow(ld(0), 1/3))"
     CUBEROOT_IN_OUT = "st(0, if(lt(ld(0), 0.5), pow(ld(0) / 4, 1/3), 1 - pow((1-ld(0)) / 4, 1/3)))"
+
+
+def _bounce(t: np.ndarray) -> np.ndarray:
+    k = 121 / 16
+    return np.select(
+        [t < 4 / 11, t < 8 / 11, t < 10 / 11],
+        [k * t * t, k * (t - 6 / 11) ** 2 + 3 / 4, k * (t - 9 / 11) ** 2 + 15 / 16],
+        k * (t - 21 / 22) ** 2 + 63 / 64,
+    )
+
+
+def _elastic_in_out(t: np.ndarray) -> np.ndarray:
+    u = 2 * t - 1
+    c = np.cos(40 * u * np.pi / 9) / 2
+    p = 2.0 ** (10 * u)
+    return np.where(t < 0.5, c * p, 1 - c / p)
+
+
+def _bounce_in_out(t: np.ndarray) -> np.ndarray:
+    sign = np.where(t < 0.5, 1, -1)
+    return (1 - sign * _bounce(sign * (1 - 2 * t))) / 2
+
+
+# NumPy implementations of the Easing expressions, for computing camera paths in Python
+EASING_FUNCTIONS: dict[Easing, ta.Callable[[np.ndarray], np.ndarray]] = {
+    Easing.LINEAR: lambda t: t,
+    Easing.QUADRATIC_IN: lambda t: t * t,
+    Easing.QUADRATIC_OUT: lambda t: t * (2 - t),
+    Easing.QUADRATIC_IN_OUT: lambda t: np.where(t < 0.5, 2 * t * t, 2 * t * (2 - t) - 1),
+    Easing.CUBIC_IN: lambda t: t**3,
+    Easing.CUBIC_OUT: lambda t: 1 - (1 - t) ** 3,
+    Easing.CUBIC_IN_OUT: lambda t: np.where(t < 0.5, 4 * t**3, 1 - 4 * (1 - t) ** 3),
+    Easing.QUARTIC_IN: lambda t: t**4,
+    Easing.QUARTIC_OUT: lambda t: 1 - (1 - t) ** 4,
+    Easing.QUARTIC_IN_OUT: lambda t: np.where(t < 0.5, 8 * t**4, 1 - 8 * (1 - t) ** 4),
+    Easing.QUINTIC_IN: lambda t: t**5,
+    Easing.QUINTIC_OUT: lambda t: 1 - (1 - t) ** 5,
+    Easing.QUINTIC_IN_OUT: lambda t: np.where(t < 0.5, 16 * t**5, 1 - 16 * (1 - t) ** 5),
+    Easing.SINUSOIDAL_IN: lambda t: 1 - np.cos(t * np.pi / 2),
+    Easing.SINUSOIDAL_OUT: lambda t: np.sin(t * np.pi / 2),
+    Easing.SINUSOIDAL_IN_OUT: lambda t: (1 - np.cos(t * np.pi)) / 2,
+    Easing.EXPONENTIAL_IN: lambda t: np.where(t <= 0, 0, 2.0 ** (10 * t - 10)),
+    Easing.EXPONENTIAL_OUT: lambda t: np.where(t >= 1, 1, 1 - 2.0 ** (-10 * t)),
+    Easing.EXPONENTIAL_IN_OUT: lambda t: np.where(
+        t < 0.5,
+        np.where(t <= 0, 0, 2.0 ** (20 * t - 11)),
+        np.where(t >= 1, 1, 1 - 2.0 ** (9 - 20 * t)),
+    ),
+    Easing.CIRCULAR_IN: lambda t: 1 - np.sqrt(1 - t * t),
+    Easing.CIRCULAR_OUT: lambda t: np.sqrt(t * (2 - t)),
+    Easing.CIRCULAR_IN_OUT: lambda t: (
+        np.where(t < 0.5, 1 - np.sqrt(1 - 4 * t * t), 1 + np.sqrt(4 * t * (2 - t) - 3)) / 2
+    ),
+    Easing.ELASTIC_IN: lambda t: np.cos(20 * (1 - t) * np.pi / 3) / 2.0 ** (10 * (1 - t)),
+    Easing.ELASTIC_OUT: lambda t: 1 - np.cos(20 * t * np.pi / 3) / 2.0 ** (10 * t),
+    Easing.ELASTIC_IN_OUT: _elastic_in_out,
+    Easing.BACK_IN: lambda t: t * t * (t * 2.70158 - 1.70158),
+    Easing.BACK_OUT: lambda t: 1 - (1 - t) ** 2 * (1 - t * 2.70158),
+    Easing.BACK_IN_OUT: lambda t: np.where(
+        t < 0.5,
+        2 * t * t * (2 * t * 3.59491 - 2.59491),
+        1 - 2 * (1 - t) ** 2 * (4.59491 - 2 * t * 3.59491),
+    ),
+    Easing.BOUNCE_IN: lambda t: 1 - _bounce(1 - t),
+    Easing.BOUNCE_OUT: _bounce,
+    Easing.BOUNCE_IN_OUT: _bounce_in_out,
+    Easing.SQUAREROOT_IN: lambda t: np.sqrt(t),
+    Easing.SQUAREROOT_OUT: lambda t: 1 - np.sqrt(1 - t),
+    Easing.SQUAREROOT_IN_OUT: lambda t: np.where(t < 0.5, np.sqrt(t / 2), 1 - np.sqrt((1 - t) / 2)),
+    Easing.CUBEROOT_IN: lambda t: 1 - np.cbrt(1 - t),
+    Easing.CUBEROOT_OUT: lambda t: np.cbrt(t),
+    Easing.CUBEROOT_IN_OUT: lambda t: np.where(t < 0.5, np.cbrt(t / 4), 1 - np.cbrt((1 - t) / 4)),
+}
+
+
+def ease(easing: Easing, t: np.ndarray) -> np.ndarray:
+    """
+    Evaluate easing for normalized times t (0..1)
+    """
+    # Both branches of np.where are evaluated, ignore warnings from the branch not taken
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.asarray(EASING_FUNCTIONS[easing](np.asarray(t, dtype=np.float64)), dtype=np.float64)
@@ -1,12 +1,41 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
-import itertools
+import dataclasses
+import hashlib
+import json
+import os
 import pathlib
 import re
 import subprocess
+import sys
+import tempfile
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 
-from .structs import Fit, KBImage, Size
+import httpx
+
+from .cache import SegmentCache
+from .image import fetch, is_url
+from .progress import ProgressCallback, parse_progress
+from .structs import Box, Fit, KBImage, OutputFormat, Renderer, Size
+from .timings import Timings, record_span
+
+# Segments are rendered to lossless H.264, which is fast to encode and decode,
+# in the pixel format of the final output
+SEGMENT_CODEC_ARGUMENTS = ["-c:v", "libx264", "-preset", "ultrafast", "-qp", "0", "-pix_fmt", "yuv420p"]
+SEGMENT_SUFFIX = ".mkv"
+# Longer filtergraphs are passed to ffmpeg in a script file, Linux limits each argument to 128KiB
+MAX_FILTERGRAPH_ARGUMENT = 64 * 1024
+# Previews are rendered at a quarter of the output width and height, and at most PREVIEW_FPS
+PREVIEW_SCALE = 4
+PREVIEW_FPS = 10
+# Fast, lower quality scaling and encoding for previews
+PREVIEW_SWS_FLAGS = "fast_bilinear"
+PREVIEW_CODEC_ARGUMENTS = ["-preset", "ultrafast"]
+# ffmpeg decodes JPEGs at up to 1/8 scale
+MAX_LOWRES = 3
 
 
 @dataclass
@@ -47,126 +76,280 @@ class FilterChain:
 @dataclass
 class FilterGraph:
     filterchains: list[FilterChain] = field(default_factory=list)
+    # Flags of the scalers in the graph, None for the ffmpeg default
+    sws_flags: str | None = None
 
     def __str__(self) -> str:
-        return ";".join(str(filterchain) for filterchain in self.filterchains)
+        graph = ";".join(str(filterchain) for filterchain in self.filterchains)
+        if self.sws_flags is None:
+            return graph
+        return f"sws_flags={self.sws_flags};{graph}"
 
 
-def encode(
-    encode_size: Size,
-    fps: int,
-    kbimages: list[KBImage],
-    outfile: pathlib.Path | str,
-    verbose: int = 0,
+def image_input(image: KBImage, index: int, directory: pathlib.Path) -> str:
+    """
+    Return the ffmpeg input for image.
+    Fetched image bytes are written into directory so ffmpeg does not fetch src again.
+    """
+    if image.data is None:
+        return image.src
+    suffix = pathlib.PurePosixPath(httpx.URL(image.src).path).suffix
+    path = directory / f"{index}{suffix}"
+    path.write_bytes(image.data)
+    return str(path)
+
+
+@contextmanager
+def filter_complex_arguments(filtergraph: FilterGraph) -> Iterator[list[str]]:
+    """
+    ffmpeg arguments for filtergraph, in a script file if it is too long for the command line
+    """
+    graph = str(filtergraph)
+    if len(graph) <= MAX_FILTERGRAPH_ARGUMENT:
+        yield ["-filter_complex", graph]
+        return
+    with tempfile.NamedTemporaryFile("w", prefix="kbai-", suffix=".txt") as script:
+        script.write(graph)
+        script.flush()
+        # Deprecated in ffmpeg 7 for -/filter_complex, which older versions don't support
+        yield ["-filter_complex_script", script.name]
+
+
+def loglevel(verbose: int) -> str:
+    return {
+        0: "error",
+        1: "warning",
+        2: "info",
+        3: "verbose",
+        4: "debug",
+        5: "trace",
+    }.get(verbose, "trace")
+
+
+def output_duration(kbimages: list[KBImage]) -> float:
+    """
+    Duration in seconds of the encoded video, each transition overlaps two images
+    """
+    return sum(image.duration for image in kbimages) - sum(
+        image.transition_duration for image in kbimages[:-1]
+    )
+
+
+def run_ffmpeg(
+    command: list[str],
+    progress: ProgressCallback | None = None,
+    label: str = "encode",
+    total_time: float | None = None,
 ) -> None:
-    command = [
-        "ffmpeg",
-        "-loglevel",
-        {
-            0: "error",
-            1: "warning",
-            2: "info",
-            3: "verbose",
-            4: "debug",
-            5: "trace",
-        }.get(verbose, "trace"),
-    ]
-    inputs = [("-i", image.src) for image in kbimages]
-    command.extend(itertools.chain.from_iterable(inputs))
+    """
+    Run ffmpeg, reporting progress to the progress callback if set.
+    If the callback raises an exception ffmpeg is killed and the exception propagated.
+    """
+    if progress is None:
+        subprocess.check_call(command)  # noqa: S603
+        return
+    # Progress is written to its own pipe, stdout may be the encoded output
+    read_fd, write_fd = os.pipe()
+    command = [command[0], "-progress", f"pipe:{write_fd}", "-nostats", *command[1:]]
+    try:
+        process = subprocess.Popen(command, pass_fds=(write_fd,))  # noqa: S603
+    finally:
+        os.close(write_fd)
+    with process, open(read_fd) as progress_pipe:
+        try:
+            for event in parse_progress(progress_pipe, label, total_time):
+                progress(event)
+        except BaseException:
+            process.kill()
+            raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
-    filtergraph = FilterGraph()
-    prev_filterchain: FilterChain | None = None
-    prev_image: KBImage | None = None
-    xfade_offset: float = 0
-    for i, image in enumerate(kbimages):
-        zoom_duration = image.duration * fps
-        # Compute a zoompan size that is fit to the output size
-        match image.fit:
-            case Fit.COVER:
-                image_fit_scale = max(
-                    encode_size.width / image.size.width, encode_size.height / image.size.height
-                )
-            case Fit.CONTAIN:
-                image_fit_scale = min(
-                    encode_size.width / image.size.width, encode_size.height / image.size.height
-                )
-        zoom_image_size = image.size * image_fit_scale
-        if image.boxes:
-            filterchain = FilterChain([], input_pads=[str(i)])
-
-            # Just use first box for now
-            # XXX look for highest threshold that matches requested feature?
-            scaled_box = image.boxes[0].scaled(image_fit_scale)
-            if zoom_image_size != encode_size and image.fit is Fit.CONTAIN:
-                scaled_box = scaled_box.translated(
-                    (encode_size.width - zoom_image_size.width) / 2,
-                    (encode_size.height - zoom_image_size.height) / 2,
-                )
-                filterchain.filters.extend(
-                    [
-                        Filter(
-                            "scale",
-                            {
-                                "w": str(zoom_image_size.width),
-                                "h": str(zoom_image_size.height),
-                            },
-                        ),
-                        Filter(
-                            "pad",
-                            {
-                                "w": str(encode_size.width),
-                                "h": str(encode_size.height),
-                                # Centered
-                                "x": "-1",
-                                "y": "-1",
-                            },
-                        ),
-                    ]
-                )
-                zoom_image_size = encode_size
-
-            # Normalized translation, -1..0..1
-            translate_x = (2 * scaled_box.center[0] / zoom_image_size.width) - 1
-            translate_y = (2 * scaled_box.center[1] / zoom_image_size.height) - 1
-            # Scale so box is object-fit=contain of the encoded image
-            zoom = min(
-                encode_size.width / scaled_box.size.width,
-                encode_size.height / scaled_box.size.height,
-                10,  # Max allowed ffmpeg zoom is 10
+
+@dataclass
+class SegmentLayout:
+    """
+    Geometry of an image segment, shared by zoompan and the native renderer
+    """
+
+    # Scale that fits the source image to the encoded size
+    fit_scale: float
+    # Size to scale the source image to before zooming, None to use it as is
+    scale_size: Size | None
+    # Size to center and pad the scaled image in, None for no padding
+    pad_size: Size | None
+    # Size of the zoomed image, it is cropped to the encoded size
+    zoom_image_size: Size
+    # Normalized translation of the zoom target, -1..0..1
+    translate_x: float
+    translate_y: float
+    # Zoom at the end of the segment, None if there is no zoom target
+    zoom: float | None
+
+
+def segment_layout(image: KBImage, encode_size: Size) -> SegmentLayout:
+    # Compute a zoompan size that is fit to the output size
+    match image.fit:
+        case Fit.COVER:
+            image_fit_scale = max(
+                encode_size.width / image.size.width, encode_size.height / image.size.height
+            )
+        case Fit.CONTAIN:
+            image_fit_scale = min(
+                encode_size.width / image.size.width, encode_size.height / image.size.height
+            )
+    zoom_image_size = image.size * image_fit_scale
+    if image.boxes:
+        # Just use first box for now
+        # XXX look for highest threshold that matches requested feature?
+        box = image.boxes[0].scaled(image_fit_scale)
+        # Scale so box is object-fit=contain of the encoded image
+        zoom = min(
+            encode_size.width / box.size.width,
+            encode_size.height / box.size.height,
+            10,  # Max allowed ffmpeg zoom is 10
+        )
+        scaled_box: Box | None = box
+    else:
+        scaled_box = None
+        zoom = 1
+
+    scale_size: Size | None = None
+    pad_size: Size | None = None
+    if zoom_image_size != encode_size and image.fit is Fit.CONTAIN:
+        if scaled_box is not None:
+            scaled_box = scaled_box.translated(
+                (encode_size.width - zoom_image_size.width) / 2,
+                (encode_size.height - zoom_image_size.height) / 2,
             )
-            z_filter = Filter(
-                "zoompan",
+        scale_size = zoom_image_size
+        pad_size = encode_size
+        zoom_image_size = encode_size
+    else:
+        # zoompan never samples more source pixels than its output size at max zoom,
+        # so downscale large sources once instead of zooming full size frames
+        source_size = image.size * min(image_fit_scale * zoom, 1)
+        if source_size != image.size:
+            scale_size = source_size
+
+    if scaled_box is None:
+        return SegmentLayout(image_fit_scale, scale_size, pad_size, zoom_image_size, 0, 0, None)
+    return SegmentLayout(
+        image_fit_scale,
+        scale_size,
+        pad_size,
+        zoom_image_size,
+        # Normalized translation, -1..0..1
+        (2 * scaled_box.center[0] / zoom_image_size.width) - 1,
+        (2 * scaled_box.center[1] / zoom_image_size.height) - 1,
+        zoom,
+    )
+
+
+def preview_settings(encode_size: Size, fps: int) -> tuple[Size, int]:
+    """
+    Encoded size and fps of a preview, the size is kept even for yuv420p
+    """
+    return (
+        Size(
+            max(2 * round(encode_size.width / PREVIEW_SCALE / 2), 2),
+            max(2 * round(encode_size.height / PREVIEW_SCALE / 2), 2),
+        ),
+        min(fps, PREVIEW_FPS),
+    )
+
+
+def lowres(image: KBImage, encode_size: Size) -> int:
+    """
+    Largest ffmpeg lowres (decode at 1/2**lowres scale) that still decodes image
+    at least as large as its segment needs
+    """
+    layout = segment_layout(image, encode_size)
+    needed = layout.scale_size or image.size
+    level = 0
+    while (
+        level < MAX_LOWRES
+        and image.size.width >> (level + 1) >= needed.width
+        and image.size.height >> (level + 1) >= needed.height
+    ):
+        level += 1
+    return level
+
+
+def input_arguments(input_: str, level: int = 0) -> list[str]:
+    """
+    ffmpeg arguments for input_, JPEGs are decoded at 1/2**level scale
+    (other decoders ignore lowres)
+    """
+    if level == 0:
+        return ["-i", input_]
+    return ["-lowres", str(level), "-i", input_]
+
+
+def segment_filterchain(image: KBImage, input_pad: str, encode_size: Size, fps: int) -> FilterChain:
+    """
+    Build the filterchain that pans and zooms image into a segment of encode_size video
+    """
+    layout = segment_layout(image, encode_size)
+    filterchain = FilterChain([], input_pads=[input_pad])
+    if layout.scale_size is not None:
+        filterchain.filters.append(
+            Filter("scale", {"w": str(layout.scale_size.width), "h": str(layout.scale_size.height)})
+        )
+    if layout.pad_size is not None:
+        filterchain.filters.append(
+            Filter(
+                "pad",
                 {
-                    "z": f"st(0, clip(time / {image.duration}, 0, 1));"
-                    f"{image.transition_easing.value};"
-                    f"lerp(1, {zoom}, ld(0))"
+                    "w": str(layout.pad_size.width),
+                    "h": str(layout.pad_size.height),
+                    # Centered
+                    "x": "-1",
+                    "y": "-1",
                 },
             )
-        else:
-            translate_x = 0
-            translate_y = 0
-            z_filter = Filter("zoompan", {"z": "1"})
+        )
 
-        z_filter.options.update(
+    if layout.zoom is not None:
+        z_filter = Filter(
+            "zoompan",
             {
-                "x": f"(iw+iw*{translate_x})/2-(iw/zoom/2)",
-                "y": f"(ih+ih*{translate_y})/2-(ih/zoom/2)",
-                "s": f"{zoom_image_size}:fps={fps}:d={zoom_duration}",
-            }
+                "z": f"st(0, clip(time / {image.duration}, 0, 1));"
+                f"{image.transition_easing.value};"
+                f"lerp(1, {layout.zoom}, ld(0))"
+            },
         )
-        filterchain.filters.append(z_filter)
-        if zoom_image_size != encode_size and image.fit is Fit.COVER:
-            filterchain.filters.append(
-                Filter("crop", {"w": str(encode_size.width), "h": str(encode_size.height)})
-            )
-        filterchain.filters.append(Filter("setsar", {"sar": "1"}))
-        if len(kbimages) > 1:
-            filterchain.output_pads = [f"pz{i}"]
-        filtergraph.filterchains.append(filterchain)
-
-        if prev_filterchain is not None and prev_image is not None:
-            xfade_offset += prev_image.duration - prev_image.transition_duration
-            xfade = FilterChain(
+    else:
+        z_filter = Filter("zoompan", {"z": "1"})
+    z_filter.options.update(
+        {
+            "x": f"(iw+iw*{layout.translate_x})/2-(iw/zoom/2)",
+            "y": f"(ih+ih*{layout.translate_y})/2-(ih/zoom/2)",
+            "s": f"{layout.zoom_image_size}:fps={fps}:d={image.duration * fps}",
+        }
+    )
+    filterchain.filters.append(z_filter)
+    if layout.zoom_image_size != encode_size and image.fit is Fit.COVER:
+        filterchain.filters.append(
+            Filter("crop", {"w": str(encode_size.width), "h": str(encode_size.height)})
+        )
+    filterchain.filters.append(Filter("setsar", {"sar": "1"}))
+    return filterchain
+
+
+def xfade_filterchains(kbimages: list[KBImage], input_pads: list[str]) -> list[FilterChain]:
+    """
+    Build the filterchains that transition between the segments of kbimages on input_pads
+    """
+    filterchains: list[FilterChain] = []
+    prev_pad = input_pads[0]
+    xfade_offset: float = 0
+    for i in range(1, len(kbimages)):
+        prev_image = kbimages[i - 1]
+        xfade_offset += prev_image.duration - prev_image.transition_duration
+        output_pads = [f"xf{i}"] if i < len(kbimages) - 1 else None
+        filterchains.append(
+            FilterChain(
                 [
                     Filter(
                         "xfade",
@@ -177,23 +360,518 @@ def encode(
                         },
                     )
                 ],
-                input_pads=[
-                    prev_filterchain.output_pads[0],
-                    filterchain.output_pads[0],
-                ],
-                output_pads=[f"xf{i}"] if i < len(kbimages) - 1 else None,
+                input_pads=[prev_pad, input_pads[i]],
+                output_pads=output_pads,
             )
-            filtergraph.filterchains.append(xfade)
-            prev_filterchain = xfade
-        else:
-            prev_filterchain = filterchain
+        )
+        if output_pads is not None:
+            prev_pad = output_pads[0]
+    return filterchains
+
+
+def image_inputs(kbimages: list[KBImage]) -> list[int]:
+    """
+    ffmpeg input index of each image, images with identical sources share an input
+    """
+    sources = [
+        hashlib.sha256(image.data).hexdigest() if image.data is not None else image.src
+        for image in kbimages
+    ]
+    inputs: dict[str, int] = {}
+    return [inputs.setdefault(source, len(inputs)) for source in sources]
+
+
+def build_filtergraph(
+    encode_size: Size, fps: int, kbimages: list[KBImage], inputs: list[int] | None = None
+) -> FilterGraph:
+    """
+    Build the filtergraph that pans and zooms each image and transitions between them.
+    inputs is the ffmpeg input index of each image, inputs used by several images are split.
+    """
+    if inputs is None:
+        inputs = list(range(len(kbimages)))
+    input_pads = [str(input_) for input_ in inputs]
+    input_images: dict[int, list[int]] = {}
+    for i, input_ in enumerate(inputs):
+        input_images.setdefault(input_, []).append(i)
+    splits: list[FilterChain] = []
+    for input_, images in input_images.items():
+        if len(images) > 1:
+            for i in images:
+                input_pads[i] = f"sp{i}"
+            splits.append(
+                FilterChain(
+                    [Filter("split", {"outputs": str(len(images))})],
+                    input_pads=[str(input_)],
+                    output_pads=[f"sp{i}" for i in images],
+                )
+            )
+    segments = [
+        segment_filterchain(image, input_pad, encode_size, fps)
+        for image, input_pad in zip(kbimages, input_pads, strict=True)
+    ]
+    if len(segments) == 1:
+        return FilterGraph(segments)
+    for i, segment in enumerate(segments):
+        segment.output_pads = [f"pz{i}"]
+    xfades = xfade_filterchains(kbimages, [f"pz{i}" for i in range(len(segments))])
+    # Interleave each segment with the transition into it
+    filtergraph = FilterGraph([*splits, segments[0]])
+    for segment, xfade in zip(segments[1:], xfades, strict=True):
+        filtergraph.filterchains.extend([segment, xfade])
+    return filtergraph
 
-        prev_image = image
 
-    command.extend(["-filter_complex", str(filtergraph)])
+def boundary_times(kbimages: list[KBImage]) -> list[float]:
+    """
+    Output times where each transition starts and ends
+    """
+    times: list[float] = []
+    offset: float = 0
+    for image in kbimages[:-1]:
+        offset += image.duration - image.transition_duration
+        times.extend([offset, offset + image.transition_duration])
+    return times
 
+
+def output_arguments(
+    encode_size: Size,
+    fps: int,
+    outfile: pathlib.Path | str,
+    output_format: OutputFormat = OutputFormat.MP4,
+    keyframes: list[float] | None = None,
+    preview: bool = False,
+) -> list[str]:
     # yuv420p otherwise ffmpeg uses H.264 High 4:4:4 Profile, some players don't support that
-    command.extend(["-r", str(fps), "-s", str(encode_size), "-pix_fmt", "yuv420p", "-y", str(outfile)])
-    subprocess.check_call(command)  # noqa: S603
+    arguments = ["-r", str(fps), "-s", str(encode_size), "-pix_fmt", "yuv420p"]
+    if preview:
+        arguments.extend(PREVIEW_CODEC_ARGUMENTS)
+    if output_format is OutputFormat.MP4:
+        return [*arguments, "-y", str(outfile)]
+
+    # Streamed output is split into fragments/segments at keyframes,
+    # force them at image and transition boundaries and disable scene cut keyframes
+    arguments.extend(["-c:v", "libx264", "-sc_threshold", "0"])
+    if keyframes:
+        arguments.extend(["-force_key_frames", ",".join(str(time) for time in keyframes)])
+    if output_format is OutputFormat.FMP4:
+        return [
+            *arguments,
+            "-movflags",
+            "frag_keyframe+empty_moov+default_base_moof",
+            "-f",
+            "mp4",
+            "-y",
+            "pipe:1" if str(outfile) == "-" else str(outfile),
+        ]
+
+    playlist = pathlib.Path(outfile)
+    return [
+        *arguments,
+        "-f",
+        "hls",
+        # Start a new segment at every keyframe
+        "-hls_time",
+        str(1 / fps),
+        # The playlist is rewritten as each segment completes
+        "-hls_playlist_type",
+        "event",
+        "-hls_segment_type",
+        "fmp4",
+        "-hls_fmp4_init_filename",
+        f"{playlist.stem}_init.mp4",
+        "-hls_segment_filename",
+        str(playlist.with_name(f"{playlist.stem}_%03d.m4s")),
+        "-hls_flags",
+        "independent_segments",
+        "-y",
+        str(playlist),
+    ]
+
+
+def trim_filters(frames: tuple[int, int | None]) -> list[Filter]:
+    """
+    Filters that keep frames start up to (not including) end, None to keep all frames after start
+    """
+    start, end = frames
+    options = {"start_frame": str(start)}
+    if end is not None:
+        options["end_frame"] = str(end)
+    return [Filter("trim", options), Filter("setpts", {"expr": "PTS-STARTPTS"})]
+
+
+def chunk_arguments(
+    encode_size: Size,
+    fps: int,
+    kbimages: list[KBImage],
+    outfile: pathlib.Path | str,
+    output_format: OutputFormat,
+    chunk_frames: tuple[int, int | None] | None,
+    preview: bool = False,
+) -> list[str]:
+    """
+    Output arguments, or lossless intermediate arguments when rendering the chunk_frames of a chunk
+    """
+    if chunk_frames is None:
+        return output_arguments(encode_size, fps, outfile, output_format, boundary_times(kbimages), preview)
+    return [*SEGMENT_CODEC_ARGUMENTS, "-y", str(outfile)]
+
+
+def render_segment(
+    image: KBImage,
+    input_: str,
+    encode_size: Size,
+    fps: int,
+    outfile: pathlib.Path,
+    verbose: int = 0,
+    progress: ProgressCallback | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Render the pan/zoom segment of a single image into a lossless intermediate file.
+    Previews decode the image at reduced scale and use fast scaling.
+    """
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        loglevel(verbose),
+        *input_arguments(input_, lowres(image, encode_size) if preview else 0),
+        "-filter_complex",
+        str(
+            FilterGraph(
+                [segment_filterchain(image, "0", encode_size, fps)],
+                sws_flags=PREVIEW_SWS_FLAGS if preview else None,
+            )
+        ),
+        *SEGMENT_CODEC_ARGUMENTS,
+        "-y",
+        str(outfile),
+    ]
+    run_ffmpeg(command, progress, image.src, image.duration)
+    if verbose > 0:
+        print(command, file=sys.stderr)
+
+
+def fetch_image_data(image: KBImage) -> KBImage:
+    """
+    Fetch the bytes of a remote image without data, so they can be hashed and passed to ffmpeg
+    """
+    if image.data is not None or not is_url(image.src):
+        return image
+    return dataclasses.replace(image, data=fetch(image.src))
+
+
+def segment_key(
+    image: KBImage, encode_size: Size, fps: int, renderer: Renderer, preview: bool = False
+) -> str:
+    """
+    Hash of everything that determines the rendered segment of image, including the source bytes
+    (remote images should be fetched into image.data first, see fetch_image_data)
+    """
+    digest = hashlib.sha256()
+    if image.data is not None:
+        digest.update(image.data)
+    else:
+        digest.update(pathlib.Path(image.src).read_bytes())
+    digest.update(
+        json.dumps(
+            [
+                str(image.size),
+                image.fit.value,
+                [[box.xmin, box.ymin, box.xmax, box.ymax] for box in image.boxes[:1]],
+                image.duration,
+                image.transition_easing.value,
+                str(encode_size),
+                fps,
+                renderer.value,
+                preview,
+                SEGMENT_CODEC_ARGUMENTS,
+            ]
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def stitch_segments(
+    encode_size: Size,
+    fps: int,
+    kbimages: list[KBImage],
+    segments: list[pathlib.Path],
+    outfile: pathlib.Path | str,
+    verbose: int = 0,
+    progress: ProgressCallback | None = None,
+    output_format: OutputFormat = OutputFormat.MP4,
+    chunk_frames: tuple[int, int | None] | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Transition between the rendered segments of kbimages, encoding to outfile
+    """
+    command = ["ffmpeg", "-loglevel", loglevel(verbose)]
+    for segment in segments:
+        command.extend(["-i", str(segment)])
+    filtergraph = FilterGraph()
+    if len(segments) > 1:
+        filtergraph.filterchains = xfade_filterchains(kbimages, [str(i) for i in range(len(segments))])
+    if chunk_frames is not None:
+        if not filtergraph.filterchains:
+            filtergraph.filterchains = [FilterChain([], input_pads=["0"])]
+        filtergraph.filterchains[-1].filters.extend(trim_filters(chunk_frames))
+    with filter_complex_arguments(filtergraph) as filter_arguments:
+        if filtergraph.filterchains:
+            command.extend(filter_arguments)
+        command.extend(
+            chunk_arguments(encode_size, fps, kbimages, outfile, output_format, chunk_frames, preview)
+        )
+        run_ffmpeg(command, progress, "stitch", output_duration(kbimages))
+    if verbose > 0:
+        print(command, file=sys.stderr)
+
+
+def encode_segments(
+    encode_size: Size,
+    fps: int,
+    kbimages: list[KBImage],
+    outfile: pathlib.Path | str,
+    jobs: int,
+    verbose: int = 0,
+    renderer: Renderer = Renderer.ZOOMPAN,
+    timings: Timings | None = None,
+    progress: ProgressCallback | None = None,
+    output_format: OutputFormat = OutputFormat.MP4,
+    segment_cache: SegmentCache | None = None,
+    chunk_frames: tuple[int, int | None] | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Render each image segment in its own ffmpeg process using jobs parallel workers,
+    then transition between the segments in a final pass.
+    Segments found in segment_cache are reused instead of rendered.
+    """
+    if renderer is Renderer.NATIVE:
+        # Imported here, the renderers import this module
+        from .renderer import render_segment as render
+    elif renderer is Renderer.SENDCMD:
+        from .camera import render_segment as render
+    else:
+        render = render_segment
+
+    def render_image(index: int, image: KBImage) -> pathlib.Path:
+        key = None
+        if segment_cache is not None:
+            # The key covers the source bytes, a changed image behind the same URL is rendered again
+            image = fetch_image_data(image)
+            key = segment_key(image, encode_size, fps, renderer, preview)
+            keys.append(key)
+            if (cached := segment_cache.get(key)) is not None:
+                return cached
+        segment = directory / f"segment{index}{SEGMENT_SUFFIX}"
+        with record_span(timings, "segment", image=image.src):
+            render(
+                image,
+                image_input(image, index, directory),
+                encode_size,
+                fps,
+                segment,
+                verbose,
+                progress,
+                preview=preview,
+            )
+        if segment_cache is not None and key is not None:
+            return segment_cache.put(key, segment)
+        return segment
+
+    keys: list[str] = []
+    with tempfile.TemporaryDirectory(prefix="kbai-") as tempdir:
+        directory = pathlib.Path(tempdir)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_image, i, image) for i, image in enumerate(kbimages)]
+            segments = [future.result() for future in futures]
+        with record_span(timings, "stitch"):
+            stitch_segments(
+                encode_size,
+                fps,
+                kbimages,
+                segments,
+                outfile,
+                verbose,
+                progress,
+                output_format,
+                chunk_frames,
+                preview,
+            )
+    # Only evict once the stitch no longer needs the segments of this encode
+    if segment_cache is not None:
+        segment_cache.evict(keep=keys)
+
+
+def chunk_ranges(
+    kbimages: list[KBImage], fps: int, chunk_size: int
+) -> list[tuple[int, int, int, int | None]]:
+    """
+    Split kbimages into chunks of chunk_size images plus the first image of the next chunk,
+    so each chunk renders the transition into the next.
+    Returns (first, last) image indexes (inclusive) and the (start, end) frames to keep of each chunk,
+    consecutive chunks are cut where the image they share has no transition.
+    """
+    assert chunk_size >= 1, "chunk_size must be at least 1"  # noqa: S101
+    chunks: list[tuple[int, int, int, int | None]] = []
+    first = 0
+    while True:
+        last = min(first + chunk_size, len(kbimages) - 1)
+        start = round(kbimages[first - 1].transition_duration * fps) if first > 0 else 0
+        if last == len(kbimages) - 1:
+            chunks.append((first, last, start, None))
+            return chunks
+        # Where the transition into the last image ends
+        chunks.append((first, last, start, round(output_duration(kbimages[first:last]) * fps)))
+        first = last
+
+
+def encode_chunks(
+    encode_size: Size,
+    fps: int,
+    kbimages: list[KBImage],
+    outfile: pathlib.Path | str,
+    chunk_size: int,
+    verbose: int = 0,
+    jobs: int = 1,
+    renderer: Renderer = Renderer.ZOOMPAN,
+    timings: Timings | None = None,
+    progress: ProgressCallback | None = None,
+    output_format: OutputFormat = OutputFormat.MP4,
+    segment_cache: SegmentCache | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Render kbimages in chunks of chunk_size images, one chunk at a time, into lossless intermediate files,
+    then concatenate them. Each ffmpeg process only has the inputs of one chunk open,
+    so memory use does not grow with the number of images.
+    """
+    with tempfile.TemporaryDirectory(prefix="kbai-") as tempdir:
+        directory = pathlib.Path(tempdir)
+        chunk_list = directory / "chunks.txt"
+        with open(chunk_list, "w") as f:
+            for i, (first, last, start, end) in enumerate(chunk_ranges(kbimages, fps, chunk_size)):
+                chunk = directory / f"chunk{i}{SEGMENT_SUFFIX}"
+                with record_span(timings, "chunk", images=last + 1 - first):
+                    encode(
+                        encode_size,
+                        fps,
+                        kbimages[first : last + 1],
+                        chunk,
+                        verbose,
+                        jobs,
+                        renderer,
+                        timings,
+                        progress,
+                        segment_cache=segment_cache,
+                        chunk_frames=(start, end),
+                        preview=preview,
+                    )
+                f.write(f"file '{chunk.name}'\n")
+        command = [
+            "ffmpeg",
+            "-loglevel",
+            loglevel(verbose),
+            "-f",
+            "concat",
+            "-i",
+            str(chunk_list),
+            *output_arguments(encode_size, fps, outfile, output_format, boundary_times(kbimages), preview),
+        ]
+        with record_span(timings, "concat"):
+            run_ffmpeg(command, progress, "concat", output_duration(kbimages))
+    if verbose > 0:
+        print(command, file=sys.stderr)
+
+
+def encode(
+    encode_size: Size,
+    fps: int,
+    kbimages: list[KBImage],
+    outfile: pathlib.Path | str,
+    verbose: int = 0,
+    jobs: int = 1,
+    renderer: Renderer = Renderer.ZOOMPAN,
+    timings: Timings | None = None,
+    progress: ProgressCallback | None = None,
+    output_format: OutputFormat = OutputFormat.MP4,
+    segment_cache: SegmentCache | None = None,
+    chunk_size: int | None = None,
+    chunk_frames: tuple[int, int | None] | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Encode kbimages into outfile.
+    Long slideshows can be rendered in chunks of chunk_size images to bound memory use.
+    chunk_frames is the (start, end) frames of a chunk to render into a lossless intermediate outfile.
+    preview trades quality for speed: images are decoded at reduced scale, scaled with fast
+    scalers and encoded with the fastest x264 preset (see preview_settings for the size and fps).
+    """
+    if chunk_size is not None and len(kbimages) > chunk_size + 1:
+        encode_chunks(
+            encode_size,
+            fps,
+            kbimages,
+            outfile,
+            chunk_size,
+            verbose,
+            jobs,
+            renderer,
+            timings,
+            progress,
+            output_format,
+            segment_cache,
+            preview,
+        )
+        return
+
+    if renderer is not Renderer.ZOOMPAN or (jobs > 1 and len(kbimages) > 1) or segment_cache is not None:
+        encode_segments(
+            encode_size,
+            fps,
+            kbimages,
+            outfile,
+            jobs,
+            verbose,
+            renderer,
+            timings,
+            progress,
+            output_format,
+            segment_cache,
+            chunk_frames,
+            preview,
+        )
+        return
+
+    command = ["ffmpeg", "-loglevel", loglevel(verbose)]
+    with tempfile.TemporaryDirectory(prefix="kbai-") as tempdir:
+        # Each distinct source is decoded once, previews at the scale all its images allow
+        inputs = image_inputs(kbimages)
+        levels: dict[int, int] = {}
+        for image, input_ in zip(kbimages, inputs, strict=True):
+            level = lowres(image, encode_size) if preview else 0
+            levels[input_] = min(levels.get(input_, level), level)
+        added: set[int] = set()
+        for image, input_ in zip(kbimages, inputs, strict=True):
+            if input_ not in added:
+                added.add(input_)
+                command.extend(
+                    input_arguments(image_input(image, input_, pathlib.Path(tempdir)), levels[input_])
+                )
+        with record_span(timings, "filtergraph", images=len(kbimages)):
+            filtergraph = build_filtergraph(encode_size, fps, kbimages, inputs)
+            if preview:
+                filtergraph.sws_flags = PREVIEW_SWS_FLAGS
+            if chunk_frames is not None:
+                filtergraph.filterchains[-1].filters.extend(trim_filters(chunk_frames))
+        with filter_complex_arguments(filtergraph) as filter_arguments:
+            command.extend(filter_arguments)
+            command.extend(
+                chunk_arguments(encode_size, fps, kbimages, outfile, output_format, chunk_frames, preview)
+            )
+            with record_span(timings, "ffmpeg"):
+                run_ffmpeg(command, progress, "encode", output_duration(kbimages))
     if verbose > 0:
-        print(command)
+        print(command, file=sys.stderr)
@@ -1,29 +1,210 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
+import functools
+import hashlib
+import importlib.util
 import io
-from dataclasses import dataclass
+import math
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 import httpx
 from PIL import Image
 
+from .store import ImageStore
+from .structs import Size
+from .timings import Timings, record_span
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 30.0
+# Shortest and longest edge the detection model resizes images to
+DETECTION_EDGES = (800, 1333)
+
 
 @dataclass
 class ImageSrc:
     image: Image.Image
     src: str
+    # Encoded image bytes fetched from a remote src
+    data: bytes | None = field(default=None, repr=False)
+    # Size of the source image, if image was decoded at a reduced scale
+    original_size: Size | None = None
 
+    @property
+    def size(self) -> Size:
+        return self.original_size or Size(*self.image.size)
 
-def load_image(src: str) -> ImageSrc:
-    image: Image.Image
-    url = httpx.URL(src)
-    if url.is_absolute_url:
-        response = httpx.get(url, follow_redirects=True)
+    @functools.cached_property
+    def digest(self) -> str:
+        """
+        Hash of the decoded image and its source size, so identical images from different sources match
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{self.image.mode}:{self.image.width}x{self.image.height}:{self.size}:".encode())
+        digest.update(self.image.tobytes())
+        return digest.hexdigest()
+
+
+def http_client(
+    concurrency: int = DEFAULT_CONCURRENCY, timeout: float | None = DEFAULT_TIMEOUT
+) -> httpx.Client:
+    """
+    Create a client with keep-alive connections, using HTTP/2 if the h2 package is installed
+    """
+    return httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        follow_redirects=True,
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+    )
+
+
+def is_url(src: str) -> bool:
+    return httpx.URL(src).is_absolute_url
+
+
+def fetch(
+    src: str,
+    client: httpx.Client | None = None,
+    store: ImageStore | None = None,
+    timings: Timings | None = None,
+) -> bytes:
+    """
+    Fetch the encoded bytes of a remote src, through store if set
+    """
+    with record_span(timings, "fetch", image=src):
+        if store is not None:
+            return store.fetch(src, client)
+        if client is None:
+            response = httpx.get(src, follow_redirects=True)
+        else:
+            response = client.get(src)
         response.raise_for_status()
-        image = Image.open(io.BytesIO(response.content))
+        return response.content
+
+
+def fetch_images(
+    srcs: Sequence[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    store: ImageStore | None = None,
+    timings: Timings | None = None,
+) -> dict[str, bytes]:
+    """
+    Fetch the encoded bytes of remote srcs concurrently using a shared client, without decoding them.
+    Repeated srcs are fetched once.
+    """
+    unique = list(dict.fromkeys(srcs))
+    with (
+        http_client(concurrency, timeout) as client,
+        ThreadPoolExecutor(max_workers=concurrency) as executor,
+    ):
+        fetched = executor.map(
+            functools.partial(fetch, client=client, store=store, timings=timings), unique
+        )
+        return dict(zip(unique, fetched, strict=True))
+
+
+def load_image(
+    src: str,
+    client: httpx.Client | None = None,
+    store: ImageStore | None = None,
+    edges: tuple[int, int] | None = None,
+    timings: Timings | None = None,
+) -> ImageSrc:
+    """
+    Load and decode src. If edges (shortest, longest) is set, the image is decoded at a reduced scale
+    that is still at least as large as when resized to fit those edges.
+    JPEGs are decoded at reduced scale (draft mode), other formats are reduced after decoding.
+    """
+    image: Image.Image
+    data: bytes | None = None
+    if is_url(src):
+        data = fetch(src, client, store, timings)
+        image = Image.open(io.BytesIO(data))
     else:
         image = Image.open(src)
+    with record_span(timings, "decode", image=src):
+        # The size from the header, before any reduction
+        original_size = Size(*image.size)
+        scale = 1.0
+        if edges is not None:
+            scale = min(edges[0] / min(image.size), edges[1] / max(image.size), 1)
+            image.draft(None, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        # Decode now, so it happens concurrently when called from load_images
+        image.load()
+        factor = math.floor(image.width / (original_size.width * scale))
+        if factor > 1:
+            image = image.reduce(factor)
+
+        # DINO can't handle alpha
+        if image.mode in ("RGBA", "LA"):
+            image = image.convert("RGB")
+    return ImageSrc(image, src, data, original_size)
+
+
+@contextmanager
+def image_stream(
+    srcs: Sequence[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    store: ImageStore | None = None,
+    edges: tuple[int, int] | None = None,
+    timings: Timings | None = None,
+    lookahead: int | None = None,
+) -> Iterator[Iterator[ImageSrc]]:
+    """
+    Fetch and decode images concurrently using a shared client, yielding an iterator of them
+    in the same order as srcs. Loading starts immediately and runs ahead of the consumer
+    by up to lookahead images (default twice concurrency), so consuming images (e.g. detecting
+    features in them) overlaps loading the following ones. Repeated srcs are loaded once.
+    """
+    if lookahead is None:
+        lookahead = 2 * concurrency
+    last_use = {src: index for index, src in enumerate(srcs)}
+    futures: dict[str, Future[ImageSrc]] = {}
+    load = functools.partial(load_image, timings=timings, store=store, edges=edges)
+
+    with (
+        http_client(concurrency, timeout) as client,
+        ThreadPoolExecutor(max_workers=concurrency) as executor,
+    ):
+
+        def submit(index: int) -> None:
+            if index < len(srcs) and srcs[index] not in futures:
+                futures[srcs[index]] = executor.submit(load, srcs[index], client=client)
+
+        def images() -> Iterator[ImageSrc]:
+            for index, src in enumerate(srcs):
+                submit(index + lookahead)
+                with record_span(timings, "wait_image", image=src):
+                    image = futures[src].result()
+                if last_use[src] == index:
+                    del futures[src]
+                yield image
+
+        for index in range(min(lookahead, len(srcs))):
+            submit(index)
+        try:
+            yield images()
+        finally:
+            for future in futures.values():
+                future.cancel()
+
 
-    # DINO can't handle alpha
-    if image.mode in ("RGBA", "LA"):
-        image = image.convert("RGB")
-    return ImageSrc(image, src)
+def load_images(
+    srcs: Sequence[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    timeout: float | None = DEFAULT_TIMEOUT,
+    store: ImageStore | None = None,
+    edges: tuple[int, int] | None = None,
+    timings: Timings | None = None,
+) -> list[ImageSrc]:
+    """
+    Fetch and decode images concurrently using a shared client.
+    Results are returned in the same order as srcs, repeated srcs are loaded once.
+    """
+    with image_stream(srcs, concurrency, timeout, store, edges, timings, lookahead=len(srcs)) as images:
+        return list(images)
@@ -0,0 +1,261 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import argparse
+import enum
+import hashlib
+import json
+import logging
+import pathlib
+import queue
+import threading
+import time
+import typing as ta
+import uuid
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """
+    Invalid job spec
+    """
+
+
+class JobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+def spec_argv(spec: ta.Any) -> list[str]:
+    """
+    Convert a job spec into command line arguments.
+    The spec is an object with the command name and the long command line options, e.g.
+    {"command": "encode", "size": "640x480", "image": [["a.jpg", "/ft", "dog"], ["b.jpg"]]}
+    List values repeat the option, nested lists are the values for a single option.
+    true adds a flag, false or null omit the option.
+    """
+    if not isinstance(spec, dict):
+        raise JobError("job spec must be an object")
+    options = dict(spec)
+    command = options.pop("command", None)
+    if not isinstance(command, str):
+        raise JobError("job spec command missing")
+    argv = [command]
+    for name, value in options.items():
+        option = "--" + name.replace("_", "-")
+        for item in value if isinstance(value, list) else [value]:
+            if item is None or item is False:
+                continue
+            argv.append(option)
+            if item is True:
+                continue
+            if isinstance(item, list):
+                argv.extend(str(v) for v in item)
+            elif isinstance(item, dict):
+                raise JobError(f"invalid value for {name}")
+            else:
+                argv.append(str(item))
+    return argv
+
+
+@dataclass
+class Job:
+    command: str
+    args: argparse.Namespace = field(repr=False)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = JobStatus.QUEUED
+    result: dict[str, ta.Any] | None = None
+    error: str | None = None
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    # Latest progress of a running job
+    progress: dict[str, ta.Any] | None = None
+
+    def to_dict(self) -> dict[str, ta.Any]:
+        return {
+            "id": self.id,
+            "command": self.command,
+            "status": self.status.value,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on worker threads from a bounded queue.
+    Finished jobs are kept (up to history of them) so their status can be queried.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[Job], dict[str, ta.Any]],
+        max_queued: int = 16,
+        workers: int = 1,
+        history: int = 1000,
+    ) -> None:
+        self.run = run
+        self.history = history
+        self.queue: queue.Queue[Job | None] = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def join(self) -> None:
+        """
+        Wait until all submitted jobs have finished
+        """
+        self.queue.join()
+
+    def submit(self, command: str, args: argparse.Namespace) -> Job:
+        """
+        Queue a job, raises queue.Full if too many jobs are already queued
+        """
+        job = Job(command, args)
+        with self.lock:
+            self.queue.put_nowait(job)
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        with self.lock:
+            return list(self._jobs.values())
+
+    def _work(self) -> None:
+        while (job := self.queue.get()) is not None:
+            job.status = JobStatus.RUNNING
+            job.started = time.time()
+            try:
+                job.result = self.run(job)
+                job.status = JobStatus.SUCCEEDED
+            except Exception as e:
+                logger.exception("job %s failed", job.id)
+                job.error = str(e) or type(e).__name__
+                job.status = JobStatus.FAILED
+            job.finished = time.time()
+            self._trim()
+            self.queue.task_done()
+        self.queue.task_done()
+
+    def _trim(self) -> None:
+        with self.lock:
+            finished = [
+                job.id
+                for job in self._jobs.values()
+                if job.status in (JobStatus.SUCCEEDED, JobStatus.FAILED)
+            ]
+            for job_id in finished[: max(len(finished) - self.history, 0)]:
+                del self._jobs[job_id]
+
+
+def read_manifest(path: pathlib.Path | str) -> list[dict[str, ta.Any]]:
+    """
+    Read a batch manifest, a JSON job spec per line.
+    The command defaults to encode, and an optional id identifies the job in the status log.
+    """
+    specs = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                spec = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise JobError(f"{path}:{lineno}: {e}") from e
+            if not isinstance(spec, dict):
+                raise JobError(f"{path}:{lineno}: job spec must be an object")
+            specs.append({"command": "encode"} | spec)
+    return specs
+
+
+def job_id(spec: dict[str, ta.Any]) -> str:
+    """
+    The spec id, or a hash of the spec so a changed spec is run again
+    """
+    if "id" in spec:
+        return str(spec["id"])
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class StatusLog:
+    """
+    Append only JSON lines log of batch job statuses, the last entry for a job wins
+    """
+
+    def __init__(self, path: pathlib.Path | str) -> None:
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+
+    def statuses(self) -> dict[str, JobStatus]:
+        statuses: dict[str, JobStatus] = {}
+        if not self.path.exists():
+            return statuses
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    statuses[entry["id"]] = JobStatus(entry["status"])
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    # A partial line written when the batch was interrupted
+                    continue
+        return statuses
+
+    def record(self, job_id: str, status: JobStatus, **fields: ta.Any) -> None:
+        line = json.dumps({"id": job_id, "status": status.value, "time": time.time()} | fields)
+        with self.lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+def run_batch(
+    jobs: Sequence[tuple[str, argparse.Namespace]],
+    run: Callable[[argparse.Namespace], dict[str, ta.Any]],
+    status: StatusLog,
+    workers: int = 1,
+) -> dict[JobStatus, int]:
+    """
+    Run (id, args) jobs on a pool of workers, recording the status of each.
+    Returns the number of jobs that succeeded and failed.
+    """
+
+    def run_job(job_id: str, args: argparse.Namespace) -> JobStatus:
+        status.record(job_id, JobStatus.RUNNING)
+        try:
+            result = run(args)
+        except Exception as e:
+            logger.exception("job %s failed", job_id)
+            status.record(job_id, JobStatus.FAILED, error=str(e) or type(e).__name__)
+            return JobStatus.FAILED
+        status.record(job_id, JobStatus.SUCCEEDED, result=result)
+        return JobStatus.SUCCEEDED
+
+    counts = {JobStatus.SUCCEEDED: 0, JobStatus.FAILED: 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(lambda job: run_job(*job), jobs):
+            counts[result] += 1
+    return counts
@@ -1,43 +1,348 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
 import argparse
+import dataclasses
+import logging
+import pathlib
+import sys
+import typing as ta
+
+from PIL import Image
 
+from .cache import DetectionCache, SegmentCache
 from .debug import debug_image
-from .detector import Detector
-from .encoder import encode
-from .image import load_image
-from .structs import KBImage, Size
+from .encoder import encode, preview_settings
+from .image import DETECTION_EDGES, ImageSrc, fetch_images, image_stream, is_url, load_image
+from .jobs import Job, JobError, JobQueue, JobStatus, StatusLog, job_id, read_manifest, run_batch
+from .models import MANIFEST, ModelError, default_model_dir, install_model, verify_model
+from .progress import Progress, ProgressCallback
+from .project import Project
+from .server import create_server
+from .store import ImageStore
+from .structs import AnnotatedBox, KBImage
+from .timings import Timings
+
+if ta.TYPE_CHECKING:
+    from .detector import Detector
+
+logger = logging.getLogger(__name__)
+
+
+def detection_cache(args: argparse.Namespace) -> DetectionCache | None:
+    if args.detection_cache is None:
+        return None
+    return DetectionCache(
+        args.detection_cache,
+        max_bytes=args.detection_cache_max_bytes,
+        max_age=args.detection_cache_max_age,
+    )
+
+
+def create_detector(args: argparse.Namespace) -> Detector:
+    # Imported on demand, torch and transformers are slow to import and are an optional dependency
+    try:
+        from .detector import Detector
+    except ImportError as e:
+        raise ImportError(
+            f"Feature detection requires the detect extra (pip install 'kbai[detect]'): {e}"
+        ) from e
+    return Detector(cache=detection_cache(args), backend=args.detect_backend, model_dir=model_dir(args))
+
+
+def model_dir(args: argparse.Namespace) -> pathlib.Path | None:
+    """
+    The --model-dir local model directory, or the default one if kbai warmup installed it
+    """
+    if args.model_dir is not None:
+        return pathlib.Path(args.model_dir)
+    path = default_model_dir()
+    return path if (path / MANIFEST).exists() else None
+
+
+def image_store(args: argparse.Namespace) -> ImageStore | None:
+    if args.image_store is None:
+        return None
+    return ImageStore(args.image_store, max_bytes=args.image_store_max_bytes, offline=args.offline)
 
 
-def encode_main(args: argparse.Namespace) -> None:
+def segment_cache(args: argparse.Namespace) -> SegmentCache | None:
+    if args.segment_cache is None:
+        return None
+    return SegmentCache(args.segment_cache, max_bytes=args.segment_cache_max_bytes)
+
+
+def write_timings(args: argparse.Namespace, timings: Timings) -> None:
+    if args.timings is not None:
+        timings.write(args.timings)
+
+
+def print_progress(progress: Progress) -> None:
+    print(progress, file=sys.stderr)
+
+
+def image_feature_texts(args: argparse.Namespace) -> list[list[str]]:
+    # Features are not detected in images with precomputed boxes
+    return [
+        []
+        if args.no_detect or "boxes" in imageinfo
+        else imageinfo.get("feature_text", args.default_feature_text)
+        for imageinfo in args.image
+    ]
+
+
+def encode_main(
+    args: argparse.Namespace,
+    detector: Detector | None = None,
+    timings: Timings | None = None,
+    progress: ProgressCallback | None = None,
+) -> None:
     fps = args.framerate
     size = args.size
     output = args.output
-    detector = Detector()
+    if timings is None:
+        timings = Timings()
+    if progress is None and args.progress:
+        progress = print_progress
+    feature_texts = image_feature_texts(args)
     kbimages: list[KBImage] = []
-    for imageinfo in args.image:
-        image = load_image(imageinfo["image"])
-        feature_text = imageinfo.get("feature_text", args.default_feature_text)
-        boxes = detector.detect(image, feature_text)
-        kbimages.append(
-            KBImage(
-                image.src,
-                Size(*image.image.size),
-                fit=imageinfo.get("image_fit", args.default_image_fit),
-                boxes=boxes,
-                duration=imageinfo.get("image_duration", args.default_image_duration),
-                transition_duration=imageinfo.get("transition_duration", args.default_transition_duration),
-                transition=imageinfo.get("transition", args.default_transition),
-                transition_easing=imageinfo.get("transition_easing", args.default_transition_easing),
-                feature_text=feature_text,
+    # Images are fetched and decoded in the background while earlier images are detected,
+    # only the encoded bytes of each image are kept once it is detected.
+    # Loading overlaps detection, so time spent waiting for images is recorded per image (wait_image)
+    with image_stream(
+        [imageinfo["image"] for imageinfo in args.image],
+        concurrency=args.fetch_concurrency,
+        timeout=args.fetch_timeout,
+        store=image_store(args),
+        edges=DETECTION_EDGES,
+        timings=timings,
+    ) as images:
+        image_boxes: ta.Iterator[tuple[ImageSrc, list[AnnotatedBox]]]
+        if any(feature_texts):
+            # The first images load while the model loads
+            if detector is None:
+                with timings.span("load_model"):
+                    detector = create_detector(args)
+            image_boxes = detector.detect_stream(
+                zip(images, feature_texts, strict=True),
+                batch_size=args.detect_batch_size,
+                max_batch_pixels=args.detect_batch_pixels,
+                timings=timings,
+            )
+        else:
+            image_boxes = ((image, []) for image in images)
+        for imageinfo, feature_text, (image, boxes) in zip(
+            args.image, feature_texts, image_boxes, strict=True
+        ):
+            kbimages.append(
+                KBImage(
+                    image.src,
+                    image.size,
+                    fit=imageinfo.get("image_fit", args.default_image_fit),
+                    boxes=imageinfo.get("boxes", boxes),
+                    duration=imageinfo.get("image_duration", args.default_image_duration),
+                    transition_duration=imageinfo.get(
+                        "transition_duration", args.default_transition_duration
+                    ),
+                    transition=imageinfo.get("transition", args.default_transition),
+                    transition_easing=imageinfo.get("transition_easing", args.default_transition_easing),
+                    feature_text=feature_text,
+                    data=image.data,
+                )
             )
+
+    project = Project(size, fps, kbimages)
+    if args.project is not None:
+        project.write(args.project)
+    if output is not None:
+        render_project(args, project, timings, progress)
+    write_timings(args, timings)
+
+
+def render_project(
+    args: argparse.Namespace,
+    project: Project,
+    timings: Timings,
+    progress: ProgressCallback | None = None,
+) -> None:
+    size, fps = project.size, project.fps
+    if args.preview:
+        size, fps = preview_settings(size, fps)
+    with timings.span("encode", images=len(project.images)):
+        encode(
+            size,
+            fps,
+            project.images,
+            args.output,
+            args.verbose,
+            jobs=args.jobs,
+            renderer=args.renderer,
+            timings=timings,
+            progress=progress,
+            output_format=args.output_format,
+            segment_cache=segment_cache(args),
+            chunk_size=args.chunk_size,
+            preview=args.preview,
         )
 
-    encode(size, fps, kbimages, output, args.verbose)
+
+def encode_job(
+    args: argparse.Namespace, detector: Detector, progress: ProgressCallback | None = None
+) -> dict[str, ta.Any]:
+    timings = Timings()
+    encode_main(args, detector, timings, progress)
+    return {"output": args.output, "project": args.project, "timings": timings.report()}
+
+
+def render_main(
+    args: argparse.Namespace,
+    timings: Timings | None = None,
+    progress: ProgressCallback | None = None,
+) -> None:
+    if timings is None:
+        timings = Timings()
+    if progress is None and args.progress:
+        progress = print_progress
+    project = Project.read(args.project)
+    # The project only keeps srcs, fetch remote images like encode so no URL reaches ffmpeg
+    fetched = fetch_images(
+        [image.src for image in project.images if image.data is None and is_url(image.src)],
+        concurrency=args.fetch_concurrency,
+        timeout=args.fetch_timeout,
+        store=image_store(args),
+        timings=timings,
+    )
+    project.images = [
+        dataclasses.replace(image, data=fetched[image.src]) if image.src in fetched else image
+        for image in project.images
+    ]
+    render_project(args, project, timings, progress)
+    write_timings(args, timings)
+
+
+def render_job(
+    args: argparse.Namespace, detector: Detector | None, progress: ProgressCallback | None = None
+) -> dict[str, ta.Any]:
+    timings = Timings()
+    render_main(args, timings, progress)
+    return {"output": args.output, "timings": timings.report()}
+
+
+def detect_boxes(
+    args: argparse.Namespace, detector: Detector | None = None, timings: Timings | None = None
+) -> tuple[ImageSrc, list[AnnotatedBox]]:
+    if timings is None:
+        timings = Timings()
+    image = load_image(args.image, store=image_store(args), edges=DETECTION_EDGES, timings=timings)
+    if detector is None:
+        with timings.span("load_model"):
+            detector = create_detector(args)
+    (boxes,) = detector.detect_many([image], [args.feature], timings=timings)
+    write_timings(args, timings)
+    return image, boxes
 
 
 def detect_main(args: argparse.Namespace) -> None:
-    image = load_image(args.image)
-    detector = Detector()
-    boxes = detector.detect(image, args.feature)
-    debug_image(image.image, boxes)
+    image, boxes = detect_boxes(args)
+    # Boxes are in source image coordinates
+    debug_image(image.image, [box.scaled(image.image.width / image.size.width) for box in boxes])
+
+
+def detect_job(
+    args: argparse.Namespace, detector: Detector, progress: ProgressCallback | None = None
+) -> dict[str, ta.Any]:
+    timings = Timings()
+    _, boxes = detect_boxes(args, detector, timings)
+    return {
+        "boxes": [
+            {
+                "xmin": box.xmin,
+                "ymin": box.ymin,
+                "xmax": box.xmax,
+                "ymax": box.ymax,
+                "annotation": box.annotation,
+            }
+            for box in boxes
+        ],
+        "timings": timings.report(),
+    }
+
+
+def serve_main(args: argparse.Namespace) -> None:
+    # Load the model once, it is shared by all jobs
+    detector = create_detector(args)
+
+    def run(job: Job) -> dict[str, ta.Any]:
+        def update_progress(progress: Progress) -> None:
+            job.progress = dataclasses.asdict(progress) | {"eta": progress.eta}
+
+        job.args.verbose = args.verbose
+        return job.args.job(job.args, detector, update_progress)
+
+    jobs = JobQueue(run, max_queued=args.max_queued, workers=args.workers, history=args.job_history)
+    server = create_server(jobs, args.parse_job, host=args.host, port=args.port, socket_path=args.socket)
+    jobs.start()
+    logger.warning("Serving jobs on %s", args.socket or f"http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.stop()
+
+
+def batch_main(args: argparse.Namespace) -> None:
+    status = StatusLog(args.status or pathlib.Path(args.manifest).with_suffix(".status.jsonl"))
+    statuses = status.statuses()
+    jobs: list[tuple[str, argparse.Namespace]] = []
+    failed = skipped = 0
+    needs_detector = False
+    for spec in read_manifest(args.manifest):
+        spec_id = job_id(spec)
+        if statuses.get(spec_id) == JobStatus.SUCCEEDED:
+            skipped += 1
+            continue
+        try:
+            command, job_args = args.parse_job({k: v for k, v in spec.items() if k != "id"})
+        except (JobError, ValueError) as e:
+            status.record(spec_id, JobStatus.FAILED, error=str(e))
+            failed += 1
+            continue
+        job_args.verbose = args.verbose
+        jobs.append((spec_id, job_args))
+        needs_detector |= command == "detect" or (
+            command == "encode" and any(image_feature_texts(job_args))
+        )
+
+    # Load the model once if any job needs it, it is shared by all jobs
+    detector = create_detector(args) if needs_detector else None
+
+    counts = run_batch(
+        jobs, lambda job_args: job_args.job(job_args, detector), status, workers=args.workers
+    )
+    failed += counts[JobStatus.FAILED]
+    logger.warning(
+        "%d jobs succeeded, %d failed, %d already completed",
+        counts[JobStatus.SUCCEEDED],
+        failed,
+        skipped,
+    )
+    if failed:
+        sys.exit(1)
+
+
+def warmup_main(args: argparse.Namespace) -> None:
+    path = pathlib.Path(args.model_dir) if args.model_dir is not None else default_model_dir()
+    try:
+        manifest = verify_model(path)
+    except ModelError as e:
+        logger.warning("Installing model: %s", e)
+        install_model(path, revision=args.revision)
+        manifest = verify_model(path)
+    args.model_dir = path
+    # Load the model and run it once, this also exports the model for the onnx backend
+    detector = create_detector(args)
+    detector.detect(ImageSrc(Image.new("RGB", (640, 480)), "warmup"), ["thing"])
+    logger.warning("Model %s@%s is ready in %s", manifest["model_id"], manifest["revision"], path)
@@ -0,0 +1,109 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import typing as ta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_ID = "IDEA-Research/grounding-dino-tiny"
+MODEL_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "kbai" / "models"
+# Written last when installing, a directory without it is incomplete
+MANIFEST = "kbai-model.json"
+
+
+class ModelError(Exception):
+    """
+    Missing or corrupt local model
+    """
+
+
+def default_model_dir(model_id: str = DEFAULT_MODEL_ID) -> pathlib.Path:
+    return MODEL_DIR / model_id.replace("/", "--")
+
+
+def file_digest(path: pathlib.Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def model_manifest(path: pathlib.Path | str) -> dict[str, ta.Any]:
+    """
+    Read the manifest of a local model directory
+    """
+    try:
+        return json.loads((pathlib.Path(path) / MANIFEST).read_text())
+    except (OSError, json.JSONDecodeError) as e:
+        raise ModelError(f"{path} is not a local model directory: {e}") from e
+
+
+def verify_model(path: pathlib.Path | str) -> dict[str, ta.Any]:
+    """
+    Check every file of a local model directory against its manifest, returning the manifest.
+    Reading the files also loads them into the page cache.
+    """
+    path = pathlib.Path(path)
+    manifest = model_manifest(path)
+    for name, digest in manifest["files"].items():
+        try:
+            actual = file_digest(path / name)
+        except OSError as e:
+            raise ModelError(f"{path / name}: {e}") from e
+        if actual != digest:
+            raise ModelError(f"{path / name}: checksum mismatch")
+    return manifest
+
+
+def install_model(
+    path: pathlib.Path | str, model_id: str = DEFAULT_MODEL_ID, revision: str | None = None
+) -> dict[str, ta.Any]:
+    """
+    Download model_id from the hub and save it to a local model directory,
+    with the weights as safetensors so they can be memory mapped.
+    Returns the manifest of the directory.
+    """
+    from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    processor = AutoProcessor.from_pretrained(model_id, revision=revision)
+    model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id, revision=revision)
+    # Install atomically, other processes may be loading the model
+    temp = pathlib.Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}."))
+    old = temp.with_name(f"{temp.name}.old")
+    try:
+        processor.save_pretrained(temp)
+        model.save_pretrained(temp, safe_serialization=True)
+        manifest = {
+            "model_id": model_id,
+            # The resolved hub commit, so the installed model is pinned even if revision was a branch
+            "revision": getattr(model.config, "_commit_hash", None) or revision,
+            "files": {
+                str(file.relative_to(temp)): file_digest(file)
+                for file in sorted(temp.rglob("*"))
+                if file.is_file()
+            },
+        }
+        (temp / MANIFEST).write_text(json.dumps(manifest, indent=2) + "\n")
+        # Move a previous install aside rather than deleting it first,
+        # so the path is only ever missing between the two renames
+        if path.exists():
+            path.rename(old)
+        try:
+            temp.rename(path)
+        except OSError:
+            if old.exists():
+                old.rename(path)
+            raise
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+    logger.warning("Installed %s@%s in %s", model_id, manifest["revision"], path)
+    return manifest
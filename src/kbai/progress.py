@@ -0,0 +1,89 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+
+
+@dataclass
+class Progress:
+    """
+    Encoding progress, from ffmpeg -progress or the native renderer.
+    label identifies what is being encoded (e.g. a segment image), out_time and total_time
+    are in seconds of output video, speed is output seconds encoded per second.
+    """
+
+    label: str
+    frame: int
+    fps: float | None
+    speed: float | None
+    out_time: float
+    total_time: float | None = None
+    done: bool = False
+
+    @property
+    def fraction(self) -> float | None:
+        if not self.total_time:
+            return None
+        return min(self.out_time / self.total_time, 1)
+
+    @property
+    def eta(self) -> float | None:
+        """
+        Estimated seconds until done
+        """
+        if self.total_time is None or not self.speed:
+            return None
+        return max(self.total_time - self.out_time, 0) / self.speed
+
+    def __str__(self) -> str:
+        fields = [self.label, f"frame={self.frame}"]
+        if self.fps is not None:
+            fields.append(f"fps={self.fps:.1f}")
+        if self.speed is not None:
+            fields.append(f"speed={self.speed:.2f}x")
+        if self.total_time is not None:
+            fields.append(f"time={self.out_time:.1f}/{self.total_time:.1f}s")
+        else:
+            fields.append(f"time={self.out_time:.1f}s")
+        if (eta := self.eta) is not None and not self.done:
+            fields.append(f"eta={eta:.0f}s")
+        return " ".join(fields)
+
+
+# Called with each progress update, raising an exception from the callback aborts the encode
+ProgressCallback = Callable[[Progress], None]
+
+
+def parse_float(value: str | None) -> float | None:
+    try:
+        return float(value.removesuffix("x")) if value is not None else None
+    except ValueError:
+        # N/A before the first frame is encoded
+        return None
+
+
+def parse_progress(lines: Iterable[str], label: str, total_time: float | None = None) -> Iterator[Progress]:
+    """
+    Parse ffmpeg -progress output, blocks of key=value lines ending with a progress=continue|end line
+    """
+    fields: dict[str, str] = {}
+    for line in lines:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        if key != "progress":
+            fields[key] = value
+            continue
+        out_time_us = parse_float(fields.get("out_time_us"))
+        yield Progress(
+            label,
+            frame=int(fields.get("frame", 0)),
+            fps=parse_float(fields.get("fps")),
+            speed=parse_float(fields.get("speed")),
+            out_time=max(out_time_us, 0) / 1_000_000 if out_time_us is not None else 0,
+            total_time=total_time,
+            done=value == "end",
+        )
+        fields = {}
@@ -0,0 +1,113 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import typing as ta
+from dataclasses import dataclass
+
+from .easings import Easing
+from .image import is_url
+from .structs import AnnotatedBox, Fit, KBImage, Size
+from .transitions import Transition
+
+VERSION = 1
+
+
+class ProjectError(Exception):
+    """
+    Invalid project file
+    """
+
+
+@dataclass
+class Project:
+    """
+    Fully resolved slideshow, everything needed to encode it without detecting features
+    """
+
+    size: Size
+    fps: int
+    images: list[KBImage]
+
+    def to_dict(self, directory: pathlib.Path | None = None) -> dict[str, ta.Any]:
+        """
+        Local srcs are written relative to directory if set
+        """
+        return {
+            "version": VERSION,
+            "size": [self.size.width, self.size.height],
+            "fps": self.fps,
+            "images": [
+                {
+                    "src": image.src
+                    if directory is None or is_url(image.src)
+                    else os.path.relpath(image.src, directory),
+                    "size": [image.size.width, image.size.height],
+                    "fit": image.fit.value,
+                    "boxes": [
+                        {
+                            "xmin": box.xmin,
+                            "ymin": box.ymin,
+                            "xmax": box.xmax,
+                            "ymax": box.ymax,
+                            "annotation": box.annotation,
+                        }
+                        for box in image.boxes
+                    ],
+                    "duration": image.duration,
+                    "transition_duration": image.transition_duration,
+                    "transition": image.transition.value,
+                    # Easing values are ffmpeg expressions, so use the names
+                    "transition_easing": image.transition_easing.name.lower(),
+                    "feature_text": image.feature_text,
+                }
+                for image in self.images
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, project: ta.Any, directory: pathlib.Path | None = None) -> Project:
+        """
+        Relative local srcs are resolved against directory if set
+        """
+        try:
+            if project["version"] != VERSION:
+                raise ProjectError(f"unsupported project version {project['version']}")
+            return cls(
+                Size(*project["size"]),
+                int(project["fps"]),
+                [
+                    KBImage(
+                        image["src"]
+                        if directory is None or is_url(image["src"])
+                        else os.path.normpath(os.path.join(directory, image["src"])),
+                        Size(*image["size"]),
+                        fit=Fit(image["fit"]),
+                        boxes=[AnnotatedBox(**box) for box in image["boxes"]],
+                        duration=image["duration"],
+                        transition_duration=image["transition_duration"],
+                        transition=Transition(image["transition"]),
+                        transition_easing=Easing[image["transition_easing"].upper()],
+                        feature_text=image.get("feature_text"),
+                    )
+                    for image in project["images"]
+                ],
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ProjectError(f"invalid project: {e!r}") from e
+
+    def write(self, path: pathlib.Path | str) -> None:
+        # Relative to the project file, so it can be moved along with its images
+        path = pathlib.Path(path)
+        path.write_text(json.dumps(self.to_dict(path.parent), indent=2) + "\n")
+
+    @classmethod
+    def read(cls, path: pathlib.Path | str) -> Project:
+        try:
+            project = json.loads(pathlib.Path(path).read_text())
+        except json.JSONDecodeError as e:
+            raise ProjectError(f"{path}: {e}") from e
+        return cls.from_dict(project, pathlib.Path(path).parent)
@@ -0,0 +1,232 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import io
+import pathlib
+import subprocess
+import sys
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+import httpx
+import numpy as np
+from PIL import Image
+
+from .camera import camera_path, frame_count
+from .encoder import SEGMENT_CODEC_ARGUMENTS, SegmentLayout, loglevel, segment_layout
+from .progress import Progress, ProgressCallback
+from .structs import KBImage, Size
+
+# Fast, lower quality resampling for previews
+PREVIEW_RESAMPLE = Image.Resampling.BILINEAR
+
+
+@dataclass
+class FrameBoxes:
+    """
+    Per frame source rectangles (left, top, right, bottom) in canvas pixels
+    """
+
+    left: np.ndarray
+    top: np.ndarray
+    right: np.ndarray
+    bottom: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.left)
+
+    def __getitem__(self, index: int) -> tuple[float, float, float, float]:
+        return (
+            float(self.left[index]),
+            float(self.top[index]),
+            float(self.right[index]),
+            float(self.bottom[index]),
+        )
+
+
+def frame_boxes(
+    image: KBImage, layout: SegmentLayout, encode_size: Size, fps: int, scale: float
+) -> FrameBoxes:
+    """
+    Compute the visible region of every frame, following the zoompan camera without
+    rounding to integer pixels. scale maps zoom image coordinates to canvas pixels.
+    """
+    path = camera_path(image, encode_size, fps, layout)
+    width, height = layout.zoom_image_size.width, layout.zoom_image_size.height
+    # Clip away floating point error, boxes must be within the canvas
+    left, top, right, bottom = path.visible_boxes()
+    return FrameBoxes(
+        np.clip(left * scale, 0, width * scale),
+        np.clip(top * scale, 0, height * scale),
+        np.clip(right * scale, 0, width * scale),
+        np.clip(bottom * scale, 0, height * scale),
+    )
+
+
+def open_source(src: str, draft_size: Size | None = None) -> Image.Image:
+    """
+    Open src, JPEGs are decoded at the smallest scale still at least draft_size if set
+    """
+    if httpx.URL(src).is_absolute_url:
+        response = httpx.get(src, follow_redirects=True)
+        response.raise_for_status()
+        source = Image.open(io.BytesIO(response.content))
+    else:
+        source = Image.open(src)
+    if draft_size is not None:
+        source.draft("RGB", (draft_size.width, draft_size.height))
+    return source.convert("RGB")
+
+
+def source_size(image: KBImage, layout: SegmentLayout) -> Size:
+    """
+    Size of the source the segment samples at most, at max zoom
+    """
+    if layout.pad_size is None:
+        return layout.scale_size or image.size
+    # The padded canvas is rendered at the resolution needed at max zoom
+    return (layout.scale_size or image.size) * min(layout.zoom or 1, 1 / layout.fit_scale)
+
+
+def build_canvas(
+    source: Image.Image,
+    image: KBImage,
+    layout: SegmentLayout,
+    resample: Image.Resampling = Image.Resampling.LANCZOS,
+) -> tuple[Image.Image, float]:
+    """
+    Prepare the image frames are resampled from, padding it for contain.
+    Returns the canvas and the scale from zoom image coordinates to canvas pixels.
+    The source may be decoded at a reduced scale.
+    """
+    if layout.pad_size is None:
+        # Frames are resampled from a pyramid of the source, so it is not prescaled
+        return source, source.width / layout.zoom_image_size.width
+
+    # Render the padded canvas at the resolution needed at max zoom, unlike zoompan
+    # which has to zoom into the padded canvas at the encoded size
+    scale = min(layout.zoom or 1, 1 / layout.fit_scale)
+    scaled = source_size(image, layout)
+    canvas_size = layout.pad_size * scale
+    canvas = Image.new("RGB", (canvas_size.width, canvas_size.height))
+    canvas.paste(
+        source.resize((scaled.width, scaled.height), resample),
+        ((canvas_size.width - scaled.width) // 2, (canvas_size.height - scaled.height) // 2),
+    )
+    return canvas, canvas_size.width / layout.zoom_image_size.width
+
+
+def build_pyramid(canvas: Image.Image, encode_size: Size) -> list[Image.Image]:
+    """
+    Successively halved copies of canvas, down to the encoded size
+    """
+    levels = [canvas]
+    while levels[-1].width >= 2 * encode_size.width and levels[-1].height >= 2 * encode_size.height:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def render_frames(
+    source: Image.Image, image: KBImage, encode_size: Size, fps: int, preview: bool = False
+) -> Iterator[bytes]:
+    """
+    Generate rgb24 frames for image, resampling each frame with subpixel accuracy.
+    Previews use faster, lower quality resampling.
+    """
+    layout = segment_layout(image, encode_size)
+    canvas, scale = build_canvas(
+        source, image, layout, PREVIEW_RESAMPLE if preview else Image.Resampling.LANCZOS
+    )
+    boxes = frame_boxes(image, layout, encode_size, fps, scale)
+    pyramid = build_pyramid(canvas, encode_size)
+    # Resample each frame from the smallest level at least as large as the frame,
+    # so the cost per frame depends on the encoded size and not the source size
+    ratios = (boxes.right - boxes.left) / encode_size.width
+    levels = np.clip(np.floor(np.log2(np.maximum(ratios, 1))), 0, len(pyramid) - 1).astype(int)
+    for i, level in enumerate(levels):
+        level_image = pyramid[level]
+        scale_x = level_image.width / canvas.width
+        scale_y = level_image.height / canvas.height
+        left, top, right, bottom = boxes[i]
+        frame = level_image.resize(
+            (encode_size.width, encode_size.height),
+            PREVIEW_RESAMPLE if preview else Image.Resampling.BICUBIC,
+            box=(
+                left * scale_x,
+                top * scale_y,
+                min(right * scale_x, level_image.width),
+                min(bottom * scale_y, level_image.height),
+            ),
+        )
+        yield frame.tobytes()
+
+
+def render_segment(
+    image: KBImage,
+    input_: str,
+    encode_size: Size,
+    fps: int,
+    outfile: pathlib.Path,
+    verbose: int = 0,
+    progress: ProgressCallback | None = None,
+    preview: bool = False,
+) -> None:
+    """
+    Render the pan/zoom segment of a single image in Python, streaming raw frames
+    into ffmpeg which encodes them into a lossless intermediate file.
+    Progress is reported once per second of video rendered.
+    Previews decode the image at reduced scale and use fast resampling.
+    """
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        loglevel(verbose),
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        str(encode_size),
+        "-r",
+        str(fps),
+        "-i",
+        "-",
+        *SEGMENT_CODEC_ARGUMENTS,
+        "-y",
+        str(outfile),
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)  # noqa: S603
+    assert process.stdin is not None  # noqa: S101
+    frames = frame_count(image, fps)
+    # Previews only decode as much of the source as the segment needs, like zoompan with lowres
+    draft_size = source_size(image, segment_layout(image, encode_size)) if preview else None
+    source = open_source(input_, draft_size)
+    start = time.perf_counter()
+    try:
+        for i, frame in enumerate(render_frames(source, image, encode_size, fps, preview), 1):
+            process.stdin.write(frame)
+            if progress is not None and (i % fps == 0 or i == frames):
+                elapsed = time.perf_counter() - start
+                progress(
+                    Progress(
+                        image.src,
+                        frame=i,
+                        fps=i / elapsed,
+                        speed=i / fps / elapsed,
+                        out_time=i / fps,
+                        total_time=image.duration,
+                        done=i == frames,
+                    )
+                )
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdin.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    if verbose > 0:
+        print(command, file=sys.stderr)
@@ -0,0 +1,112 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import pathlib
+import queue
+import socketserver
+import typing as ta
+from collections.abc import Callable
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .jobs import JobError, JobQueue
+
+logger = logging.getLogger(__name__)
+
+
+class JobServerMixin:
+    jobs: JobQueue
+    parse_job: Callable[[ta.Any], tuple[str, argparse.Namespace]]
+
+
+class JobHTTPServer(JobServerMixin, ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class JobUnixServer(JobServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self) -> None:
+        super().server_close()
+        pathlib.Path(self.server_address).unlink(missing_ok=True)  # type: ignore[arg-type]
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs queues a job from a JSON job spec,
+    GET /jobs lists jobs and GET /jobs/ID returns a single job status and result.
+    """
+
+    server: JobHTTPServer | JobUnixServer
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format: str, *args: ta.Any) -> None:  # noqa: A002
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def send_json(self, status: HTTPStatus, body: ta.Any, headers: dict[str, str] | None = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == "/jobs":
+            self.send_json(HTTPStatus.OK, [job.to_dict() for job in self.server.jobs.jobs()])
+            return
+        job_id = self.path.removeprefix("/jobs/")
+        job = self.server.jobs.get(job_id) if job_id != self.path else None
+        if job is None:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        self.send_json(HTTPStatus.OK, job.to_dict())
+
+    def do_POST(self) -> None:
+        if self.path != "/jobs":
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            command, args = self.server.parse_job(spec)
+        except (ValueError, JobError) as e:
+            # Also invalid JSON, a non UTF-8 body or an invalid Content-Length
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            return
+        try:
+            job = self.server.jobs.submit(command, args)
+        except queue.Full:
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "job queue full"})
+            return
+        self.send_json(HTTPStatus.ACCEPTED, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+
+
+def create_server(
+    jobs: JobQueue,
+    parse_job: Callable[[ta.Any], tuple[str, argparse.Namespace]],
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str | None = None,
+) -> JobHTTPServer | JobUnixServer:
+    """
+    Create a server accepting jobs over HTTP on host:port, or on the Unix socket socket_path
+    """
+    server: JobHTTPServer | JobUnixServer
+    if socket_path is not None:
+        # Remove a stale socket left by a previous server
+        pathlib.Path(socket_path).unlink(missing_ok=True)
+        server = JobUnixServer(socket_path, JobRequestHandler)
+    else:
+        server = JobHTTPServer((host, port), JobRequestHandler)
+    server.jobs = jobs
+    server.parse_job = parse_job
+    return server
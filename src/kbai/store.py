@@ -0,0 +1,127 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import hashlib
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+
+import httpx
+
+from .cache import transaction
+
+
+class ImageStore:
+    """
+    Persistent content addressed store of fetched image bytes.
+    URLs are revalidated with conditional requests using the stored
+    ETag/Last-Modified headers, or served only from the store when offline.
+    Least recently used images are evicted when the total size exceeds max_bytes.
+    """
+
+    def __init__(
+        self, root: pathlib.Path | str, max_bytes: int | None = None, offline: bool = False
+    ) -> None:
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.index = self.root / "index.db"
+        with transaction(self.index) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                "url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, last_modified TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "digest TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    def _object_path(self, digest: str) -> pathlib.Path:
+        return self.objects / digest[:2] / digest
+
+    def _lookup(self, url: str) -> tuple[str, str | None, str | None] | None:
+        with transaction(self.index) as connection:
+            row = connection.execute(
+                "SELECT digest, etag, last_modified FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not self._object_path(row[0]).exists():
+            return None
+        return row
+
+    def _touch(self, digest: str) -> bytes:
+        with transaction(self.index) as connection:
+            connection.execute("UPDATE objects SET accessed = ? WHERE digest = ?", (time.time(), digest))
+        return self._object_path(digest).read_bytes()
+
+    def fetch(self, url: str, client: httpx.Client | None = None) -> bytes:
+        """
+        Return the bytes for url, from the store if they are still current
+        """
+        entry = self._lookup(url)
+        if self.offline:
+            if entry is None:
+                raise LookupError(f"{url} not in image store")
+            return self._touch(entry[0])
+
+        headers: dict[str, str] = {}
+        if entry is not None:
+            _, etag, last_modified = entry
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+        if client is None:
+            response = httpx.get(url, headers=headers, follow_redirects=True)
+        else:
+            response = client.get(url, headers=headers)
+        if entry is not None and response.status_code == httpx.codes.NOT_MODIFIED:
+            return self._touch(entry[0])
+        response.raise_for_status()
+
+        data = response.content
+        self._put(url, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return data
+
+    def _put(self, url: str, data: bytes, etag: str | None, last_modified: str | None) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Write atomically so concurrent readers never see a partial object
+            fd, temp = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        with transaction(self.index) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO urls (url, digest, etag, last_modified) VALUES (?, ?, ?, ?)",
+                (url, digest, etag, last_modified),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO objects (digest, size, accessed) VALUES (?, ?, ?)",
+                (digest, len(data), time.time()),
+            )
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        if self.max_bytes is None:
+            return
+        # Keep the most recently accessed objects that fit within max_bytes
+        evicted = [
+            digest
+            for (digest,) in connection.execute(
+                "SELECT digest FROM ("
+                "SELECT digest, SUM(size) OVER (ORDER BY accessed DESC, digest) AS total FROM objects"
+                ") WHERE total > ?",
+                (self.max_bytes,),
+            ).fetchall()
+        ]
+        for digest in evicted:
+            connection.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+            connection.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+            self._object_path(digest).unlink(missing_ok=True)
@@ -17,6 +17,35 @@ class Fit(enum.Enum):
     CONTAIN = "contain"
 
 
+class Renderer(enum.Enum):
+    # ffmpeg zoompan filter
+    ZOOMPAN = "zoompan"
+    # Subpixel frames rendered in Python and streamed to ffmpeg
+    NATIVE = "native"
+    # ffmpeg scale and crop driven by the precomputed camera path with sendcmd
+    SENDCMD = "sendcmd"
+
+
+class OutputFormat(enum.Enum):
+    # Regular MP4 file
+    MP4 = "mp4"
+    # Fragmented MP4, playable while it is written, can be written to stdout
+    FMP4 = "fmp4"
+    # HLS playlist and fragmented MP4 segments
+    HLS = "hls"
+
+
+class DetectorBackend(enum.Enum):
+    # fp32 PyTorch
+    TORCH = "torch"
+    # PyTorch with bfloat16 autocast, where supported
+    BF16 = "bf16"
+    # PyTorch with dynamic int8 quantization of linear layers (CPU)
+    INT8 = "int8"
+    # ONNX Runtime (CPU), exported from the PyTorch model on first use
+    ONNX = "onnx"
+
+
 @dataclass(frozen=True)
 class Size:
     width: int
@@ -90,6 +119,8 @@ class KBImage:
     transition: Transition
     transition_easing: Easing
     feature_text: list[str] | None = None
+    # Encoded image bytes, if set these are used instead of fetching src again
+    data: bytes | None = field(default=None, repr=False, compare=False)
 
     def __post_init__(self) -> None:
         if self.duration - self.transition_duration <= 0:
@@ -0,0 +1,133 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+from __future__ import annotations
+
+import json
+import pathlib
+import resource
+import sys
+import threading
+import time
+import typing as ta
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+RSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+Hook = Callable[["Span"], None]
+
+# Hooks called with every finished span, e.g. to forward them to a metrics system
+HOOKS: list[Hook] = []
+
+
+def add_hook(hook: Hook) -> None:
+    HOOKS.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    HOOKS.remove(hook)
+
+
+@dataclass
+class Span:
+    """
+    Resource usage of a stage, e.g. fetching or detecting features in an image.
+    cpu is process CPU time, including other threads running concurrently,
+    thread_cpu is CPU time of the thread running the stage and children_cpu is CPU time
+    of child processes (ffmpeg) that exited during the stage.
+    max_rss_growth is how much the stage raised the peak resident set size of the process, in bytes,
+    memory allocated below an earlier peak is not counted, and concurrent stages share the growth.
+    children_max_rss_growth is how much the stage raised the largest peak of exited child processes.
+    """
+
+    name: str
+    attributes: dict[str, ta.Any] = field(default_factory=dict)
+    start: float = 0
+    wall: float = 0
+    cpu: float = 0
+    thread_cpu: float = 0
+    children_cpu: float = 0
+    max_rss_growth: int = 0
+    children_max_rss_growth: int = 0
+
+
+def max_rss(who: int) -> int:
+    return resource.getrusage(who).ru_maxrss * RSS_SCALE
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Timings:
+    """
+    Records spans of the stages of a command
+    """
+
+    def __init__(self, hooks: ta.Iterable[Hook] = ()) -> None:
+        self.hooks = list(hooks)
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, **attributes: ta.Any) -> Iterator[Span]:
+        span = Span(name, attributes, start=time.perf_counter() - self.origin)
+        cpu = time.process_time()
+        thread_cpu = time.thread_time()
+        child_cpu = children_cpu()
+        self_rss = max_rss(resource.RUSAGE_SELF)
+        child_rss = max_rss(resource.RUSAGE_CHILDREN)
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - self.origin - span.start
+            span.cpu = time.process_time() - cpu
+            span.thread_cpu = time.thread_time() - thread_cpu
+            span.children_cpu = children_cpu() - child_cpu
+            span.max_rss_growth = max_rss(resource.RUSAGE_SELF) - self_rss
+            span.children_max_rss_growth = max_rss(resource.RUSAGE_CHILDREN) - child_rss
+            with self.lock:
+                self.spans.append(span)
+            for hook in [*self.hooks, *HOOKS]:
+                hook(span)
+
+    def report(self) -> dict[str, ta.Any]:
+        """
+        All spans, the totals for each stage and the peak resident set sizes of the process
+        and its children so far
+        """
+        with self.lock:
+            spans = list(self.spans)
+        stages: dict[str, dict[str, float]] = {}
+        for span in spans:
+            stage = stages.setdefault(
+                span.name, {"count": 0, "wall": 0, "thread_cpu": 0, "children_cpu": 0}
+            )
+            stage["count"] += 1
+            stage["wall"] += span.wall
+            stage["thread_cpu"] += span.thread_cpu
+            stage["children_cpu"] += span.children_cpu
+        return {
+            "stages": stages,
+            "max_rss": max_rss(resource.RUSAGE_SELF),
+            "children_max_rss": max_rss(resource.RUSAGE_CHILDREN),
+            "spans": [asdict(span) for span in sorted(spans, key=lambda span: span.start)],
+        }
+
+    def write(self, path: pathlib.Path | str) -> None:
+        pathlib.Path(path).write_text(json.dumps(self.report(), indent=2) + "\n")
+
+
+def record_span(
+    timings: Timings | None, name: str, **attributes: ta.Any
+) -> AbstractContextManager[Span | None]:
+    """
+    Record a span if timings is set
+    """
+    if timings is None:
+        return nullcontext()
+    return timings.span(name, **attributes)
@@ -11,6 +11,13 @@ def pytest_addoption(parser):
         default=[],
         help="Mocks to skip when encoding test videos.",
     )
+    parser.addoption(
+        "--detector-backend",
+        choices=["torch", "bf16", "int8", "onnx"],
+        action="append",
+        default=[],
+        help="Detector backends to check against the reference boxes (loads the model and fetches images).",
+    )
 
 
 @pytest.fixture
@@ -0,0 +1,72 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+
+import pytest
+from PIL import Image
+
+from kbai import cli
+from kbai.jobs import JobStatus, StatusLog, job_id, read_manifest
+
+
+def write_manifest(path, specs):
+    path.write_text("".join(json.dumps(spec) + "\n" for spec in specs))
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    manifest.write_text('{"id": "a", "output": "a.mp4"}\n\n{"command": "detect", "image": "b.jpg"}\n')
+    specs = read_manifest(manifest)
+    assert specs == [
+        {"command": "encode", "id": "a", "output": "a.mp4"},
+        {"command": "detect", "image": "b.jpg"},
+    ]
+    assert job_id(specs[0]) == "a"
+    assert job_id(specs[1]) == job_id(dict(specs[1]))
+    assert job_id(specs[1]) != job_id(specs[1] | {"image": "c.jpg"})
+
+
+def test_status_log(tmp_path):
+    status = StatusLog(tmp_path / "status.jsonl")
+    assert status.statuses() == {}
+    status.record("a", JobStatus.RUNNING)
+    status.record("b", JobStatus.RUNNING)
+    status.record("a", JobStatus.SUCCEEDED, result={"output": "a.mp4"})
+    # Partial line from an interrupted batch
+    with open(status.path, "a") as f:
+        f.write('{"id": "b", "sta')
+    assert status.statuses() == {"a": JobStatus.SUCCEEDED, "b": JobStatus.RUNNING}
+
+
+def test_batch_resume(tmp_path, mocker):
+    check_call = mocker.patch("subprocess.check_call")
+    create_detector = mocker.patch("kbai.main.create_detector")
+    Image.new("RGB", (640, 480), "red").save(tmp_path / "a.jpg")
+    manifest = tmp_path / "jobs.jsonl"
+    specs = [
+        {"id": f"job{i}", "no_detect": True, "image": str(tmp_path / "a.jpg"), "output": f"{i}.mp4"}
+        for i in range(3)
+    ]
+    write_manifest(manifest, [*specs, {"id": "bad", "size": "huge"}])
+
+    with pytest.raises(SystemExit):
+        cli.main(["batch", "--workers", "2", str(manifest)])
+    create_detector.assert_not_called()
+    assert check_call.call_count == 3
+    status = StatusLog(tmp_path / "jobs.status.jsonl")
+    assert status.statuses() == {
+        "job0": JobStatus.SUCCEEDED,
+        "job1": JobStatus.SUCCEEDED,
+        "job2": JobStatus.SUCCEEDED,
+        "bad": JobStatus.FAILED,
+    }
+
+    # Completed jobs are skipped
+    check_call.reset_mock()
+    write_manifest(manifest, [*specs, {"id": "job3", "image": str(tmp_path / "a.jpg"), "output": "3.mp4"}])
+    detector = create_detector.return_value
+    detector.detect_stream.side_effect = lambda images, **kwargs: ((image, []) for image, _ in images)
+    cli.main(["batch", str(manifest)])
+    create_detector.assert_called_once()
+    assert check_call.call_count == 1
+    assert status.statuses()["job3"] == JobStatus.SUCCEEDED
@@ -0,0 +1,83 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import pytest
+from PIL import Image
+
+from kbai.cache import DetectionCache, transaction
+from kbai.image import ImageSrc
+from kbai.structs import AnnotatedBox, Size
+
+BOXES = [
+    AnnotatedBox(xmin=10.5, ymin=20.25, xmax=100.0, ymax=200.75, annotation="person"),
+    AnnotatedBox(xmin=1.0, ymin=2.0, xmax=3.0, ymax=4.0, annotation="a dog"),
+]
+
+
+@pytest.fixture
+def image():
+    return Image.new("RGB", (64, 48), "red")
+
+
+def key(image, text="person.", model_id="model", box_threshold=0.5, text_threshold=0.3, original_size=None):
+    digest = ImageSrc(image, "image.jpg", original_size=original_size).digest
+    return DetectionCache.key(digest, text, model_id, box_threshold, text_threshold)
+
+
+def test_roundtrip(tmp_path, image):
+    cache = DetectionCache(tmp_path / "cache.db")
+    assert cache.get(key(image)) is None
+    cache.put(key(image), BOXES)
+    assert cache.get(key(image)) == BOXES
+    # A second instance (e.g. another process) sees the same entries
+    assert DetectionCache(tmp_path / "cache.db").get(key(image)) == BOXES
+
+
+def test_empty_result_is_cached(tmp_path, image):
+    cache = DetectionCache(tmp_path / "cache.db")
+    cache.put(key(image), [])
+    assert cache.get(key(image)) == []
+
+
+def test_key(image):
+    assert key(image) == key(image.copy())
+    assert key(image) != key(Image.new("RGB", (64, 48), "blue"))
+    assert key(image) != key(Image.new("RGB", (48, 64), "red"))
+    assert key(image) != key(image, text="dog.")
+    assert key(image) != key(image, model_id="other")
+    assert key(image) != key(image, box_threshold=0.4)
+    assert key(image) != key(image, text_threshold=0.4)
+    # Boxes are in source coordinates, so sources reduced to the same pixels are cached separately
+    assert key(image, original_size=Size(640, 480)) != key(image, original_size=Size(1280, 960))
+    assert key(image) == key(image, original_size=Size(64, 48))
+
+
+def test_max_age(tmp_path, image, mocker):
+    time_mock = mocker.patch("time.time", return_value=1000.0)
+    cache = DetectionCache(tmp_path / "cache.db", max_age=60)
+    cache.put(key(image), BOXES)
+    time_mock.return_value = 1059.0
+    assert cache.get(key(image)) == BOXES
+    time_mock.return_value = 1061.0
+    assert cache.get(key(image)) is None
+
+
+def test_max_bytes(tmp_path, mocker):
+    time_mock = mocker.patch("time.time", return_value=1000.0)
+    images = [Image.new("L", (8, 8), color) for color in range(4)]
+    cache = DetectionCache(tmp_path / "cache.db")
+    for i, image in enumerate(images[:3]):
+        time_mock.return_value = 1000.0 + i
+        cache.put(key(image), BOXES)
+    # Touch the oldest entry so it is the most recently used
+    time_mock.return_value = 2000.0
+    assert cache.get(key(images[0])) == BOXES
+
+    with transaction(cache.path) as connection:
+        (entry_size,) = connection.execute("SELECT MAX(size) FROM detections").fetchone()
+    cache.max_bytes = 2 * entry_size
+    time_mock.return_value = 2001.0
+    cache.put(key(images[3]), BOXES)
+    assert cache.get(key(images[3])) == BOXES
+    assert cache.get(key(images[0])) == BOXES
+    assert cache.get(key(images[1])) is None
+    assert cache.get(key(images[2])) is None
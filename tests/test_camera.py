@@ -0,0 +1,209 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import dataclasses
+import json
+import math
+import pathlib
+import re
+
+import numpy as np
+import pytest
+
+from kbai.camera import camera_path, sendcmd_filterchain
+from kbai.easings import Easing, ease
+from kbai.encoder import encode, segment_filterchain
+from kbai.structs import AnnotatedBox, Fit, KBImage, Renderer, Size
+from kbai.transitions import Transition
+
+TOKEN = re.compile(r"\s*(?:(\d+\.?\d*)|([A-Za-z_]\w*)|(.))")
+
+FUNCTIONS = {
+    "lt": lambda a, b: float(a < b),
+    "lte": lambda a, b: float(a <= b),
+    "gte": lambda a, b: float(a >= b),
+    "cos": math.cos,
+    "sin": math.sin,
+    "sqrt": math.sqrt,
+    "pow": math.pow,
+    "clip": lambda x, lo, hi: min(max(x, lo), hi),
+    "lerp": lambda a, b, t: a + (b - a) * t,
+}
+
+
+class Expression:
+    """
+    Evaluates the subset of ffmpeg expressions used by zoompan and the easings
+    """
+
+    def __init__(self, expression):
+        self.tokens = [m.group(1) or m.group(2) or m.group(3) for m in TOKEN.finditer(expression.strip())]
+        self.position = 0
+        self.node = self.parse_expr()
+        assert self.peek() is None, expression
+
+    def __call__(self, **variables):
+        return self.node({"PI": math.pi, **variables}, [0.0] * 10)
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        assert expected is None or token == expected, (token, expected)
+        self.position += 1
+        return token
+
+    def binary(self, operand, operators):
+        node = operand()
+        while self.peek() in operators:
+            op, left, right = operators[self.take()], node, operand()
+            node = lambda v, r, op=op, left=left, right=right: op(left(v, r), right(v, r))  # noqa: E731
+        return node
+
+    def parse_expr(self):
+        return self.binary(self.parse_sum, {";": lambda a, b: b})
+
+    def parse_sum(self):
+        return self.binary(self.parse_term, {"+": lambda a, b: a + b, "-": lambda a, b: a - b})
+
+    def parse_term(self):
+        return self.binary(self.parse_power, {"*": lambda a, b: a * b, "/": lambda a, b: a / b})
+
+    def parse_power(self):
+        return self.binary(self.parse_unary, {"^": math.pow})
+
+    def parse_unary(self):
+        if self.peek() == "-":
+            self.take()
+            operand = self.parse_unary()
+            return lambda v, r: -operand(v, r)
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.take()
+        if token == "(":
+            node = self.parse_expr()
+            self.take(")")
+            return node
+        if token[0].isdigit():
+            return lambda v, r: float(token)
+        if self.peek() != "(":
+            return lambda v, r: v[token]
+        self.take("(")
+        args = [self.parse_expr()]
+        while self.peek() == ",":
+            self.take()
+            args.append(self.parse_expr())
+        self.take(")")
+        if token == "st":
+            return lambda v, r: r.__setitem__(int(args[0](v, r)), args[1](v, r)) or r[int(args[0](v, r))]
+        if token == "ld":
+            return lambda v, r: r[int(args[0](v, r))]
+        if token == "if":
+            # Only the branch taken is evaluated, like ffmpeg
+            return lambda v, r: args[1](v, r) if args[0](v, r) else args[2](v, r)
+        return lambda v, r: FUNCTIONS[token](*(arg(v, r) for arg in args))
+
+
+def kbimage(fit=Fit.COVER, easing=Easing.CUBIC_IN_OUT):
+    return KBImage(
+        "image.jpg",
+        Size(1280, 960),
+        fit=fit,
+        boxes=[AnnotatedBox(400, 300, 720, 480, "thing")],
+        duration=3,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=easing,
+    )
+
+
+@pytest.mark.parametrize("easing", list(Easing))
+def test_easings_match_ffmpeg(easing):
+    # ffmpeg stores the eased time in variable 0
+    expression = Expression(f"st(0, t);{easing.value};ld(0)")
+    times = np.linspace(0, 1, 101)
+    expected = [expression(t=t) for t in times]
+    assert ease(easing, times) == pytest.approx(expected, abs=1e-9)
+
+
+@pytest.mark.parametrize("fit", list(Fit))
+@pytest.mark.parametrize("easing", [Easing.LINEAR, Easing.CUBIC_IN_OUT, Easing.BACK_OUT])
+def test_camera_path_matches_zoompan(fit, easing):
+    image = kbimage(fit, easing)
+    encode_size = Size(640, 360)
+    path = camera_path(image, encode_size, 25)
+    assert len(path) == 75
+
+    (zoompan,) = [
+        f for f in segment_filterchain(image, "0", encode_size, 25).filters if f.name == "zoompan"
+    ]
+    z, x, y = (Expression(zoompan.options[name]) for name in ("z", "x", "y"))
+    for frame in range(len(path)):
+        zoom = z(time=frame / 25)
+        assert path.zoom[frame] == pytest.approx(zoom)
+        variables = {"iw": path.size.width, "ih": path.size.height, "zoom": zoom}
+        assert path.x[frame] == pytest.approx(
+            min(max(x(**variables), 0), path.size.width - path.size.width / zoom)
+        )
+        assert path.y[frame] == pytest.approx(
+            min(max(y(**variables), 0), path.size.height - path.size.height / zoom)
+        )
+
+
+def test_camera_path_export(tmp_path):
+    image = kbimage()
+    path = camera_path(image, Size(640, 360), 25)
+    path.write_json(tmp_path / "camera.json")
+    exported = json.loads((tmp_path / "camera.json").read_text())
+    assert exported["fps"] == 25
+    assert len(exported["zoom"]) == len(exported["x"]) == len(exported["y"]) == 75
+
+    script = tmp_path / "camera.txt"
+    filterchain = sendcmd_filterchain(image, "0", Size(640, 360), 25, script)
+    assert str(filterchain) == (
+        f"[0]sendcmd=f={script},scale@camera=w=640:h=480,crop@camera=w=640:h=360,setsar=sar=1"
+    )
+    commands = script.read_text().splitlines()
+    assert len(commands) == 75
+    assert (
+        commands[0]
+        == "0.000000 scale@camera w 640, scale@camera h 480, crop@camera x 0.000, crop@camera y 60.000;"
+    )
+    # Zoomed in on the box by the last frame
+    last = commands[-1].split()
+    assert int(last[3].rstrip(",")) > 640 * 3
+
+
+def test_encode_sendcmd(mocker, tmp_path):
+    scripts = []
+
+    def check_call_side_effect(command):
+        if "-loop" in command:
+            graph = command[command.index("-filter_complex") + 1]
+            scripts.append(pathlib.Path(re.match(r"\[0\]sendcmd=f=([^,]+),", graph).group(1)).read_text())
+
+    ffmpeg_mock = mocker.patch("subprocess.check_call", side_effect=check_call_side_effect)
+    encode(Size(640, 360), 25, [kbimage(), kbimage()], tmp_path / "out.mp4", renderer=Renderer.SENDCMD)
+
+    commands = [call.args[0] for call in ffmpeg_mock.call_args_list]
+    assert len(commands) == 3
+    for command in commands[:2]:
+        assert command[command.index("-loop") + 1] == "1"
+        assert command[command.index("-i") + 1] == "image.jpg"
+    assert [len(script.splitlines()) for script in scripts] == [75, 75]
+    # The scripts are removed once rendered
+    assert not list(tmp_path.rglob("*.sendcmd"))
+
+
+def test_encode_sendcmd_preview(mocker, tmp_path):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    # Without a zoom target only a quarter of the source resolution is needed
+    image = dataclasses.replace(kbimage(), boxes=[])
+    encode(
+        Size(320, 180), 10, [image, image], tmp_path / "out.mp4", renderer=Renderer.SENDCMD, preview=True
+    )
+    for command in [call.args[0] for call in ffmpeg_mock.call_args_list][:2]:
+        # Decoded at reduced scale, with fast scaling
+        assert command[command.index("-lowres") + 1] == "2"
+        assert command[command.index("-filter_complex") + 1].startswith("sws_flags=fast_bilinear;")
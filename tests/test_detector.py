@@ -0,0 +1,147 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import numpy as np
+from PIL import Image
+from test_encoder import IMAGES
+
+from kbai.image import DETECTION_EDGES, ImageSrc, load_images
+from kbai.structs import AnnotatedBox, DetectorBackend, Size
+
+
+def pytest_generate_tests(metafunc):
+    # Only run when backends are requested, e.g. pytest --detector-backend int8
+    if "backend" in metafunc.fixturenames:
+        metafunc.parametrize("backend", metafunc.config.getoption("--detector-backend"))
+
+
+def iou(a, b):
+    width = min(a.xmax, b.xmax) - max(a.xmin, b.xmin)
+    height = min(a.ymax, b.ymax) - max(a.ymin, b.ymin)
+    if width <= 0 or height <= 0:
+        return 0
+    intersection = width * height
+    return intersection / (a.size.width * a.size.height + b.size.width * b.size.height - intersection)
+
+
+def test_backend_agreement(backend):
+    from kbai.detector import Detector
+
+    detector = Detector(backend=DetectorBackend(backend))
+    images = load_images(list(IMAGES), edges=DETECTION_EDGES)
+    results = detector.detect_many(images, [image["features"] for image in IMAGES.values()])
+    for (src, image), boxes in zip(IMAGES.items(), results, strict=True):
+        assert len(boxes) == len(image["boxes"]), src
+        for expected in image["boxes"]:
+            assert (
+                max(iou(expected, box) for box in boxes if box.annotation == expected.annotation) > 0.9
+            ), src
+
+
+def test_detect_stream_repeated(mocker):
+    from kbai.detector import Detector
+
+    detector = Detector.__new__(Detector)
+    detected = []
+
+    def detect_many(images, features, **kwargs):
+        pairs = list(zip(images, features, strict=True))
+        detected.extend(image.src for image, image_features in pairs if image_features)
+        return [[AnnotatedBox(0, 0, 10, 10, image.src)] if f else [] for image, f in pairs]
+
+    mocker.patch.object(detector, "detect_many", side_effect=detect_many)
+    colors = {"logo.png": "red", "a.jpg": "green", "b.jpg": "blue"}
+    srcs = ["logo.png", "a.jpg", "logo.png", "b.jpg", "logo.png"]
+    images = [ImageSrc(Image.new("RGB", (64, 48), colors[src]), src) for src in srcs]
+    results = list(detector.detect_stream(((image, ["a logo"]) for image in images), batch_size=1))
+    # Repeats in later batches reuse the boxes of the first
+    assert detected == ["logo.png", "a.jpg", "b.jpg"]
+    assert [image.src for image, _ in results] == srcs
+    assert [boxes[0].annotation for _, boxes in results] == srcs
+
+
+def test_model_revision():
+    from kbai.detector import Detector
+
+    detector = Detector.__new__(Detector)
+    detector.backend = DetectorBackend.ONNX
+    assert detector.cache_model_id == "IDEA-Research/grounding-dino-tiny@onnx"
+    assert detector.onnx_path.name == "IDEA-Research--grounding-dino-tiny.onnx"
+    # Each installed revision gets its own cache entries and ONNX export
+    detector.revision = "abc123"
+    assert detector.cache_model_id == "IDEA-Research/grounding-dino-tiny@abc123@onnx"
+    assert detector.onnx_path.name == "IDEA-Research--grounding-dino-tiny@abc123.onnx"
+
+
+def test_bf16_supported(mocker):
+    from kbai.detector import bf16_supported
+
+    torch = mocker.patch("kbai.detector.torch")
+    cpu = mocker.Mock(type="cpu")
+    torch.backends.mkldnn.is_available.return_value = True
+    torch.ops.mkldnn._is_mkldnn_bf16_supported.return_value = True
+    assert bf16_supported(cpu)
+    # The private op is not available in every torch version
+    del torch.ops.mkldnn._is_mkldnn_bf16_supported
+    assert not bf16_supported(cpu)
+    torch.backends.mkldnn.is_available.return_value = False
+    assert not bf16_supported(cpu)
+
+
+def stub_detector(mocker):
+    """
+    Detector with a stubbed processor and model, whose boxes cover the middle of each image
+    """
+    from kbai.detector import Detector
+
+    detector = Detector.__new__(Detector)
+    detector.cache = None
+    detector.device = "cpu"
+    detector.processor = mocker.MagicMock()
+    detector.processor.image_processor.size = {"shortest_edge": 800, "longest_edge": 1333}
+
+    def post_process(outputs, input_ids, target_sizes, **kwargs):
+        return [
+            {
+                "boxes": np.array([[width / 4, height / 4, width * 3 / 4, height * 3 / 4]]),
+                "labels": ["thing"],
+            }
+            for height, width in target_sizes
+        ]
+
+    detector.processor.post_process_grounded_object_detection.side_effect = post_process
+    mocker.patch.object(detector, "_forward")
+    return detector
+
+
+def test_batches(mocker):
+    detector = stub_detector(mocker)
+    images = [ImageSrc(Image.new("RGB", size), "image.jpg") for size in [(640, 480)] * 5 + [(480, 640)]]
+    assert list(detector._batches(range(6), images, 2, None)) == [[0, 1], [2, 3], [4, 5]]
+    assert list(detector._batches(range(6), images, 8, None)) == [[0, 1, 2, 3, 4, 5]]
+    # Landscape images are processed to 1067x800
+    assert list(detector._batches(range(6), images, 8, 3 * 1067 * 800)) == [[0, 1, 2], [3, 4], [5]]
+    # Padded to the largest width and height in the batch, a 1067x1067 batch with the portrait image
+    assert list(detector._batches([4, 5], images, 8, 2 * 1067 * 1067 - 1)) == [[4], [5]]
+    assert list(detector._batches([4, 5], images, 8, 2 * 1067 * 1067)) == [[4, 5]]
+
+
+def test_detect_many_batches(mocker):
+    detector = stub_detector(mocker)
+    images = [
+        ImageSrc(Image.new("RGB", (640, 480), "red"), "a.jpg"),
+        ImageSrc(Image.new("RGB", (480, 640), "green"), "b.jpg"),
+        # Decoded at a reduced scale
+        ImageSrc(Image.new("RGB", (320, 240), "blue"), "c.jpg", original_size=Size(1280, 960)),
+        ImageSrc(Image.new("RGB", (200, 100), "white"), "d.jpg"),
+    ]
+    results = detector.detect_many(images, [["thing"], ["thing"], [], ["thing"]], batch_size=2)
+    assert detector._forward.call_count == 2
+    batches = [call.kwargs["images"] for call in detector.processor.call_args_list]
+    assert batches == [[images[0].image, images[1].image], [images[3].image]]
+    # Boxes are in each image's own source coordinates, in input order
+    assert results == [
+        [AnnotatedBox(160, 120, 480, 360, "thing")],
+        [AnnotatedBox(120, 160, 360, 480, "thing")],
+        [],
+        [AnnotatedBox(50, 25, 150, 75, "thing")],
+    ]
@@ -1,11 +1,20 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
+import pathlib
+import subprocess
+import sys
+
 import pytest
+from PIL import Image
 
 from kbai import cli
+from kbai.cache import SegmentCache
 from kbai.detector import Detector
+from kbai.easings import Easing
+from kbai.encoder import build_filtergraph, chunk_ranges, encode, preview_settings
 from kbai.image import ImageSrc
-from kbai.structs import AnnotatedBox, Size
+from kbai.structs import AnnotatedBox, Fit, KBImage, OutputFormat, Size
+from kbai.transitions import Transition
 
 IMAGES = {
     # Person 4x3
@@ -157,6 +166,24 @@ IMAGES = {
     },
 }
 
+
+def kbimage(src, size=None, duration=3, **kwargs):
+    """
+    A cover image without boxes, fading into the next
+    """
+    return KBImage(
+        src,
+        size or Size(640, 480),
+        fit=Fit.COVER,
+        boxes=[],
+        duration=duration,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=Easing.LINEAR,
+        **kwargs,
+    )
+
+
 encode_testdata = {
     "single_cover_4x3_to_16x9": (
         [
@@ -178,7 +205,7 @@ encode_testdata = {
             "-i",
             "https://picsum.photos/id/22/1280/960",
             "-filter_complex",
-            "[0]zoompan=z='st(0, clip(time / 5, 0, 1));"
+            "[0]scale=w=1047:h=785,zoompan=z='st(0, clip(time / 5, 0, 1));"
             "st(0, if(lt(ld(0), 0.5), 4 * ld(0)^3, 1 - 4 * (1-ld(0))^3));"
             "lerp(1, 1.6363636363636365, ld(0))':"
             "x=(iw+iw*0.15547246932983394)/2-(iw/zoom/2):"
@@ -269,7 +296,7 @@ encode_testdata = {
             ":x=(iw+iw*-0.11581172943115237)/2-(iw/zoom/2)"
             ":y=(ih+ih*0.3028771082560222)/2-(ih/zoom/2):s=640x480:fps=25:d=50.0,setsar=sar=1[pz1];"
             "[pz0][pz1]xfade=transition=fade:duration=1:offset=4[xf1];"
-            "[2]zoompan=z='st(0, clip(time / 7.0, 0, 1));"
+            "[2]scale=w=1187:h=890,zoompan=z='st(0, clip(time / 7.0, 0, 1));"
             "st(0, if(lt(ld(0), 0.5), 4 * ld(0)^3, 1 - 4 * (1-ld(0))^3));lerp(1, 1.855072463768116, ld(0))'"
             ":x=(iw+iw*0.19238944053649898)/2-(iw/zoom/2)"
             ":y=(ih+ih*-0.5645016670227051)/2-(ih/zoom/2):s=640x480:fps=25:d=175.0,setsar=sar=1[pz2];"
@@ -311,22 +338,26 @@ encode_testdata = {
 def test_encode(skip_mocks, mocker, kbai_args, expected_ffmpeg_args):
     if "image" not in skip_mocks:
 
-        def load_image_side_effect(src):
-            image = mocker.Mock(size=IMAGES[src])
-            return ImageSrc(image, src)
+        def load_image_side_effect(src, **kwargs):
+            size = IMAGES[src]["size"]
+            # Real images, detection hashes their pixels
+            return ImageSrc(Image.new("RGB", (size.width, size.height)), src)
 
         load_image_mock = mocker.patch("kbai.image.load_image")
         load_image_mock.side_effect = load_image_side_effect
 
     if "detect" not in skip_mocks:
 
-        def detect_side_effect(image_src, features):
-            image = IMAGES[image_src.src]
-            assert image["features"] == features
-            return image["boxes"]
+        def detect_many_side_effect(image_srcs, features_list, **kwargs):
+            results = []
+            for image_src, features in zip(image_srcs, features_list, strict=True):
+                image = IMAGES[image_src.src]
+                assert image["features"] == features
+                results.append(image["boxes"])
+            return results
 
-        detect_mock = mocker.patch.object(Detector, "detect")
-        detect_mock.side_effect = detect_side_effect
+        detect_mock = mocker.patch.object(Detector, "detect_many")
+        detect_mock.side_effect = detect_many_side_effect
 
     if "encode" not in skip_mocks:
         ffmpeg_mock = mocker.patch("subprocess.check_call")
@@ -337,3 +368,308 @@ def test_encode(skip_mocks, mocker, kbai_args, expected_ffmpeg_args):
 
     if ffmpeg_mock is not None:
         ffmpeg_mock.assert_called_once_with(expected_ffmpeg_args)
+
+
+def test_encode_fetched_data(mocker, tmp_path):
+    def check_call_side_effect(command):
+        inputs = [command[i + 1] for i, arg in enumerate(command) if arg == "-i"]
+        assert [pathlib.Path(path).read_bytes() for path in inputs] == [b"image0", b"image1"]
+        assert [pathlib.Path(path).suffix for path in inputs] == [".jpg", ""]
+
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    ffmpeg_mock.side_effect = check_call_side_effect
+    kbimages = [
+        KBImage(
+            src,
+            Size(1280, 960),
+            fit=Fit.COVER,
+            boxes=[AnnotatedBox(100, 100, 200, 200, "thing")],
+            duration=2,
+            transition_duration=1,
+            transition=Transition.FADE,
+            transition_easing=Easing.LINEAR,
+            data=data,
+        )
+        for src, data in [
+            ("https://example.com/image.jpg?w=1280", b"image0"),
+            ("https://example.com/1", b"image1"),
+        ]
+    ]
+    encode(Size(640, 480), 25, kbimages, tmp_path / "out.mp4")
+    ffmpeg_mock.assert_called_once()
+
+
+def test_filtergraph_without_boxes():
+    kbimages = [
+        KBImage(
+            f"image{i}.jpg",
+            Size(6000, 4000),
+            fit=fit,
+            boxes=[],
+            duration=2,
+            transition_duration=1,
+            transition=Transition.FADE,
+            transition_easing=Easing.LINEAR,
+        )
+        for i, fit in enumerate([Fit.COVER, Fit.CONTAIN])
+    ]
+    assert str(build_filtergraph(Size(640, 360), 25, kbimages)) == (
+        "[0]scale=w=640:h=427,zoompan=z=1:x=(iw+iw*0)/2-(iw/zoom/2):y=(ih+ih*0)/2-(ih/zoom/2)"
+        ":s=640x427:fps=25:d=50,crop=w=640:h=360,setsar=sar=1[pz0];"
+        "[1]scale=w=540:h=360,pad=w=640:h=360:x=-1:y=-1,zoompan=z=1"
+        ":x=(iw+iw*0)/2-(iw/zoom/2):y=(ih+ih*0)/2-(ih/zoom/2):s=640x360:fps=25:d=50,setsar=sar=1[pz1];"
+        "[pz0][pz1]xfade=transition=fade:duration=1:offset=1"
+    )
+
+
+def test_encode_repeated_sources(mocker):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    kbimages = [
+        kbimage(src, duration=2) for src in ["logo.png", "image1.jpg", "logo.png", "image2.jpg", "logo.png"]
+    ]
+    encode(Size(640, 480), 25, kbimages, "out.mp4")
+    command = ffmpeg_mock.call_args.args[0]
+    # Each source is decoded once and split
+    assert [command[i + 1] for i, arg in enumerate(command) if arg == "-i"] == [
+        "logo.png",
+        "image1.jpg",
+        "image2.jpg",
+    ]
+    filtergraph = command[command.index("-filter_complex") + 1]
+    assert filtergraph.startswith("[0]split=outputs=3[sp0][sp2][sp4];[sp0]zoompan")
+    assert ";[1]zoompan" in filtergraph
+    assert ";[sp2]zoompan" in filtergraph
+    assert ";[2]zoompan" in filtergraph
+    assert ";[sp4]zoompan" in filtergraph
+
+
+def test_encode_segments(mocker, tmp_path):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    kbimages = [kbimage(f"image{i}.jpg") for i in range(3)]
+    encode(Size(640, 480), 25, kbimages, tmp_path / "out.mp4", jobs=2)
+
+    commands = [call.args[0] for call in ffmpeg_mock.call_args_list]
+    assert len(commands) == 4
+    segments = []
+    for i, command in enumerate(commands[:3]):
+        assert command[command.index("-i") + 1] == f"image{i}.jpg"
+        assert command[command.index("-filter_complex") + 1].startswith("[0]zoompan=z=1:")
+        segments.append(command[-1])
+    stitch = commands[3]
+    assert [stitch[i + 1] for i, arg in enumerate(stitch) if arg == "-i"] == segments
+    assert stitch[stitch.index("-filter_complex") + 1] == (
+        "[0][1]xfade=transition=fade:duration=1:offset=2[xf1];[xf1][2]xfade=transition=fade:duration=1:offset=4"
+    )
+    assert stitch[-1] == str(tmp_path / "out.mp4")
+
+
+def test_encode_segment_cache(mocker, tmp_path):
+    def check_call_side_effect(command):
+        pathlib.Path(command[-1]).write_bytes(b"segment")
+
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    ffmpeg_mock.side_effect = check_call_side_effect
+    cache = SegmentCache(tmp_path / "segments")
+
+    def kbimages(data):
+        return [
+            kbimage(f"https://example.com/image{i}.jpg", data=image_data)
+            for i, image_data in enumerate(data)
+        ]
+
+    encode(Size(640, 480), 25, kbimages([b"a", b"b", b"c"]), tmp_path / "out.mp4", segment_cache=cache)
+    assert len(ffmpeg_mock.call_args_list) == 4
+    stitch = ffmpeg_mock.call_args.args[0]
+    segments = [stitch[i + 1] for i, arg in enumerate(stitch) if arg == "-i"]
+    assert all(pathlib.Path(segment).parent == cache.segments for segment in segments)
+
+    # Only the changed image is rendered again
+    ffmpeg_mock.reset_mock()
+    encode(Size(640, 480), 25, kbimages([b"a", b"x", b"c"]), tmp_path / "out.mp4", segment_cache=cache)
+    assert len(ffmpeg_mock.call_args_list) == 2
+    stitch = ffmpeg_mock.call_args.args[0]
+    new_segments = [stitch[i + 1] for i, arg in enumerate(stitch) if arg == "-i"]
+    assert new_segments[0] == segments[0]
+    assert new_segments[1] != segments[1]
+    assert new_segments[2] == segments[2]
+
+
+def test_encode_segment_cache_evict(mocker, tmp_path):
+    def check_call_side_effect(command):
+        # The stitch needs every segment of the encode
+        for i, arg in enumerate(command):
+            if arg == "-i" and command[i + 1].endswith(".mkv"):
+                assert pathlib.Path(command[i + 1]).exists()
+        pathlib.Path(command[-1]).write_bytes(b"segment!")
+
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    ffmpeg_mock.side_effect = check_call_side_effect
+    cache = SegmentCache(tmp_path / "segments", max_bytes=10)
+    kbimages = [kbimage(f"image{i}.jpg", data=bytes([i])) for i in range(3)]
+    encode(Size(640, 480), 25, kbimages, tmp_path / "out.mp4", segment_cache=cache)
+    assert len(ffmpeg_mock.call_args_list) == 4
+    # Evicted after the stitch
+    cache.evict()
+    assert len(list(cache.segments.iterdir())) == 1
+
+
+def test_encode_segment_cache_url(mocker, tmp_path):
+    def check_call_side_effect(command):
+        pathlib.Path(command[-1]).write_bytes(b"segment")
+
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    ffmpeg_mock.side_effect = check_call_side_effect
+    get = mocker.patch("httpx.get")
+    cache = SegmentCache(tmp_path / "segments")
+    image = kbimage("https://example.com/image.jpg")
+    get.return_value.content = b"a"
+    encode(Size(640, 480), 25, [image], tmp_path / "out.mp4", segment_cache=cache)
+    encode(Size(640, 480), 25, [image], tmp_path / "out.mp4", segment_cache=cache)
+    assert len(ffmpeg_mock.call_args_list) == 3
+    # A different image behind the same URL is rendered again
+    get.return_value.content = b"b"
+    encode(Size(640, 480), 25, [image], tmp_path / "out.mp4", segment_cache=cache)
+    assert len(ffmpeg_mock.call_args_list) == 5
+
+
+def test_encode_chunks(mocker, tmp_path):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    kbimages = [kbimage(f"image{i}.jpg", duration=3 + i % 2) for i in range(6)]
+    chunks = chunk_ranges(kbimages, 25, 2)
+    # Chunks share their last image with the next chunk, and are cut after the transition into it
+    assert chunks == [(0, 2, 0, 150), (2, 4, 25, 150), (4, 5, 25, None)]
+
+    encode(Size(640, 480), 25, kbimages, tmp_path / "out.mp4", chunk_size=2)
+    commands = [call.args[0] for call in ffmpeg_mock.call_args_list]
+    assert len(commands) == 4
+    for command, (first, last, _, _) in zip(commands, chunks, strict=False):
+        assert [command[i + 1] for i, arg in enumerate(command) if arg == "-i"] == [
+            f"image{i}.jpg" for i in range(first, last + 1)
+        ]
+    assert commands[1][commands[1].index("-filter_complex") + 1].endswith(
+        "xfade=transition=fade:duration=1:offset=5,trim=start_frame=25:end_frame=150,setpts=expr=PTS-STARTPTS"
+    )
+    concat = commands[3]
+    assert concat[concat.index("-f") + 1] == "concat"
+    assert concat[-1] == str(tmp_path / "out.mp4")
+
+
+def test_chunk_ranges_invalid():
+    with pytest.raises(AssertionError):
+        chunk_ranges([], 25, 0)
+
+
+def test_encode_image_list(mocker, tmp_path):
+    encode_main_mock = mocker.patch("kbai.cli.encode_main")
+    image_list = tmp_path / "images.txt"
+    image_list.write_text("# images\nimage0.jpg /id 3 /ft 'a dog'\n\nimage1.jpg\n")
+    cli.main(["encode", "--image-list", str(image_list), "-o", "out.mp4"])
+    assert encode_main_mock.call_args.args[0].image == [
+        {"image": "image0.jpg", "image_duration": 3, "feature_text": ["a dog"]},
+        {"image": "image1.jpg"},
+    ]
+
+    image_list.write_text("image0.jpg /ft 'a dog\n")
+    with pytest.raises(SystemExit):
+        cli.main(["encode", "--image-list", str(image_list), "-o", "out.mp4"])
+    with pytest.raises(SystemExit):
+        cli.main(["encode", "-i", "image0.jpg", "--chunk-size", "0", "-o", "out.mp4"])
+
+
+def test_encode_precomputed_boxes(mocker):
+    def load_image_side_effect(src, **kwargs):
+        return ImageSrc(Image.new("RGB", (1280, 960)), src)
+
+    mocker.patch("kbai.image.load_image").side_effect = load_image_side_effect
+    create_detector_mock = mocker.patch("kbai.main.create_detector")
+    encode_mock = mocker.patch("kbai.main.encode")
+
+    cli.main(
+        [
+            "encode",
+            "--no-detect",
+            "-i",
+            "image0.jpg",
+            "/bx",
+            "100,200,300,400.5,a dog",
+            "/bx",
+            "10,20,30,40",
+            "-i",
+            "image1.jpg",
+            "-o",
+            "out.mp4",
+        ]
+    )
+
+    create_detector_mock.assert_not_called()
+    kbimages = encode_mock.call_args.args[2]
+    assert kbimages[0].boxes == [
+        AnnotatedBox(100, 200, 300, 400.5, "a dog"),
+        AnnotatedBox(10, 20, 30, 40, ""),
+    ]
+    assert kbimages[1].boxes == []
+
+
+def test_cli_imports_without_torch():
+    # The CLI must not import the detection model dependencies until they are needed
+    code = "import sys, kbai.cli; assert 'torch' not in sys.modules and 'transformers' not in sys.modules"
+    subprocess.check_call([sys.executable, "-c", code])
+
+
+def test_encode_streaming_formats(mocker, tmp_path):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    kbimages = [kbimage(f"image{i}.jpg", Size(1280, 960), duration) for i, duration in enumerate([5, 4, 5])]
+
+    encode(Size(640, 480), 25, kbimages, "-", output_format=OutputFormat.FMP4)
+    command = ffmpeg_mock.call_args.args[0]
+    assert command[command.index("-force_key_frames") + 1] == "4,5,7,8"
+    assert command[-6:] == [
+        "-movflags",
+        "frag_keyframe+empty_moov+default_base_moof",
+        "-f",
+        "mp4",
+        "-y",
+        "pipe:1",
+    ]
+
+    encode(Size(640, 480), 25, kbimages, tmp_path / "out.m3u8", output_format=OutputFormat.HLS)
+    command = ffmpeg_mock.call_args.args[0]
+    assert command[command.index("-force_key_frames") + 1] == "4,5,7,8"
+    assert command[command.index("-f") + 1] == "hls"
+    assert command[command.index("-hls_segment_filename") + 1] == str(tmp_path / "out_%03d.m4s")
+    assert command[-1] == str(tmp_path / "out.m3u8")
+
+
+def test_encode_preview(mocker):
+    ffmpeg_mock = mocker.patch("subprocess.check_call")
+    kbimages = [
+        kbimage(src, size) for src, size in [("large.jpg", Size(4000, 3000)), ("small.jpg", Size(640, 480))]
+    ]
+    size, fps = preview_settings(Size(1280, 720), 25)
+    assert (size, fps) == (Size(320, 180), 10)
+    encode(size, fps, kbimages, "out.mp4", preview=True)
+    command = ffmpeg_mock.call_args.args[0]
+    # JPEGs are decoded at the smallest scale still at least as large as the segment needs
+    assert command[command.index("-lowres") : command.index("-filter_complex")] == [
+        "-lowres",
+        "3",
+        "-i",
+        "large.jpg",
+        "-lowres",
+        "1",
+        "-i",
+        "small.jpg",
+    ]
+    assert command[command.index("-filter_complex") + 1].startswith("sws_flags=fast_bilinear;[0]")
+    assert command[-10:] == [
+        "-r",
+        "10",
+        "-s",
+        "320x180",
+        "-pix_fmt",
+        "yuv420p",
+        "-preset",
+        "ultrafast",
+        "-y",
+        "out.mp4",
+    ]
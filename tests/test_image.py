@@ -0,0 +1,52 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import pytest
+from PIL import Image
+
+from kbai.image import DETECTION_EDGES, image_stream, load_image, load_images
+from kbai.structs import Size
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_load_image_reduced(tmp_path, image_format):
+    path = tmp_path / f"image.{image_format.lower()}"
+    Image.new("RGB", (6000, 4000), "red").save(path, image_format)
+
+    image = load_image(str(path), edges=DETECTION_EDGES)
+    assert image.size == Size(6000, 4000)
+    # Reduced, but still at least as large as the detection model needs
+    assert 800 <= image.image.height < 2000
+    assert image.image.width / image.image.height == pytest.approx(1.5, abs=0.01)
+
+    image = load_image(str(path))
+    assert image.size == Size(6000, 4000)
+    assert image.image.size == (6000, 4000)
+
+
+def test_load_image_small(tmp_path):
+    path = tmp_path / "image.jpg"
+    Image.new("RGB", (640, 480), "red").save(path)
+    image = load_image(str(path), edges=DETECTION_EDGES)
+    assert image.size == Size(640, 480)
+    assert image.image.size == (640, 480)
+
+
+def test_load_images_repeated(mocker):
+    load_image_mock = mocker.patch("kbai.image.load_image")
+    load_image_mock.side_effect = lambda src, **kwargs: mocker.Mock(src=src)
+    images = load_images(["a.jpg", "b.jpg", "a.jpg"])
+    assert [call.args[0] for call in load_image_mock.call_args_list] == ["a.jpg", "b.jpg"]
+    assert images[0] is images[2]
+    assert images[1].src == "b.jpg"
+
+
+def test_image_stream_lookahead(mocker):
+    load_image_mock = mocker.patch("kbai.image.load_image")
+    load_image_mock.side_effect = lambda src, **kwargs: mocker.Mock(src=src)
+    srcs = [f"{i}.jpg" for i in range(10)]
+    with image_stream(srcs, concurrency=2, lookahead=3) as images:
+        first = next(images)
+        # Only loads up to lookahead images ahead of the consumer
+        assert load_image_mock.call_count <= 4
+        rest = list(images)
+    assert [image.src for image in [first, *rest]] == srcs
@@ -0,0 +1,74 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+
+import pytest
+
+from kbai import cli
+from kbai.models import MANIFEST, ModelError, install_model, verify_model
+
+
+def mock_pretrained(mocker):
+    def save_pretrained(name, content):
+        return lambda path, **kwargs: (path / name).write_text(content)
+
+    processor = mocker.patch("transformers.AutoProcessor").from_pretrained.return_value
+    processor.save_pretrained.side_effect = save_pretrained("preprocessor_config.json", "{}")
+    model = mocker.patch("transformers.AutoModelForZeroShotObjectDetection").from_pretrained.return_value
+    model.save_pretrained.side_effect = save_pretrained("model.safetensors", "weights")
+    model.config._commit_hash = "abc123"
+    return model
+
+
+def test_install_model(tmp_path, mocker):
+    model = mock_pretrained(mocker)
+    path = tmp_path / "model"
+    manifest = install_model(path, "org/model")
+    model.save_pretrained.assert_called_once()
+    assert model.save_pretrained.call_args.kwargs["safe_serialization"]
+    assert manifest["model_id"] == "org/model"
+    assert manifest["revision"] == "abc123"
+    assert sorted(manifest["files"]) == ["model.safetensors", "preprocessor_config.json"]
+    assert json.loads((path / MANIFEST).read_text()) == manifest
+    assert verify_model(path) == manifest
+    # Only the installed directory is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["model"]
+
+    # Reinstalling replaces the previous install
+    (path / "stale.bin").write_text("stale")
+    model.config._commit_hash = "def456"
+    assert install_model(path, "org/model")["revision"] == "def456"
+    assert not (path / "stale.bin").exists()
+    assert verify_model(path)["revision"] == "def456"
+    assert [p.name for p in tmp_path.iterdir()] == ["model"]
+
+    # A failed install keeps the previous one
+    model.save_pretrained.side_effect = OSError("disk full")
+    with pytest.raises(OSError, match="disk full"):
+        install_model(path, "org/model")
+    assert verify_model(path)["revision"] == "def456"
+    assert [p.name for p in tmp_path.iterdir()] == ["model"]
+
+    (path / "model.safetensors").write_text("truncated")
+    with pytest.raises(ModelError, match="checksum mismatch"):
+        verify_model(path)
+    (path / "model.safetensors").unlink()
+    with pytest.raises(ModelError):
+        verify_model(path)
+    with pytest.raises(ModelError):
+        verify_model(tmp_path / "missing")
+
+
+def test_warmup(tmp_path, mocker):
+    mock_pretrained(mocker)
+    create_detector = mocker.patch("kbai.main.create_detector")
+    install = mocker.patch("kbai.main.install_model", wraps=install_model)
+    path = tmp_path / "model"
+    cli.main(["warmup", "--model-dir", str(path)])
+    # Already installed and verified
+    cli.main(["warmup", "--model-dir", str(path)])
+    install.assert_called_once()
+    assert verify_model(path)["model_id"] == "IDEA-Research/grounding-dino-tiny"
+    assert create_detector.call_count == 2
+    assert create_detector.call_args.args[0].model_dir == path
+    assert create_detector.return_value.detect.call_count == 2
@@ -0,0 +1,83 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import pytest
+
+from kbai.encoder import run_ffmpeg
+from kbai.progress import Progress, parse_progress
+
+PROGRESS_OUTPUT = """\
+frame=0
+fps=0.00
+out_time_us=N/A
+speed=N/A
+progress=continue
+frame=50
+fps=25.00
+bitrate= 150.2kbits/s
+out_time_us=2000000
+out_time=00:00:02.000000
+speed=1.00x
+progress=continue
+frame=100
+fps=33.33
+out_time_us=4000000
+speed=1.33x
+progress=end
+"""
+
+
+def test_parse_progress():
+    events = list(parse_progress(PROGRESS_OUTPUT.splitlines(keepends=True), "encode", 4))
+    assert events == [
+        Progress("encode", frame=0, fps=0, speed=None, out_time=0, total_time=4),
+        Progress("encode", frame=50, fps=25, speed=1, out_time=2, total_time=4),
+        Progress("encode", frame=100, fps=33.33, speed=1.33, out_time=4, total_time=4, done=True),
+    ]
+    assert events[0].eta is None
+    assert events[1].eta == 2
+    assert events[1].fraction == 0.5
+    assert str(events[1]) == "encode frame=50 fps=25.0 speed=1.00x time=2.0/4.0s eta=2s"
+
+
+def popen_mock(mocker):
+    def popen_side_effect(command, pass_fds):
+        # Write progress to the pipe passed to ffmpeg
+        with open(pass_fds[0], "w", closefd=False) as pipe:
+            pipe.write(PROGRESS_OUTPUT)
+        return process
+
+    popen = mocker.patch("subprocess.Popen")
+    popen.side_effect = popen_side_effect
+    process = popen.return_value
+    process.__enter__.return_value = process
+    process.returncode = 0
+    return popen, process
+
+
+def test_run_ffmpeg_progress(mocker):
+    popen, _ = popen_mock(mocker)
+    events = []
+    run_ffmpeg(["ffmpeg", "-i", "in.jpg", "out.mp4"], events.append, total_time=4)
+    (fd,) = popen.call_args.kwargs["pass_fds"]
+    assert popen.call_args.args[0] == [
+        "ffmpeg",
+        "-progress",
+        f"pipe:{fd}",
+        "-nostats",
+        "-i",
+        "in.jpg",
+        "out.mp4",
+    ]
+    assert [event.frame for event in events] == [0, 50, 100]
+
+
+def test_run_ffmpeg_abort(mocker):
+    _, process = popen_mock(mocker)
+
+    def progress(event):
+        if event.frame > 0 and event.speed < 1.5:
+            raise TimeoutError("too slow")
+
+    with pytest.raises(TimeoutError):
+        run_ffmpeg(["ffmpeg", "out.mp4"], progress)
+    process.kill.assert_called_once()
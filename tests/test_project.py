@@ -0,0 +1,140 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import dataclasses
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from kbai import cli
+from kbai.easings import Easing
+from kbai.project import Project, ProjectError
+from kbai.structs import AnnotatedBox, Fit, KBImage, Size
+from kbai.transitions import Transition
+
+
+def test_project_round_trip(tmp_path):
+    project = Project(
+        Size(640, 360),
+        30,
+        [
+            KBImage(
+                "https://example.com/a.jpg",
+                Size(1280, 960),
+                fit=Fit.CONTAIN,
+                boxes=[AnnotatedBox(10, 20, 300, 400, "dog")],
+                duration=4,
+                transition_duration=0.5,
+                transition=Transition.WIPELEFT,
+                transition_easing=Easing.QUADRATIC_IN_OUT,
+                feature_text=["a dog"],
+            )
+        ],
+    )
+    project.write(tmp_path / "project.json")
+    assert Project.read(tmp_path / "project.json") == project
+
+
+def test_project_invalid(tmp_path):
+    path = tmp_path / "project.json"
+    path.write_text('{"version": 1, "size": [640, 360], "fps": 25, "images": [{"src": "a.jpg"}]}')
+    with pytest.raises(ProjectError):
+        Project.read(path)
+    path.write_text("{")
+    with pytest.raises(ProjectError):
+        Project.read(path)
+
+
+def test_encode_project_render(tmp_path, mocker):
+    encode = mocker.patch("kbai.main.encode")
+    create_detector = mocker.patch("kbai.main.create_detector")
+    Image.new("RGB", (640, 480), "red").save(tmp_path / "a.jpg")
+    project = tmp_path / "project.json"
+    cli.main(
+        [
+            "encode",
+            "--no-detect",
+            "--project",
+            str(project),
+            "-s",
+            "320x240",
+            "-i",
+            str(tmp_path / "a.jpg"),
+            "/bx",
+            "10,10,100,100,dog",
+        ]
+    )
+    # Only the project is written without an output
+    encode.assert_not_called()
+    (image,) = Project.read(project).images
+    assert image.size == Size(640, 480)
+    assert image.boxes == [AnnotatedBox(10, 10, 100, 100, "dog")]
+
+    cli.main(["render", str(project), "-o", str(tmp_path / "out.mp4")])
+    create_detector.assert_not_called()
+    assert encode.call_args.args[:4] == (Size(320, 240), 25, [image], str(tmp_path / "out.mp4"))
+
+
+def test_missing_output(mocker, capsys):
+    encode_main = mocker.patch("kbai.cli.encode_main")
+    render_main = mocker.patch("kbai.cli.render_main")
+    with pytest.raises(SystemExit):
+        cli.main(["encode", "-i", "a.jpg"])
+    assert "-o/--output --project" in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        cli.main(["render", "project.json"])
+    assert "-o/--output" in capsys.readouterr().err
+    encode_main.assert_not_called()
+    render_main.assert_not_called()
+
+
+def test_project_relative_srcs(tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "projects").mkdir()
+    image = KBImage(
+        str(tmp_path / "images" / "a.jpg"),
+        Size(640, 480),
+        fit=Fit.COVER,
+        boxes=[],
+        duration=3,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=Easing.LINEAR,
+    )
+    url_image = dataclasses.replace(image, src="https://example.com/b.jpg")
+    Project(Size(320, 240), 25, [image, url_image]).write(tmp_path / "projects" / "project.json")
+    project = json.loads((tmp_path / "projects" / "project.json").read_text())
+    assert [image["src"] for image in project["images"]] == [
+        os.path.join("..", "images", "a.jpg"),
+        "https://example.com/b.jpg",
+    ]
+    # Resolved against the project file, not the working directory
+    monkeypatch.chdir(tmp_path / "images")
+    assert Project.read(os.path.join("..", "projects", "project.json")).images == [
+        dataclasses.replace(image, src=os.path.join("..", "images", "a.jpg")),
+        url_image,
+    ]
+
+
+def test_render_fetches_remote_images(tmp_path, mocker):
+    encode = mocker.patch("kbai.main.encode")
+    get = mocker.patch("httpx.Client.get")
+    get.return_value.content = b"image"
+    bare_get = mocker.patch("httpx.get")
+    image = KBImage(
+        "https://example.com/a.jpg",
+        Size(640, 480),
+        fit=Fit.COVER,
+        boxes=[],
+        duration=3,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=Easing.LINEAR,
+    )
+    Project(Size(320, 240), 25, [image, image]).write(tmp_path / "project.json")
+    cli.main(["render", str(tmp_path / "project.json"), "-o", str(tmp_path / "out.mp4")])
+    # Fetched once with the pooled client, so ffmpeg gets the bytes instead of the URL
+    get.assert_called_once_with("https://example.com/a.jpg")
+    bare_get.assert_not_called()
+    assert [image.data for image in encode.call_args.args[2]] == [b"image", b"image"]
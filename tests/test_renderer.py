@@ -0,0 +1,94 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import pytest
+from PIL import Image
+
+import kbai.renderer
+from kbai.easings import Easing
+from kbai.encoder import segment_layout
+from kbai.renderer import build_canvas, frame_boxes, render_segment
+from kbai.structs import AnnotatedBox, Fit, KBImage, Size
+from kbai.transitions import Transition
+
+
+def kbimage(size=None, fit=Fit.COVER, boxes=()):
+    return KBImage(
+        "image.png",
+        size or Size(1280, 960),
+        fit=fit,
+        boxes=list(boxes),
+        duration=2,
+        transition_duration=1,
+        transition=Transition.FADE,
+        transition_easing=Easing.LINEAR,
+    )
+
+
+def test_frame_boxes_without_zoom():
+    image = kbimage()
+    encode_size = Size(640, 360)
+    layout = segment_layout(image, encode_size)
+    boxes = frame_boxes(image, layout, encode_size, 25, 2)
+    assert len(boxes) == 50
+    # Center crop of the full resolution image
+    assert boxes[0] == boxes[49] == (0, 120, 1280, 840)
+
+
+def test_frame_boxes_zoom():
+    box = AnnotatedBox(400, 300, 720, 480, "thing")
+    image = kbimage(boxes=[box])
+    encode_size = Size(640, 480)
+    layout = segment_layout(image, encode_size)
+    boxes = frame_boxes(image, layout, encode_size, 25, 2)
+    assert boxes[0] == pytest.approx((0, 0, 1280, 960))
+    assert layout.zoom == pytest.approx(4)
+    # Linear easing, nearly at the final zoom on the last frame
+    zoom = 1 + (layout.zoom - 1) * 49 / 50
+    left, top, right, bottom = boxes[49]
+    assert (right - left, bottom - top) == pytest.approx((1280 / zoom, 960 / zoom))
+    assert ((left + right) / 2, (top + bottom) / 2) == pytest.approx(box.center, abs=1)
+    # Subpixel camera motion, not rounded to whole pixels
+    assert any(left != int(left) for left, _, _, _ in (boxes[i] for i in range(len(boxes))))
+
+
+def test_contain_canvas():
+    box = AnnotatedBox(400, 300, 720, 480, "thing")
+    image = kbimage(size=Size(960, 1280), fit=Fit.CONTAIN, boxes=[box])
+    layout = segment_layout(image, Size(640, 480))
+    canvas, scale = build_canvas(Image.new("RGB", (960, 1280), "red"), image, layout)
+    # Padded canvas at the source resolution rather than the encoded size
+    assert canvas.size == (1707, 1280)
+    assert scale == pytest.approx(1707 / 640)
+    assert canvas.getpixel((0, 0)) == (0, 0, 0)
+    assert canvas.getpixel((853, 640)) == (255, 0, 0)
+
+
+def test_render_segment(mocker, tmp_path):
+    source = tmp_path / "image.png"
+    Image.new("RGB", (1280, 960), "red").save(source)
+    popen_mock = mocker.patch("subprocess.Popen")
+    popen_mock.return_value.wait.return_value = 0
+    render_segment(kbimage(), str(source), Size(320, 240), 10, tmp_path / "segment.mkv")
+
+    command = popen_mock.call_args.args[0]
+    assert command[command.index("-s") + 1] == "320x240"
+    assert command[command.index("-i") + 1] == "-"
+    writes = popen_mock.return_value.stdin.write.call_args_list
+    assert len(writes) == 20
+    assert all(len(call.args[0]) == 320 * 240 * 3 for call in writes)
+
+
+def test_render_segment_preview(mocker, tmp_path):
+    source = tmp_path / "image.jpg"
+    Image.new("RGB", (1280, 960), "red").save(source)
+    popen_mock = mocker.patch("subprocess.Popen")
+    popen_mock.return_value.wait.return_value = 0
+    open_source = mocker.spy(kbai.renderer, "open_source")
+    render_segment(kbimage(), str(source), Size(320, 240), 10, tmp_path / "segment.mkv", preview=True)
+
+    # The JPEG is decoded at the scale the segment needs
+    assert open_source.call_args.args[1] == Size(320, 240)
+    assert open_source.spy_return.size == (320, 240)
+    writes = popen_mock.return_value.stdin.write.call_args_list
+    assert len(writes) == 20
+    assert all(len(call.args[0]) == 320 * 240 * 3 for call in writes)
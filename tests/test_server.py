@@ -0,0 +1,153 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import queue
+import threading
+from argparse import Namespace
+
+import httpx
+import pytest
+
+from kbai.cli import parse_job
+from kbai.jobs import JobError, JobQueue, JobStatus, spec_argv
+from kbai.server import create_server
+from kbai.structs import Fit, Size
+
+ENCODE_SPEC = {
+    "command": "encode",
+    "size": "640x480",
+    "default_image_fit": None,
+    "image": [["a.jpg", "/ft", "dog", "/if", "contain"], ["b.jpg"]],
+    "offline": True,
+    "output": "out.mp4",
+}
+
+
+def test_spec_argv():
+    assert spec_argv(ENCODE_SPEC) == [
+        "encode",
+        "--size",
+        "640x480",
+        "--image",
+        "a.jpg",
+        "/ft",
+        "dog",
+        "/if",
+        "contain",
+        "--image",
+        "b.jpg",
+        "--offline",
+        "--output",
+        "out.mp4",
+    ]
+    with pytest.raises(JobError):
+        spec_argv(["encode"])
+    with pytest.raises(JobError):
+        spec_argv({"size": "640x480"})
+
+
+def test_parse_job():
+    command, args = parse_job(ENCODE_SPEC)
+    assert command == "encode"
+    assert args.size == Size(640, 480)
+    assert args.image[0] == {"image": "a.jpg", "feature_text": ["dog"], "image_fit": Fit.CONTAIN}
+    assert args.offline
+    with pytest.raises(JobError):
+        parse_job({"command": "encode", "output": "out.mp4"})
+    with pytest.raises(JobError):
+        parse_job({"command": "serve"})
+    with pytest.raises(JobError):
+        parse_job(ENCODE_SPEC | {"default_transition_name": "nope"})
+    # Without an output or project file
+    with pytest.raises(JobError, match="--output"):
+        parse_job({k: v for k, v in ENCODE_SPEC.items() if k != "output"})
+    with pytest.raises(JobError, match="--output"):
+        parse_job({"command": "render", "project": "project.json"})
+
+
+def test_job_queue():
+    def run(job):
+        if job.args.fail:
+            raise RuntimeError("failed")
+        return {"value": job.args.value}
+
+    jobs = JobQueue(run, workers=2, history=1)
+    jobs.start()
+    first = jobs.submit("test", Namespace(fail=False, value=1))
+    jobs.join()
+    failed = jobs.submit("test", Namespace(fail=True, value=2))
+    jobs.join()
+    jobs.stop()
+    assert failed.status == JobStatus.FAILED
+    assert failed.error == "failed"
+    assert first.status == JobStatus.SUCCEEDED
+    assert first.result == {"value": 1}
+    # Only the most recently finished job is kept
+    assert jobs.get(first.id) is None
+    assert jobs.jobs() == [failed]
+
+
+def test_job_queue_full():
+    jobs = JobQueue(lambda job: {}, max_queued=1)
+    jobs.submit("test", Namespace())
+    with pytest.raises(queue.Full):
+        jobs.submit("test", Namespace())
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def client(request, tmp_path):
+    running = threading.Event()
+    started = threading.Event()
+
+    def run(job):
+        job.progress = {"frame": 1}
+        running.set()
+        started.wait(timeout=5)
+        return {"output": job.args.output}
+
+    jobs = JobQueue(run, max_queued=1)
+    if request.param == "unix":
+        server = create_server(jobs, parse_job, socket_path=str(tmp_path / "kbai.sock"))
+        client = httpx.Client(
+            transport=httpx.HTTPTransport(uds=str(tmp_path / "kbai.sock")), base_url="http://kbai"
+        )
+    else:
+        server = create_server(jobs, parse_job, port=0)
+        client = httpx.Client(base_url=f"http://127.0.0.1:{server.server_address[1]}")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    jobs.start()
+    client.running = running
+    client.started = started
+    client.jobs = jobs
+    yield client
+    started.set()
+    client.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    jobs.stop()
+
+
+def test_server(client):
+    response = client.post("/jobs", json=ENCODE_SPEC)
+    assert response.status_code == 202
+    job = response.json()
+    assert response.headers["Location"] == f"/jobs/{job['id']}"
+    assert client.running.wait(timeout=5)
+    assert client.get(f"/jobs/{job['id']}").json()["progress"] == {"frame": 1}
+    # The worker is blocked on the first job, so the second fills the queue and the third is refused
+    client.post("/jobs", json=ENCODE_SPEC).raise_for_status()
+    assert client.post("/jobs", json=ENCODE_SPEC).status_code == 503
+
+    assert client.post("/jobs", json={"command": "encode"}).status_code == 400
+    assert client.post("/jobs", content=b"{").status_code == 400
+    assert client.post("/jobs", json=ENCODE_SPEC | {"default_transition_name": "nope"}).status_code == 400
+    assert client.post("/jobs", content=b"\xff").status_code == 400
+    assert client.get("/jobs/unknown").status_code == 404
+
+    client.started.set()
+    client.jobs.join()
+    job = client.get(f"/jobs/{job['id']}").json()
+    assert job["status"] == "succeeded"
+    assert job["result"] == {"output": "out.mp4"}
+    assert [job["status"] for job in client.get("/jobs").json()] == ["succeeded", "succeeded"]
@@ -0,0 +1,70 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import httpx
+import pytest
+
+from kbai.store import ImageStore
+
+ETAG = '"v1"'
+
+
+@pytest.fixture
+def requests():
+    return []
+
+
+@pytest.fixture
+def client(requests):
+    def handler(request):
+        requests.append(request)
+        if request.headers.get("If-None-Match") == ETAG:
+            return httpx.Response(304)
+        return httpx.Response(200, content=request.url.path.encode() * 10, headers={"ETag": ETAG})
+
+    with httpx.Client(transport=httpx.MockTransport(handler)) as client:
+        yield client
+
+
+def test_revalidate(tmp_path, client, requests):
+    store = ImageStore(tmp_path)
+    data = store.fetch("https://example.com/a.jpg", client)
+    assert data == b"/a.jpg" * 10
+    assert "If-None-Match" not in requests[0].headers
+
+    assert ImageStore(tmp_path).fetch("https://example.com/a.jpg", client) == data
+    assert requests[1].headers["If-None-Match"] == ETAG
+
+
+def test_offline(tmp_path, client, requests):
+    ImageStore(tmp_path).fetch("https://example.com/a.jpg", client)
+    store = ImageStore(tmp_path, offline=True)
+    assert store.fetch("https://example.com/a.jpg", client) == b"/a.jpg" * 10
+    assert len(requests) == 1
+    with pytest.raises(LookupError):
+        store.fetch("https://example.com/b.jpg", client)
+
+
+def test_content_addressed(tmp_path, client):
+    store = ImageStore(tmp_path)
+    store.fetch("https://example.com/a.jpg", client)
+    store.fetch("https://example.com/a.jpg?w=100", client)
+    assert len(list(store.objects.glob("*/*"))) == 1
+
+
+def test_max_bytes(tmp_path, client, requests, mocker):
+    time_mock = mocker.patch("time.time", return_value=1000.0)
+    store = ImageStore(tmp_path, max_bytes=len(b"/a.jpg" * 10) * 2)
+    store.fetch("https://example.com/a.jpg", client)
+    time_mock.return_value = 1001.0
+    store.fetch("https://example.com/b.jpg", client)
+    time_mock.return_value = 1002.0
+    store.fetch("https://example.com/a.jpg", client)
+    time_mock.return_value = 1003.0
+    store.fetch("https://example.com/c.jpg", client)
+    assert len(list(store.objects.glob("*/*"))) == 2
+
+    offline = ImageStore(tmp_path, offline=True)
+    offline.fetch("https://example.com/a.jpg")
+    offline.fetch("https://example.com/c.jpg")
+    with pytest.raises(LookupError):
+        offline.fetch("https://example.com/b.jpg")
@@ -0,0 +1,75 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+
+from PIL import Image
+
+from kbai import cli, timings
+from kbai.timings import Timings, record_span
+
+
+def test_spans():
+    spans = []
+    global_spans = []
+    recorder = Timings(hooks=[spans.append])
+    timings.add_hook(global_spans.append)
+    try:
+        with recorder.span("allocate") as allocate:
+            # Well above the peak so far
+            data = bytearray(256 * 1024 * 1024)
+            data[::4096] = b"x" * len(data[::4096])
+        del data
+        with recorder.span("fetch", image="a.jpg") as span:
+            sum(range(100000))
+        with recorder.span("fetch", image="b.jpg"):
+            pass
+        with record_span(recorder, "detect"):
+            pass
+        with record_span(None, "detect") as span_none:
+            assert span_none is None
+    finally:
+        timings.remove_hook(global_spans.append)
+
+    assert spans == global_spans == recorder.spans
+    assert span.attributes == {"image": "a.jpg"}
+    assert span.wall > 0
+    assert span.thread_cpu > 0
+    assert span.max_rss_growth >= 0
+
+    report = recorder.report()
+    assert allocate.max_rss_growth > 128 * 1024 * 1024
+    assert [span["name"] for span in report["spans"]] == ["allocate", "fetch", "fetch", "detect"]
+    assert report["stages"]["fetch"]["count"] == 2
+    assert report["stages"]["detect"]["count"] == 1
+    assert report["max_rss"] > 0
+
+
+def test_encode_timings(tmp_path, mocker):
+    mocker.patch("subprocess.check_call")
+    for name in ["a.jpg", "b.jpg"]:
+        Image.new("RGB", (640, 480), "red").save(tmp_path / name)
+    report = tmp_path / "timings.json"
+
+    cli.main(
+        [
+            "encode",
+            "--no-detect",
+            "--timings",
+            str(report),
+            "-i",
+            str(tmp_path / "a.jpg"),
+            "-i",
+            str(tmp_path / "b.jpg"),
+            "-o",
+            str(tmp_path / "out.mp4"),
+        ]
+    )
+
+    stages = json.loads(report.read_text())["stages"]
+    assert {name: stage["count"] for name, stage in stages.items()} == {
+        "decode": 2,
+        "wait_image": 2,
+        "filtergraph": 1,
+        "ffmpeg": 1,
+        "encode": 1,
+    }